@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+#
+# Benchmark the startup time and the mode switch latency of the
+# toggle-wacom-touchring-mode.py script. No tablet is needed: the script
+# is run against a fake 'xsetwacom' and 'qdbus' placed first in the PATH
+# and a fake 'wacom_led/status_led0_select' sysfs tree in a temporary
+# directory. The results are printed (or written to a file) as JSON, so
+# that they can be compared between releases.
+#
+# Copyright (C) 2014 Vangelis Tasoulas <vangelis@tasoulas.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+PROGRAM_NAME = 'benchmark-toggle-wacom-touchring-mode'
+VERSION = '0.0.1'
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'toggle-wacom-touchring-mode.py')
+CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'toggle-wacom-touchring-mode-client.py')
+
+# The number of X devices, cmdlist keys and profiles of the baseline scenario.
+# Every other scenario scales one of them.
+BASELINE = {'devices': 1, 'keys': 2, 'profiles': 1}
+SCALED = [
+    ('devices', [1, 2, 4, 8, 16]),
+    ('keys', [2, 8, 16, 32, 64]),
+    ('profiles', [1, 10, 50]),
+]
+QUICK_SCALED = [
+    ('devices', [1, 16]),
+    ('keys', [2, 64]),
+    ('profiles', [1, 50]),
+]
+
+FAKE_XSETWACOM = r'''#!/bin/sh
+# Fake xsetwacom for the benchmarks. The number of devices and parameters
+# is read from the files of $FAKE_WACOM_DIR.
+case "$1" in
+--list)
+    if [ "$2" = "parameters" ]; then
+        printf 'AbsWheelUp - X11 event.\nAbsWheelDown - X11 event.\n'
+        i=0; n=$(cat "$FAKE_WACOM_DIR/keys")
+        while [ $i -lt $n ]; do echo "Param$i - Benchmark parameter"; i=$((i+1)); done
+    else
+        i=0; n=$(cat "$FAKE_WACOM_DIR/devices")
+        while [ $i -lt $n ]; do printf 'Fake Wacom %d pad\tid: %d\ttype: PAD\n' $i $((i+10)); i=$((i+1)); done
+    fi
+    ;;
+--get)
+    echo 0
+    ;;
+esac
+exit 0
+'''
+
+FAKE_QDBUS = r'''#!/bin/sh
+echo Bench0
+'''
+
+#----------------------------------------------------------------------
+def percentile(values, p):
+    """
+    Return the p-th percentile (nearest rank) of values
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+#----------------------------------------------------------------------
+def summary(values):
+    """
+    Return the p50/p99/min/max of a list of durations in milliseconds
+    """
+    return {'p50': round(percentile(values, 50), 3),
+            'p99': round(percentile(values, 99), 3),
+            'min': round(min(values), 3),
+            'max': round(max(values), 3),
+            'samples': len(values)}
+
+#----------------------------------------------------------------------
+def timed(func, iterations):
+    """
+    Call func() iterations times and return the durations in milliseconds
+    """
+    durations = []
+    for _ in xrange(iterations):
+        start = time.time()
+        func()
+        durations.append((time.time() - start) * 1000.0)
+    return durations
+
+#----------------------------------------------------------------------
+def write_file(path, content, mode=None):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+class fake_environment(object):
+    """
+    A temporary directory with the fake programs, the fake sysfs tree and
+    private XDG directories, and the environment variables that point the
+    script to them.
+    """
+    #----------------------------------------------------------------------
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix=PROGRAM_NAME + '-')
+        self.bin_dir = os.path.join(self.root, 'bin')
+        self.sysfs_root = os.path.join(self.root, 'sys')
+        self.led_file = os.path.join(self.sysfs_root, 'class/hidraw/hidraw0/device/wacom_led/status_led0_select')
+        write_file(os.path.join(self.bin_dir, 'xsetwacom'), FAKE_XSETWACOM, 0o755)
+        write_file(os.path.join(self.bin_dir, 'qdbus'), FAKE_QDBUS, 0o755)
+
+        self.env = dict(os.environ)
+        self.env.update({'PATH': self.bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                         'FAKE_WACOM_DIR': self.root,
+                         'TOGGLE_WACOM_SYSFS_ROOT': self.sysfs_root,
+                         'XDG_RUNTIME_DIR': os.path.join(self.root, 'run'),
+                         'XDG_CACHE_HOME': os.path.join(self.root, 'cache'),
+                         'XDG_CONFIG_HOME': os.path.join(self.root, 'config'),
+                         # No session bus, so that the profile is read from the fake qdbus
+                         'DBUS_SESSION_BUS_ADDRESS': 'unix:path=' + os.path.join(self.root, 'no-bus'),
+                         'DISPLAY': ':99'})
+        self.socket_path = os.path.join(self.root, 'run', 'bench.sock')
+
+    #----------------------------------------------------------------------
+    def setup(self, devices, keys, profiles):
+        """
+        Prepare a scenario with the given number of X devices, cmdlist
+        keys per mode and profiles (of 4 modes each)
+        """
+        for directory in ('run', 'cache', 'config'):
+            shutil.rmtree(os.path.join(self.root, directory), ignore_errors=True)
+            os.makedirs(os.path.join(self.root, directory))
+        write_file(os.path.join(self.root, 'devices'), str(devices))
+        write_file(os.path.join(self.root, 'keys'), str(keys))
+        write_file(self.led_file, '0')
+
+        generated = {}
+        for p in xrange(profiles):
+            generated['Bench{}'.format(p)] = dict(
+                (str(mode), {'mode_description': 'Bench{} Mode {}'.format(p, mode),
+                             'apply_to_dev_type': 'PAD',
+                             'cmdlist': dict(('Param{}'.format(k), str(mode + 1)) for k in xrange(keys))})
+                for mode in xrange(4))
+        write_file(os.path.join(self.root, 'config', 'wacom-touchring', 'profiles.d', 'bench.json'),
+                   json.dumps(generated))
+
+    #----------------------------------------------------------------------
+    def load_module(self):
+        """
+        Import a fresh copy of the script with this environment applied
+        """
+        os.environ.clear()
+        os.environ.update(self.env)
+        module = imp.load_source('toggle_wacom_touchring_mode_bench', SCRIPT)
+        module._configureLogging('CRITICAL')
+        return module
+
+    #----------------------------------------------------------------------
+    def run(self, args, script=SCRIPT):
+        """
+        Run the script with args and return the duration in milliseconds
+        """
+        start = time.time()
+        subprocess.check_call([sys.executable, script, '-q'] + args, env=self.env)
+        return (time.time() - start) * 1000.0
+
+    #----------------------------------------------------------------------
+    def start_daemon(self, args=()):
+        daemon = subprocess.Popen([sys.executable, SCRIPT, '-q', '--daemon', '-s', self.socket_path] + list(args),
+                                  env=self.env)
+        # The socket file exists from bind() on, but connections are refused until listen()
+        for _ in xrange(500):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                s.connect(self.socket_path)
+                return daemon
+            except socket.error:
+                time.sleep(0.01)
+            finally:
+                s.close()
+        daemon.kill()
+        raise RuntimeError("The daemon did not start")
+
+    #----------------------------------------------------------------------
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+#----------------------------------------------------------------------
+def benchmark_global(env, iterations):
+    """
+    Measurements that do not depend on the scenario
+    """
+    env.setup(**BASELINE)
+    import_code = ("import imp, time; t = time.time(); imp.load_source('m', {!r}); "
+                   "print((time.time() - t) * 1000.0)").format(SCRIPT)
+    import_ms = [float(subprocess.check_output([sys.executable, '-c', import_code], env=env.env))
+                 for _ in xrange(iterations)]
+    interpreter_ms = timed(lambda: subprocess.check_call([sys.executable, '-c', 'pass'], env=env.env), iterations)
+
+    module = env.load_module()
+    subprocess_ms = timed(lambda: module.executeCommand(['xsetwacom', '--set', 'Fake Wacom 0 pad', 'Param0', '1']),
+                          iterations)
+    return {'interpreter_startup_ms': summary(interpreter_ms),
+            'import_ms': summary(import_ms),
+            'xsetwacom_subprocess_ms': summary(subprocess_ms)}
+
+#----------------------------------------------------------------------
+def benchmark_scenario(env, iterations, devices, keys, profiles):
+    """
+    Measure discovery, profile loading and toggle latency for one scenario
+    """
+    env.setup(devices, keys, profiles)
+    module = env.load_module()
+    result = {'devices': devices, 'keys': keys, 'profiles': profiles}
+
+    result['profile_compile_ms'] = summary(timed(lambda: module.load_profiles(use_cache=False), iterations))
+    result['profile_load_ms'] = summary(timed(lambda: module.load_profiles(), iterations))
+
+    wacom = module.toggle_touchring(module.get_param_backend('xsetwacom'), use_cache=False)
+    result['discovery_ms'] = summary(timed(wacom.discover, iterations))
+    result['init_cached_ms'] = summary(timed(lambda: module.toggle_touchring(wacom.backend).close(), iterations))
+
+    # In-process switches, as done by the daemon. Every mode of the generated profiles
+    # changes all of the keys, so the full cmdlist is sent on every switch.
+    result['toggle_ms'] = summary(timed(wacom.toggle_mode, iterations))
+    wacom.close()
+
+    # A new process for every switch, without a daemon
+    missing_socket = os.path.join(env.root, 'run', 'missing.sock')
+    result['cli_toggle_ms'] = summary([env.run(['--toggle', '-s', missing_socket]) for _ in xrange(iterations)])
+
+    # The client of a running daemon
+    daemon = env.start_daemon()
+    try:
+        result['daemon_client_toggle_ms'] = summary([env.run(['--toggle', '-s', env.socket_path])
+                                                     for _ in xrange(iterations)])
+        # The fast path for the global shortcut, from the start of the interpreter to the reply
+        result['fast_client_toggle_ms'] = summary([env.run(['--toggle', '-s', env.socket_path], CLIENT_SCRIPT)
+                                                   for _ in xrange(iterations)])
+        result['daemon_request_ms'] = summary(timed(
+            lambda: module.send_daemon_request(env.socket_path, {'command': 'toggle'}), iterations))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    return result
+
+#----------------------------------------------------------------------
+def _command_Line_Options():
+    parser = argparse.ArgumentParser(description=PROGRAM_NAME + " version " + VERSION)
+    parser.add_argument("-n", "--iterations",
+                        action="store",
+                        type=int,
+                        default=20,
+                        dest="iterations",
+                        help="Number of samples per measurement. (Default: 20)")
+    parser.add_argument("--quick",
+                        action="store_true",
+                        default=False,
+                        dest="quick",
+                        help="Only run the smallest and the largest scenario of each dimension.")
+    parser.add_argument("-o", "--output",
+                        action="store",
+                        default=None,
+                        dest="output",
+                        metavar="FILE",
+                        help="Write the JSON results to FILE instead of the standard output.")
+    parser.add_argument("--startup-budget",
+                        action="store",
+                        type=float,
+                        default=None,
+                        dest="startup_budget",
+                        metavar="MS",
+                        help="Exit with 1 if the median time of a toggle through the fast client "
+                             "(toggle-wacom-touchring-mode-client.py) and the daemon exceeds MS milliseconds "
+                             "in the baseline scenario.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = _command_Line_Options()
+    original_environ = dict(os.environ)
+    env = fake_environment()
+    try:
+        results = {'version': VERSION,
+                   'python': sys.version.split()[0],
+                   'timestamp': int(time.time()),
+                   'iterations': options.iterations,
+                   'global': benchmark_global(env, options.iterations),
+                   'scenarios': []}
+        done = []
+        for dimension, values in (QUICK_SCALED if options.quick else SCALED):
+            for value in values:
+                scenario = dict(BASELINE)
+                scenario[dimension] = value
+                if scenario in done:
+                    continue
+                done.append(scenario)
+                sys.stderr.write("Scenario {}\n".format(scenario))
+                results['scenarios'].append(benchmark_scenario(env, options.iterations, **scenario))
+    finally:
+        os.environ.clear()
+        os.environ.update(original_environ)
+        env.cleanup()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if options.startup_budget is not None:
+        startup_ms = results['scenarios'][0]['fast_client_toggle_ms']['p50']
+        if startup_ms > options.startup_budget:
+            sys.stderr.write("Startup budget exceeded: a toggle through the fast client took {} ms (p50), "
+                             "the budget is {} ms.\n".format(startup_ms, options.startup_budget))
+            sys.exit(1)
+        sys.stderr.write("Startup within budget: {} ms (p50) <= {} ms.\n".format(startup_ms, options.startup_budget))
@@ -38,25 +38,62 @@
 # Run the script with sudo (needs root privileges) and choose either "install" or "uninstall"
 # as a command line argument.
 # If you want to install a different version, just change the version number in variable "pkgver"
+#
+# The downloaded tarball is kept (with its sha256 sum) in "cache_dir", so that it is downloaded
+# only once per version: 'install --offline' installs from the cache without network access, and
+# 'install --tarball FILE' takes the tarball from a local file instead of downloading it.
+# The modules are prebuilt for every installed kernel (that has its headers installed) in
+# parallel, one job per kernel, and DKMS only copies the prebuilt modules. After a kernel update,
+# run the script with the 'prebuild' argument to build (and install) the modules for the new kernels.
 
 if [[ "$(whoami)" != "root" ]]; then
 	echo "You must be root to execute this script."
 	exit 1
 fi
 
-if [[ "$1" != "install" && "$1" != "uninstall" ]]; then
+command="$1"
+shift
+offline=false
+tarball=
+while [[ $# -gt 0 ]]; do
+	case "$1" in
+		--offline) offline=true ;;
+		--tarball) tarball="$2"; shift ;;
+		*) command= ;;
+	esac
+	shift
+done
+
+if [[ "$command" != "install" && "$command" != "uninstall" && "$command" != "prebuild" ]]; then
 	echo "You should provide one argument to the script."
 	echo "Accepted arguments:"
-	echo "    'install', 'uninstall'"
+	echo "    'install [--offline] [--tarball FILE]', 'uninstall', 'prebuild [--offline] [--tarball FILE]'"
+	exit 1
+fi
+if [[ -n "$tarball" && ! -f "$tarball" ]]; then
+	echo "The tarball '$tarball' does not exist."
 	exit 1
 fi
 
 pkgname=input-wacom
 pkgver=0.39.0
+# The sha256 sum of the tarball of "pkgver". If it is empty, the sum of the first downloaded
+# tarball is recorded and the cached tarball is checked against it.
+pkgsha256=
 dest_dir="/usr/src/"
-dkms_location="$dest_dir"/"$pkgname-$pkgver"/"dkms.conf"
 blacklist_file="/etc/modprobe.d/blacklist-""$pkgname""-dkms.conf"
 udev_rules_file="/etc/udev/rules.d/wacom.rules"
+cache_dir="/var/cache/$pkgname-dkms"
+
+set_paths() {
+	# Set the paths that depend on "pkgver"
+	src_dir="$dest_dir""$pkgname-$pkgver"
+	dkms_location="$src_dir"/"dkms.conf"
+	make_helper="$src_dir"/"dkms-make.sh"
+	tarball_cache="$cache_dir"/"$pkgname-$pkgver.tar.bz2"
+	build_cache="$cache_dir"/"$pkgver"
+}
+set_paths
 
 dkms=$(which dkms)
 exit_status=$?
@@ -76,14 +113,20 @@ version_ge() {
 	return 0
 }
 
-DRIVER_KERNEL_VER=
-# ls -d */ | sed -e s'/\///' | sed -E 's/[a-zA-Z]+//g' | sort -V -r);
-if [[ -z "$DRIVER_KERNEL_VER" ]]; then version_ge $(uname -r | sed -E 's/([0-9]+.[0-9]+.[0-9]+).*/\1/') 4.5.0 && DRIVER_KERNEL_VER=4.5; fi
-if [[ -z "$DRIVER_KERNEL_VER" ]]; then version_ge $(uname -r | sed -E 's/([0-9]+.[0-9]+.[0-9]+).*/\1/') 3.17.0 && DRIVER_KERNEL_VER=3.17; fi
-if [[ -z "$DRIVER_KERNEL_VER" ]]; then version_ge $(uname -r | sed -E 's/([0-9]+.[0-9]+.[0-9]+).*/\1/') 3.7.0 && DRIVER_KERNEL_VER=3.7; fi
-if [[ -z "$DRIVER_KERNEL_VER" ]]; then version_ge $(uname -r | sed -E 's/([0-9]+.[0-9]+.[0-9]+).*/\1/') 2.6.38 && DRIVER_KERNEL_VER=2.6.38; fi
-if [[ -z "$DRIVER_KERNEL_VER" ]]; then version_ge $(uname -r | sed -E 's/([0-9]+.[0-9]+.[0-9]+).*/\1/') 2.6.36 && DRIVER_KERNEL_VER=2.6.36; fi
-if [[ -z "$DRIVER_KERNEL_VER" ]]; then version_ge $(uname -r | sed -E 's/([0-9]+.[0-9]+.[0-9]+).*/\1/') 2.6.30 && DRIVER_KERNEL_VER=2.6.30; fi
+driver_kernel_ver() {
+	# Print the directory of the input-wacom sources that is built for the kernel release "$1"
+	# Return 1 if the kernel is older than 2.6.30
+	local version=$(echo "$1" | sed -E 's/([0-9]+.[0-9]+.[0-9]+).*/\1/')
+	version_ge "$version" 4.5.0 && echo 4.5 && return 0
+	version_ge "$version" 3.17.0 && echo 3.17 && return 0
+	version_ge "$version" 3.7.0 && echo 3.7 && return 0
+	version_ge "$version" 2.6.38 && echo 2.6.38 && return 0
+	version_ge "$version" 2.6.36 && echo 2.6.36 && return 0
+	version_ge "$version" 2.6.30 && echo 2.6.30 && return 0
+	return 1
+}
+
+DRIVER_KERNEL_VER=$(driver_kernel_ver "$(uname -r)")
 if [[ -z "$DRIVER_KERNEL_VER" ]]; then
 	# If the variable is still unset by now, the running kernel is < 2.6.30
 	echo "Kernel version 2.6.30 and above are supported by this driver."
@@ -112,13 +155,13 @@ function create_dkms_file {
 PACKAGE_NAME="$pkgname"
 PACKAGE_VERSION="$pkgver"
 CLEAN="make clean"
-MAKE[0]="./configure && make"
+MAKE[0]="/bin/bash $make_helper \${kernelver} \${kernel_source_dir}"
 BUILT_MODULE_NAME[0]="wacom"
 DEST_MODULE_NAME[0]="wacom_dkms"
 BUILT_MODULE_NAME[1]="wacom_w8001"
 DEST_MODULE_NAME[1]="wacom_w8001_dkms"
-BUILT_MODULE_LOCATION[0]="$DRIVER_KERNEL_VER/"
-BUILT_MODULE_LOCATION[1]="$DRIVER_KERNEL_VER/"
+BUILT_MODULE_LOCATION[0]="\$(/bin/bash $make_helper --location \${kernelver})/"
+BUILT_MODULE_LOCATION[1]="\$(/bin/bash $make_helper --location \${kernelver})/"
 DEST_MODULE_LOCATION[0]="/kernel/drivers/input/tablet"
 DEST_MODULE_LOCATION[1]="/kernel/drivers/input/touchscreen"
 AUTOINSTALL="yes"
@@ -126,20 +169,175 @@ AUTOINSTALL="yes"
 EOF
 }
 
+function create_make_helper {
+	# Create the script that DKMS runs (MAKE[0]) in its build directory to build the modules for
+	# one kernel. It copies the modules prebuilt by prebuild_kernel if they were built from the
+	# same tarball, and otherwise runs configure (reusing the configure cache of that kernel) and make.
+	cat << EOF > "$make_helper"
+#!/bin/bash
+# Created by input-wacom-dkms.sh for $pkgname $pkgver
+# Usage: dkms-make.sh KERNELVER KERNEL_SOURCE_DIR
+#        dkms-make.sh --location KERNELVER
+
+$(declare -f version_ge driver_kernel_ver)
+
+if [[ "\$1" == "--location" ]]; then
+	driver_kernel_ver "\$2"
+	exit
+fi
+
+kernelver="\$1"
+kernel_source_dir="\$2"
+location=\$(driver_kernel_ver "\$kernelver") || exit 1
+prebuilt="$build_cache/build/\$kernelver"
+if [[ -f "\$prebuilt/.prebuilt" && "\$(cat "\$prebuilt/.prebuilt")" == "\$(cat "$src_dir/.tarball.sha256")" ]]; then
+	echo "Using the modules prebuilt in '\$prebuilt'."
+	cp "\$prebuilt/\$location/"*.ko "\$location/" && exit 0
+fi
+mkdir -p "$build_cache"
+./configure --cache-file="$build_cache/config-\$kernelver.cache" --with-kernel="\$kernel_source_dir" \\
+	--with-kernel-version="\$kernelver" && make
+EOF
+}
+
+function verify_tarball {
+	# Return 0 if the tarball "$1" has the sha256 sum recorded when it was cached (and "pkgsha256")
+	local sum=$(sha256sum "$1" | cut -d " " -f 1)
+	[[ -f "$1.sha256" && "$sum" == "$(cat "$1.sha256")" ]] && [[ -z "$pkgsha256" || "$sum" == "$pkgsha256" ]]
+}
+
+function fetch_tarball {
+	# Put a verified tarball of "pkgver" in the cache, from the --tarball file, the cache itself
+	# or the website (unless --offline is used)
+	mkdir -p "$cache_dir"
+	if [[ -z "$tarball" && -f "$tarball_cache" ]]; then
+		if verify_tarball "$tarball_cache"; then
+			echo "Using the cached '$tarball_cache'."
+			return 0
+		fi
+		echo "The cached '$tarball_cache' does not match its sha256 sum, removing it."
+		rm -f "$tarball_cache" "$tarball_cache.sha256"
+	fi
+
+	if [[ -n "$tarball" ]]; then
+		cp "$tarball" "$tarball_cache.part" || return 1
+	elif $offline; then
+		echo "There is no cached tarball of $pkgname $pkgver in '$cache_dir'."
+		echo "Run the script without '--offline', or with '--tarball FILE', first."
+		return 1
+	elif ! wget https://github.com/linuxwacom/input-wacom/releases/download/input-wacom-"${pkgver}"/"${pkgname}"-"${pkgver}".tar.bz2 -O "$tarball_cache.part"; then
+		rm -f "$tarball_cache.part"
+		return 1
+	fi
+
+	local sum=$(sha256sum "$tarball_cache.part" | cut -d " " -f 1)
+	if [[ -n "$pkgsha256" && "$sum" != "$pkgsha256" ]]; then
+		echo "The sha256 sum of the tarball ($sum) is not the expected one ($pkgsha256)."
+		rm -f "$tarball_cache.part"
+		return 1
+	fi
+	if ! tar tjf "$tarball_cache.part" > /dev/null; then
+		echo "The tarball of $pkgname $pkgver is not a valid tar.bz2 file."
+		rm -f "$tarball_cache.part"
+		return 1
+	fi
+	mv "$tarball_cache.part" "$tarball_cache"
+	echo "$sum" > "$tarball_cache.sha256"
+}
+
+function installed_kernels {
+	# Print the kernels whose headers are installed
+	local build
+	for build in /lib/modules/*/build; do
+		if [[ -d "$build" ]]; then basename "$(dirname "$build")"; fi
+	done
+}
+
+function prebuild_kernel {
+	# Build the modules for the kernel "$1" in a private copy of the sources. Nothing is done if
+	# they were already built from the same tarball.
+	local kernel="$1"
+	local build_dir="$build_cache/build/$kernel"
+	if [[ -f "$build_dir/.prebuilt" && "$(cat "$build_dir/.prebuilt")" == "$(cat "$src_dir/.tarball.sha256")" ]]; then
+		return 0
+	fi
+	rm -rf "$build_dir"
+	mkdir -p "$build_dir"
+	cp -a "$src_dir"/. "$build_dir"/ || return 1
+	(cd "$build_dir" && ./configure --cache-file="$build_cache/config-$kernel.cache" \
+		--with-kernel="/lib/modules/$kernel/build" --with-kernel-version="$kernel" && make) \
+		> "$build_cache/build-$kernel.log" 2>&1 || return 1
+	cp "$src_dir/.tarball.sha256" "$build_dir/.prebuilt"
+}
+
+function prebuild_modules {
+	# Prebuild the modules for every installed kernel, one job per kernel. DKMS builds every
+	# kernel in the same build directory, so the jobs use their own copies of the sources and
+	# DKMS only copies their results (see create_make_helper).
+	# The kernels that were built are listed in "prebuilt_kernels".
+	local kernel i pids=() kernels=()
+	prebuilt_kernels=()
+	mkdir -p "$build_cache"
+	for kernel in $(installed_kernels); do
+		if ! driver_kernel_ver "$kernel" > /dev/null; then
+			echo "Skipping kernel $kernel, it is older than 2.6.30."
+			continue
+		fi
+		prebuild_kernel "$kernel" &
+		pids+=($!)
+		kernels+=("$kernel")
+	done
+	for i in "${!pids[@]}"; do
+		if wait "${pids[$i]}"; then
+			echo "The modules for kernel ${kernels[$i]} are built."
+			prebuilt_kernels+=("${kernels[$i]}")
+		else
+			echo "Building the modules for kernel ${kernels[$i]} failed, see '$build_cache/build-${kernels[$i]}.log'."
+		fi
+	done
+}
+
+function install_modules {
+	# Install the modules with DKMS for the running kernel and the prebuilt kernels that do not have them yet
+	local kernel
+	for kernel in $(echo "$(uname -r)" "${prebuilt_kernels[@]}" | tr " " "\n" | sort -u); do
+		if [[ -e "/var/lib/dkms/$pkgname/$pkgver/$kernel" ]] && compgen -G "/var/lib/dkms/$pkgname/kernel-$kernel-*" > /dev/null; then
+			continue
+		fi
+		$dkms install -m $pkgname -v $pkgver -k "$kernel"
+	done
+}
+
 function create_udev_rules_file {
 	# Create a udev rules to give permission to simple users to change the led status
+	# The LED files are sysfs attributes, so MODE and GROUP (which only apply to the /dev nodes)
+	# cannot be used. Instead, every rule matches only the device that owns the wacom_led
+	# directory, once the wacom driver is bound to it, and runs chmod on its own LED file.
+	# The LEDs belong to the HID device since Linux 3.17, and to the USB interface before.
+	local led
 	if version_ge "$DRIVER_KERNEL_VER" "3.17"; then
-		cat << EOF > "$udev_rules_file"
-ATTRS{idVendor}=="056a", RUN+="/bin/bash -c '/bin/chmod 666 /sys/class/hidraw/hidraw*/device/wacom_led/status_led*_select'"
-EOF
+		udev_subsystem=hid
 	else
-		cat << EOF > "$udev_rules_file"
-ATTRS{idVendor}=="056a", RUN+="/bin/bash -c '/bin/chmod 666 /sys/bus/usb/devices/*/wacom_led/status_led*_select'"
+		udev_subsystem=usb
+	fi
+	echo "# Let the users change the mode LEDs of the Wacom tablets (created by input-wacom-dkms.sh)" > "$udev_rules_file"
+	for led in status_led0_select status_led1_select; do
+		cat << EOF >> "$udev_rules_file"
+ACTION!="remove", SUBSYSTEM=="$udev_subsystem", DRIVER=="wacom", TEST=="wacom_led/$led", RUN+="/bin/chmod 0666 %S%p/wacom_led/$led"
 EOF
+	done
+	# Kernels older than 4.14 do not send "bind" events, so the rules above only match the events
+	# triggered later. Match the input devices that the driver creates for the tablet instead.
+	if ! version_ge "$(uname -r | sed -E 's/([0-9]+.[0-9]+.[0-9]+).*/\1/')" 4.14.0; then
+		for led in status_led0_select status_led1_select; do
+			cat << EOF >> "$udev_rules_file"
+ACTION=="add", SUBSYSTEM=="input", KERNEL=="input*", TEST=="../../wacom_led/$led", RUN+="/bin/chmod 0666 %S%p/../../wacom_led/$led"
+EOF
+		done
 	fi
 }
 
-if [[ "$1" == "install" ]]; then
+if [[ "$command" == "install" ]]; then
 
 	if [[ $(check_if_installed) == "true" ]]; then
 		echo "It looks like '$pkgname' is already installed."
@@ -147,28 +345,29 @@ if [[ "$1" == "install" ]]; then
 		exit 1
 	fi
 
-	wget https://github.com/linuxwacom/input-wacom/releases/download/input-wacom-"${pkgver}"/"${pkgname}"-"${pkgver}".tar.bz2 -O "${dest_dir}""${pkgname}"-"${pkgver}".tar.bz2
+	fetch_tarball || exit 1
 
 	cd "$dest_dir"
 
 	# Extract
-	tar xvf "$pkgname"-"$pkgver".tar.bz2
-
-	# Remove the tar.bz2 file
-	rm "$pkgname"-"$pkgver".tar.bz2
+	tar xvf "$tarball_cache"
+	cp "$tarball_cache.sha256" "$src_dir/.tarball.sha256"
 
 	create_blacklist_file
 	create_dkms_file
+	create_make_helper
 	create_udev_rules_file
 
-	$dkms install -m $pkgname -v $pkgver
+	prebuild_modules
+	install_modules
 
 	# Reload the udev rules
 	# For debugging: udevadm test $(udevadm info --name=/dev/input/event17 | grep P: | cut -f2 -d " ")
 	#                udevadm info --attribute-walk --name=/dev/input/event17
 	# Change '/dev/input/event17' with the event assigned to your device.
 	udevadm control --reload
-	udevadm trigger
+	# Only the devices of the subsystem that owns the LEDs need to run the new rules
+	udevadm trigger --action=change --subsystem-match="$udev_subsystem"
 
 	echo -e "\n"
 	echo "#####################################"
@@ -178,14 +377,35 @@ if [[ "$1" == "install" ]]; then
 	echo "To remove the modules, use 'rmmod wacom' or 'rmmod wacom_w8001' instead."
 	echo -e "\n"
 
-elif [[ "$1" == "uninstall" ]]; then
+elif [[ "$command" == "prebuild" ]]; then
+
+	if [[ $(check_if_installed) != "true" ]]; then
+		echo "'$pkgname' is not installed, run the script with the 'install' argument instead."
+		exit 1
+	fi
+	pkgver=$(ls "/var/lib/dkms/$pkgname/" | grep -v '^kernel-' | head -1)
+	set_paths
+
+	# Extract the sources again if they were removed
+	if [[ ! -f "$src_dir/.tarball.sha256" ]]; then
+		fetch_tarball || exit 1
+		(cd "$dest_dir" && tar xf "$tarball_cache") || exit 1
+		cp "$tarball_cache.sha256" "$src_dir/.tarball.sha256"
+		create_dkms_file
+		create_make_helper
+	fi
+
+	prebuild_modules
+	install_modules
+
+elif [[ "$command" == "uninstall" ]]; then
 	# Just run some sanity checks first...
 
 	# If it is installed
 	if [[ $(check_if_installed) == "true" ]]; then
 		# Get the installed version number
-		pkgver=$(ls "/var/lib/dkms/$pkgname/" | head -1)
-		dkms_location="$dest_dir"/"$pkgname-$pkgver"/"dkms.conf"
+		pkgver=$(ls "/var/lib/dkms/$pkgname/" | grep -v '^kernel-' | head -1)
+		set_paths
 
 		# and if the dkms file does not exist
 		if [[ ! -f "$dkms_location" ]]; then
@@ -202,5 +422,8 @@ elif [[ "$1" == "uninstall" ]]; then
 		rm "$dkms_location"
 	fi
 	if [[ -d "$dest_dir"/"$pkgname-$pkgver" ]]; then rm -rf "$dest_dir"/"$pkgname-$pkgver"; fi
+	# Remove the prebuilt modules, but keep the verified tarballs for later (offline) installs
+	if [[ -d "$build_cache" ]]; then rm -rf "$build_cache"; fi
+	if [[ -d "$cache_dir" ]]; then echo "The downloaded tarballs are kept in '$cache_dir'."; fi
 
 fi
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+#
+# Unit tests of toggle-wacom-touchring-mode.py. Run them with
+# 'python -m unittest test_toggle_wacom_touchring_mode' or by executing
+# this file.
+#
+# Copyright (C) 2014 Vangelis Tasoulas <vangelis@tasoulas.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import imp
+import json
+import time
+import select
+import socket
+import shutil
+import unittest
+import tempfile
+import threading
+import subprocess
+from distutils.spawn import find_executable
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark-toggle-wacom-touchring-mode.py')
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'toggle-wacom-touchring-mode.py')
+CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'toggle-wacom-touchring-mode-client.py')
+
+toggle = imp.load_source('toggle_wacom_touchring_mode', SCRIPT)
+
+
+class executeBatchTest(unittest.TestCase):
+    """
+    The output and the return code of each command are the same whether
+    the batch runs as one 'sh -c' script or one process per command.
+    """
+    COMMANDS = [['printf', 'x'],
+                ['sh', '-c', 'printf y >&2; exit 3'],
+                ['echo', 'z'],
+                ['printf', '']]
+
+    #----------------------------------------------------------------------
+    def check_results(self, max_workers):
+        results = toggle.executeBatch(self.COMMANDS, max_workers).getResults()
+        self.assertEqual([cmd.getStdout(False) for cmd in results], ['x', '', 'z\n', ''])
+        self.assertEqual([cmd.getStderr(False) for cmd in results], ['', 'y', '', ''])
+        self.assertEqual([cmd.getReturnCode() for cmd in results], [0, 3, 0, 0])
+
+    #----------------------------------------------------------------------
+    def test_script(self):
+        self.check_results(0)
+
+    #----------------------------------------------------------------------
+    def test_processes(self):
+        self.check_results(4)
+
+
+class dbusMarshalTest(unittest.TestCase):
+    """
+    Values marshalled by dbus_connection are unmarshalled unchanged.
+    Variants are unmarshalled to their value.
+    """
+    #----------------------------------------------------------------------
+    def round_trip(self, signature, args):
+        bus = toggle.dbus_connection.__new__(toggle.dbus_connection)
+        data = bytearray()
+        for type_code, arg in zip(bus.split_signature(signature), args):
+            bus._marshal(data, type_code, arg)
+        values = []
+        offset = 0
+        for type_code in bus.split_signature(signature):
+            value, offset = bus._unmarshal(str(data), offset, type_code, '<')
+            values.append(value)
+        self.assertEqual(offset, len(data))
+        return values
+
+    #----------------------------------------------------------------------
+    def test_split_signature(self):
+        self.assertEqual(toggle.dbus_connection.split_signature('sa{sv}(ii)aai'), ['s', 'a{sv}', '(ii)', 'aai'])
+
+    #----------------------------------------------------------------------
+    def test_basic_types(self):
+        args = [7, True, -2, 3, -4, 5, -6 << 40, 7 << 40, 0.5, 'text', '/org/kde', 'a{sv}']
+        self.assertEqual(self.round_trip('ybnqiuxtdsog', args), args)
+
+    #----------------------------------------------------------------------
+    def test_containers(self):
+        settings = {'name': ('s', 'Krita'), 'modes': ('u', 4), 'leds': ('ai', [0, 1, 2])}
+        self.assertEqual(self.round_trip('ya{sv}(yx)as', [1, settings, (2, 3), ['a', 'bc']]),
+                         [1, {'name': 'Krita', 'modes': 4, 'leds': [0, 1, 2]}, (2, 3), ['a', 'bc']])
+
+    #----------------------------------------------------------------------
+    def test_empty_array(self):
+        self.assertEqual(self.round_trip('aya{sv}s', [[], {}, 'end']), [[], {}, 'end'])
+
+
+class fake_wacom_service(object):
+    """
+    An org.kde.Wacom service on its own dbus_connection: getProfile
+    returns profile, setSettings records its argument and returns it back,
+    and any other method gets an error reply.
+    """
+    ERROR_NAME = 'org.kde.Wacom.Error.UnknownMethod'
+
+    #----------------------------------------------------------------------
+    def __init__(self, address, profile):
+        self.profile = profile
+        self.received = []
+        self.bus = toggle.dbus_connection(address)
+        self.bus.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'RequestName',
+                      'su', ['org.kde.Wacom', 0])
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    #----------------------------------------------------------------------
+    def _serve(self):
+        bus = self.bus
+        while self._running:
+            try:
+                message = bus._receive(time.time() + 0.1)
+            except socket.timeout:
+                continue
+            if message['type'] != bus.METHOD_CALL:
+                continue
+            reply = {'destination': message.get('sender'), 'reply_serial': message['serial']}
+            if message.get('member') == 'getProfile':
+                bus.send(bus.METHOD_RETURN, reply, 's', [self.profile])
+            elif message.get('member') == 'setSettings':
+                self.received.append(message['body'])
+                bus.send(bus.METHOD_RETURN, reply, 'a{sv}',
+                         [dict((key, ('s', str(value))) for key, value in message['body'][0].items())])
+            else:
+                bus.send(bus.ERROR, dict(reply, error_name=self.ERROR_NAME), 's',
+                         ["No method '{}'".format(message.get('member'))])
+
+    #----------------------------------------------------------------------
+    def profile_changed(self, profile):
+        self.bus.send(self.bus.SIGNAL, {'path': '/Tablet', 'interface': 'org.kde.Wacom', 'member': 'profileChanged'},
+                      'ss', ['tablet-1', profile])
+
+    #----------------------------------------------------------------------
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self.bus.close()
+
+
+@unittest.skipIf(not find_executable('dbus-daemon'), 'dbus-daemon is not installed')
+class dbusConnectionTest(unittest.TestCase):
+    """
+    dbus_connection and kde_wacom_profile() against a private bus with
+    a fake org.kde.Wacom service
+    """
+    #----------------------------------------------------------------------
+    @classmethod
+    def setUpClass(cls):
+        cls.daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address'],
+                                      stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        cls.address = cls.daemon.stdout.readline().strip()
+
+    #----------------------------------------------------------------------
+    @classmethod
+    def tearDownClass(cls):
+        cls.daemon.terminate()
+        cls.daemon.wait()
+
+    #----------------------------------------------------------------------
+    def setUp(self):
+        self.service = fake_wacom_service(self.address, 'Krita')
+        self.bus = toggle.dbus_connection(self.address)
+
+    #----------------------------------------------------------------------
+    def tearDown(self):
+        self.bus.close()
+        self.service.close()
+
+    #----------------------------------------------------------------------
+    def test_hello(self):
+        self.assertTrue(self.bus.unique_name.startswith(':'))
+        self.assertNotEqual(self.bus.unique_name, self.service.bus.unique_name)
+
+    #----------------------------------------------------------------------
+    def test_method_call(self):
+        self.assertEqual(self.bus.call('org.kde.Wacom', '/Tablet', 'org.kde.Wacom', 'getProfile'), ['Krita'])
+
+    #----------------------------------------------------------------------
+    def test_dict_of_variants(self):
+        settings = {'profile': ('s', 'Gimp'), 'mode': ('u', 2), 'leds': ('ay', [1, 2])}
+        reply = self.bus.call('org.kde.Wacom', '/Tablet', 'org.kde.Wacom', 'setSettings', 'a{sv}', [settings])
+        self.assertEqual(self.service.received, [[{'profile': 'Gimp', 'mode': 2, 'leds': [1, 2]}]])
+        self.assertEqual(reply, [{'profile': 'Gimp', 'mode': '2', 'leds': '[1, 2]'}])
+
+    #----------------------------------------------------------------------
+    def test_error_reply(self):
+        with self.assertRaises(toggle.dbus_error) as context:
+            self.bus.call('org.kde.Wacom', '/Tablet', 'org.kde.Wacom', 'nothing')
+        self.assertEqual(context.exception.name, fake_wacom_service.ERROR_NAME)
+        with self.assertRaises(toggle.dbus_error) as context:
+            self.bus.call('org.kde.Missing', '/Tablet', 'org.kde.Missing', 'getProfile')
+        self.assertEqual(context.exception.name, 'org.freedesktop.DBus.Error.ServiceUnknown')
+
+    #----------------------------------------------------------------------
+    def test_profile_changed_signal(self):
+        received = []
+        self.bus.on_signal('org.kde.Wacom', 'profileChanged', lambda args, message: received.append(args))
+        self.service.profile_changed('Gimp')
+        deadline = time.time() + 5
+        while not received and time.time() < deadline:
+            select.select([self.bus], [], [], 0.1)
+            self.assertTrue(self.bus.handle_events())
+        self.assertEqual(received, [['tablet-1', 'Gimp']])
+
+    #----------------------------------------------------------------------
+    def test_kde_wacom_profile(self):
+        address = os.environ.get('DBUS_SESSION_BUS_ADDRESS')
+        os.environ['DBUS_SESSION_BUS_ADDRESS'] = self.address
+        toggle._SESSION_BUS = None
+        try:
+            self.assertEqual(toggle.kde_wacom_profile(), 'Krita')
+            self.service.profile = 'Gimp'
+            self.assertEqual(toggle.kde_wacom_profile(), 'Gimp')
+        finally:
+            if toggle._SESSION_BUS is not None:
+                toggle._SESSION_BUS.close()
+                toggle._SESSION_BUS = None
+            if address is None:
+                del os.environ['DBUS_SESSION_BUS_ADDRESS']
+            else:
+                os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+
+
+
+#----------------------------------------------------------------------
+def input_events(events):
+    """
+    Pack (time, type, code, value) tuples as 'struct input_event' records
+    """
+    return ''.join(toggle.pad_button_listener.INPUT_EVENT.pack(int(t), int(round(t % 1 * 1000000)), ev_type, code,
+                                                               value)
+                   for t, ev_type, code, value in events)
+
+
+class accelerationTest(unittest.TestCase):
+    #----------------------------------------------------------------------
+    def test_factor(self):
+        curve = [[10, 1], [100, 3]]
+        self.assertEqual(toggle.acceleration_factor([], 500), 1.0)
+        self.assertEqual(toggle.acceleration_factor(curve, 5), 1.0)
+        self.assertEqual(toggle.acceleration_factor(curve, 55), 2.0)
+        self.assertEqual(toggle.acceleration_factor(curve, 1000), 3.0)
+        self.assertEqual(toggle.acceleration_factor([[10, 1], [10, 2]], 10), 1.0)
+
+    #----------------------------------------------------------------------
+    def test_errors(self):
+        self.assertEqual(toggle.acceleration_errors({'up': 'REL_WHEEL 1', 'down': 'KEY_LEFTCTRL+KEY_KPMINUS'}), [])
+        self.assertEqual(len(toggle.acceleration_errors({'up': 'REL_WHEEL', 'down': 'KEY_NOPE',
+                                                         'curve': [[100, 2], [10, 1]]})), 3)
+
+
+class recorded_output(object):
+    """
+    Stands in for the uinput_device of a ring_processor
+    """
+    def __init__(self):
+        self.actions = []
+
+    def send_action(self, action, count):
+        self.actions.append((action, count))
+
+
+class ringProcessorTest(unittest.TestCase):
+    """
+    Recorded ABS_WHEEL events are turned into the number of actions of
+    the touchring rotation. The ring reports positions 1 to 72 (see
+    ring_processor.DEFAULT_POSITIONS), and 0 when the finger is lifted.
+    """
+    UP = (toggle.uinput_device.EV_REL, [toggle.uinput_device.REL_CODES['REL_WHEEL']], 1)
+    DOWN = (toggle.uinput_device.EV_REL, [toggle.uinput_device.REL_CODES['REL_WHEEL']], -1)
+
+    #----------------------------------------------------------------------
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    #----------------------------------------------------------------------
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        # The burst timers are cancelled by flush(), wait for their threads to end
+        for thread in threading.enumerate():
+            if isinstance(thread, threading._Timer):
+                thread.join()
+
+    #----------------------------------------------------------------------
+    def process(self, positions, curve=None, window_ms=1000):
+        """
+        Feed (time, position) pairs to a ring processor and return the
+        actions it sent
+        """
+        path = os.path.join(self.directory, 'events')
+        with open(path, 'wb') as f:
+            f.write(input_events([(1000 + t, toggle.ring_processor.EV_ABS, 0x08, position) for t, position in positions]))
+        config = {'up': 'REL_WHEEL 1', 'down': 'REL_WHEEL -1', 'window_ms': window_ms, 'curve': curve or []}
+        output = recorded_output()
+        processor = toggle.ring_processor(path, 0, lambda: config, output)
+        try:
+            self.assertEqual(processor.positions, toggle.ring_processor.DEFAULT_POSITIONS)
+            self.assertFalse(processor.handle_events())
+        finally:
+            processor.close()
+        return output.actions
+
+    #----------------------------------------------------------------------
+    def test_steps(self):
+        self.assertEqual(self.process([(0.00, 10), (0.01, 11), (0.02, 12), (0.03, 13)]), [(self.UP, 3)])
+        self.assertEqual(self.process([(0.00, 13), (0.01, 12), (0.02, 11)]), [(self.DOWN, 2)])
+
+    #----------------------------------------------------------------------
+    def test_wrap_around(self):
+        self.assertEqual(self.process([(0.00, 70), (0.01, 71), (0.02, 1), (0.03, 2)]), [(self.UP, 4)])
+        self.assertEqual(self.process([(0.00, 2), (0.01, 1), (0.02, 71), (0.03, 70)]), [(self.DOWN, 4)])
+
+    #----------------------------------------------------------------------
+    def test_lift(self):
+        # Lifting the finger at 11 and touching the ring again at 40 is not a rotation
+        self.assertEqual(self.process([(0.00, 10), (0.01, 11), (0.02, 0), (0.03, 40), (0.04, 41)]), [(self.UP, 2)])
+        self.assertEqual(self.process([(0.00, 10), (0.01, 0), (0.02, 0)]), [])
+
+    #----------------------------------------------------------------------
+    def test_acceleration(self):
+        curve = [[10, 1], [100, 3]]
+        # 4 detents in 0.4 s: 10 detents/s, factor 1
+        self.assertEqual(self.process([(i * 0.1, 10 + i) for i in xrange(5)], curve, 2000), [(self.UP, 4)])
+        # 10 detents in 0.2 s: 50 detents/s, factor 1 + 2 * 40 / 90
+        self.assertEqual(self.process([(i * 0.02, 10 + i) for i in xrange(11)], curve, 2000), [(self.UP, 18)])
+        # 10 detents in 10 ms: 1000 detents/s, factor 3
+        self.assertEqual(self.process([(i * 0.001, 10 + i) for i in xrange(11)], curve), [(self.UP, 30)])
+
+    #----------------------------------------------------------------------
+    def test_bursts_carry_the_remainder(self):
+        # Two bursts (2 s apart, longer than the window) of one detent each, with factor 1.5
+        actions = self.process([(0.00, 10), (0.01, 11), (2.00, 12)], [[0, 1.5]])
+        self.assertEqual(actions, [(self.UP, 1), (self.UP, 2)])
+
+
+
+class listenDeviceTest(unittest.TestCase):
+    """
+    Run the daemon against the fake xsetwacom and sysfs tree of the
+    benchmark, with a FIFO as the --listen-device, and press the button
+    by writing input events to the FIFO.
+    """
+    #----------------------------------------------------------------------
+    def setUp(self):
+        self.env = imp.load_source('benchmark_toggle_wacom_touchring_mode', BENCHMARK).fake_environment()
+        self.env.setup(1, 2, 1)
+        self.fifo = os.path.join(self.env.root, 'pad-events')
+        os.mkfifo(self.fifo)
+        self.daemon = self.env.start_daemon(['--listen', 'BTN_0', '--listen-device', self.fifo])
+
+    #----------------------------------------------------------------------
+    def tearDown(self):
+        self.daemon.terminate()
+        self.daemon.wait()
+        self.env.cleanup()
+
+    #----------------------------------------------------------------------
+    def status(self):
+        return toggle.send_daemon_request(self.env.socket_path, {'command': 'status'})
+
+    #----------------------------------------------------------------------
+    def wait_for_mode(self, mode):
+        for _ in xrange(200):
+            reply = self.status()
+            if reply['mode'] == mode:
+                return reply
+            time.sleep(0.02)
+        self.fail("The mode is still {} instead of {}".format(reply['mode'], mode))
+
+    #----------------------------------------------------------------------
+    def test_button_press_toggles_the_mode(self):
+        reply = self.status()
+        self.assertEqual(reply['status'], 'ok')
+        mode = reply['mode']
+
+        key = toggle.pad_button_listener.EV_KEY
+        button = toggle.pad_button_listener.BUTTON_CODES['BTN_0']
+        with open(self.fifo, 'wb', 0) as fifo:
+            fifo.write(input_events([(1, key, button, 1)]))
+            mode = (max(mode, 0) + 1) % 4
+            reply = self.wait_for_mode(mode)
+            self.assertEqual(reply['tablets'][0]['rings'][0]['mode'], mode)
+            with open(self.env.led_file) as f:
+                self.assertEqual(f.read().strip(), str(mode))
+
+            # Releases, autorepeats and other buttons do not toggle the mode
+            fifo.write(input_events([(1.1, key, button, 0), (1.2, key, button, 2),
+                                     (1.3, key, button + 1, 1), (1.4, key, button + 1, 0)]))
+            time.sleep(0.2)
+            self.assertEqual(self.status()['mode'], mode)
+
+            fifo.write(input_events([(2, key, button, 1), (2.1, key, button, 0)]))
+            mode = (mode + 1) % 4
+            self.wait_for_mode(mode)
+            with open(self.env.led_file) as f:
+                self.assertEqual(f.read().strip(), str(mode))
+
+
+
+class clientStartupTest(unittest.TestCase):
+    """
+    toggle-wacom-touchring-mode-client.py is bound to a pad button, so a
+    cold start up to the reply of the daemon must stay fast. The daemon
+    is a stub that answers every request with an 'ok' reply.
+    """
+    # Generous, the client usually needs a few tens of milliseconds
+    BUDGET_MS = 500
+    RUNS = 7
+
+    #----------------------------------------------------------------------
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'daemon.sock')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen(5)
+        self.requests = []
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    #----------------------------------------------------------------------
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    #----------------------------------------------------------------------
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except socket.error:
+                return
+            try:
+                request = conn.makefile('r').readline()
+                self.requests.append(json.loads(request))
+                conn.sendall(json.dumps({'status': 'ok', 'tablets': []}) + '\n')
+            finally:
+                conn.close()
+
+    #----------------------------------------------------------------------
+    def test_cold_start(self):
+        durations = []
+        for _ in xrange(self.RUNS):
+            start = time.time()
+            subprocess.check_call([sys.executable, CLIENT_SCRIPT, '-q', '-s', self.socket_path])
+            durations.append((time.time() - start) * 1000.0)
+
+        # Every run was answered by the stub, none fell back to the full script
+        self.assertEqual(self.requests, [{'command': 'toggle', 'ring': 0}] * self.RUNS)
+        median = sorted(durations)[len(durations) // 2]
+        self.assertLessEqual(median, self.BUDGET_MS,
+                             "The client took {:.1f} ms (median of {} runs), the budget is {} ms".format(
+                                 median, self.RUNS, self.BUDGET_MS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# Fast path for the global shortcut of toggle-wacom-touchring-mode.py.
+# Bind the shortcut to this script instead of 'toggle-wacom-touchring-mode.py
+# --toggle': it asks the running daemon (started with
+# 'toggle-wacom-touchring-mode.py --daemon') to switch the mode, and
+# imports nothing but what that takes. No argparse, no logging, no
+# profiles. If no daemon is running, or for any option it does not know,
+# the full toggle-wacom-touchring-mode.py is executed in its place with the
+# same arguments.
+#
+# Understood options: -t/--toggle, -m/--set-mode MODE, --apply PROFILE:MODE,
+# -T/--tablet TABLET, -R/--ring RING, -s/--socket PATH, --verify and -q/--quiet.
+# Without arguments, the mode is toggled.
+#
+# Copyright (C) 2014 Vangelis Tasoulas <vangelis@tasoulas.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import stat
+import json
+import errno
+import socket
+
+# Must match the PROGRAM_NAME of toggle-wacom-touchring-mode.py, it names the socket.
+PROGRAM_NAME = 'toggle-wacom-touchring-mode'
+
+SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), PROGRAM_NAME + '.py')
+
+#----------------------------------------------------------------------
+def default_socket_path():
+    """
+    Return the default path of the daemon control socket, or None if there
+    is no safe runtime directory (see default_socket_path() and
+    runtime_dir() in toggle-wacom-touchring-mode.py)
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, PROGRAM_NAME + '.sock')
+    path = os.path.join('/tmp', '{}-{}'.format(PROGRAM_NAME, os.getuid()))
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        return None
+    return os.path.join(path, 'daemon.sock')
+
+#----------------------------------------------------------------------
+def parse_args(args):
+    """
+    Return the daemon request, the socket path and whether the output is
+    quiet for the command line arguments, or None if they need the full
+    script.
+    """
+    request = {'command': 'toggle', 'ring': 0}
+    socket_path = default_socket_path()
+    quiet = False
+
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('--') and '=' in arg:
+            arg, value = arg.split('=', 1)
+            args.insert(0, value)
+        if arg in ('-t', '--toggle'):
+            request['command'] = 'toggle'
+        elif arg in ('--verify',):
+            request['verify'] = True
+        elif arg in ('-q', '--quiet'):
+            quiet = True
+        elif arg in ('-m', '--set-mode', '--apply', '-T', '--tablet', '-R', '--ring', '-s', '--socket') and args:
+            value = args.pop(0)
+            try:
+                if arg in ('-m', '--set-mode'):
+                    request.update({'command': 'set-mode', 'mode': int(value)})
+                elif arg == '--apply':
+                    profile, _, mode = value.rpartition(':')
+                    request.update({'command': 'set-mode', 'mode': int(mode), 'profile': profile or None})
+                elif arg in ('-T', '--tablet'):
+                    request['tablet'] = value
+                elif arg in ('-R', '--ring'):
+                    request['ring'] = int(value)
+                else:
+                    socket_path = value
+            except ValueError:
+                return None
+        else:
+            return None
+    return request, socket_path, quiet
+
+#----------------------------------------------------------------------
+def send_request(socket_path, request, timeout=2.0):
+    """
+    Send one request to the daemon and return the decoded reply.
+
+    Raises socket.error if the daemon cannot be reached (with errno
+    ENOENT or ECONNREFUSED if no daemon listens on socket_path) or does
+    not reply in time.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall(json.dumps(request) + '\n')
+        reply = ''
+        while not reply.endswith('\n'):
+            data = s.recv(4096)
+            if not data:
+                break
+            reply += data
+    finally:
+        s.close()
+    return json.loads(reply)
+
+#----------------------------------------------------------------------
+def run_full_script(args):
+    """
+    Replace this process with toggle-wacom-touchring-mode.py
+    """
+    os.execv(sys.executable, [sys.executable, SCRIPT] + args)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    parsed = parse_args(args)
+    if parsed is None:
+        run_full_script(args)
+    request, socket_path, quiet = parsed
+    if not socket_path:
+        run_full_script(args)
+
+    try:
+        reply = send_request(socket_path, request)
+    except socket.error as e:
+        if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            # The daemon may have received the request (e.g. it is slow to reply), switching
+            # in-process too could switch the mode twice.
+            sys.stderr.write("The daemon on '{}' did not reply: {}\n".format(socket_path, e))
+            exit(1)
+        # No daemon, switch the mode in-process.
+        run_full_script(args)
+    except ValueError as e:
+        sys.stderr.write("Invalid reply from the daemon on '{}': {}\n".format(socket_path, e))
+        exit(1)
+
+    if reply.get('status') != 'ok':
+        sys.stderr.write(reply.get('message', "Daemon failed to execute '{}'".format(request['command'])) + '\n')
+        exit(1)
+
+    if not quiet:
+        for tablet in reply.get('tablets', []):
+            for ring in tablet.get('rings', []):
+                name = tablet.get('name') if len(tablet['rings']) == 1 else '{} ring {}'.format(tablet.get('name'), ring.get('ring'))
+                sys.stderr.write("Tablet '{}', profile '{}', mode {}: {}\n".format(name, reply.get('profile'), ring.get('mode'),
+                                                                                  ring.get('mode_description')))
+    exit(0)
@@ -5,6 +5,12 @@
 # global shortcut to it. Then assign the global shortcut to the button "1"
 # (or any other button that you want) of your Wacom tablet.
 #
+# To avoid starting a new python process on every button press, start the
+# script once with '--daemon' (e.g. from your session autostart) and
+# bind the global shortcut to 'toggle-wacom-touchring-mode.py --toggle'
+# instead, or to 'toggle-wacom-touchring-mode-client.py', which starts
+# faster because it only imports what it needs to talk to the daemon.
+#
 # Copyright (C) 2014 Vangelis Tasoulas <vangelis@tasoulas.net>
 #
 # This program is free software: you can redistribute it and/or modify
@@ -23,10 +29,24 @@
 import os
 import sys
 import re
-import argparse
+import json
+import errno
+import socket
+import select
+import signal
+import glob
+import shlex
+import pipes
+import struct
+import stat
+import fcntl
+import marshal
+import threading
 import logging
-import subprocess
 import datetime
+import calendar
+import time
+import tempfile
 from collections import OrderedDict
 
 ##########################################################################
@@ -34,21 +54,24 @@ from collections import OrderedDict
 ##########################################################################
 ##########################################################################
 
-# A profile defined in the  cannot have more than MAX_MODES_PER_PROFILE.
+# The number of mode LEDs of a touchring, used when the kernel does not tell how many LEDs a
+# touchring has (the '<device>::wacom-<ring>.<led>' LEDs in sysfs appeared in Linux 4.11).
 MAX_MODES_PER_PROFILE = 4
 
 # Define your different profiles with their corresponding modes in the 'PROFILE' dict.
 # Look at the examples below, on how to define different profiles.
 #
-# A profile can have up to MAX_MODES_PER_PROFILE sequential modes, and the mode IDs should
-# start from 0 to MAX_MODES_PER_PROFILE - 1. My Wacom Intuos Pro Medium has 4 modes, thus, I
-# have set the variable MAX_MODES_PER_PROFILE to '4', and the profile IDs I use are 0, 1, 2, and 3.
-# I don't know if there are other devices with less or more modes, but if they do, feel free to
-# change the variable and define the corresponding modes accordingly.
+# The mode IDs of a profile should be sequential, starting from 0. The number of modes the
+# touchring cycles through is limited by the number of its LEDs: My Wacom Intuos Pro Medium has
+# 4 LEDs, thus, the profile IDs I use are 0, 1, 2, and 3. The LEDs of every tablet (and of every
+# touchring of tablets with two of them) are counted separately, so one profile can be used with
+# tablets that have less LEDs: the modes they have no LED for are skipped (with a warning).
+#
+# Tablets with two touchrings (e.g. the Cintiq 24HD) have one mode per touchring. The modes of
+# the second touchring (--ring 1) use the same profiles: their AbsWheelUp and AbsWheelDown keys
+# are applied to AbsWheel2Up and AbsWheel2Down (see RING_PARAMS), and their other keys are ignored.
 #
-# In principle, the way the script works could support unlimited modes for any device.  However,
-# you will not have proper LED indication if you choose to add more modes than those supported
-# by your device. Also if you define parameter keys other than the AbsWheelUp and AbsWheelDown,
+# Also if you define parameter keys other than the AbsWheelUp and AbsWheelDown,
 # the script could support changing other wacom keys on the "fly". Not only the behavior of the
 # touchring.
 #
@@ -65,6 +88,27 @@ MAX_MODES_PER_PROFILE = 4
 #       4=scroll mouse wheel up
 #       5=scroll mouse wheel down
 #
+# Profiles can also be defined outside of this script, in JSON files (YAML and TOML files are
+# supported if PyYAML or toml are installed) placed in '~/.config/wacom-touchring/profiles.d/'.
+# Each file contains a dict with the same structure as the 'PROFILE' dict, e.g.
+#     {"Inkscape": {"0": {"mode_description": "Inkscape Mode 0 - Zoom In/Out",
+#                         "apply_to_dev_type": "PAD",
+#                         "cmdlist": {"AbsWheelUp": "key +", "AbsWheelDown": "key -"}}}}
+# A profile defined in a file replaces the profile with the same name defined below.
+#
+# When the daemon runs with '--accelerate', a mode can also define an 'acceleration' dict. The
+# daemon then reads the rotation of the touchring from the pad itself and sends the actions
+# through a virtual input device (/dev/uinput), while AbsWheelUp and AbsWheelDown are set to 0 so
+# that the X driver does not act on the rotation too. The detents turned within 'window_ms'
+# milliseconds (default 40) are sent as one action, scaled by the factor that the 'curve' gives for
+# the rotation speed (in detents per second, interpolated between the [speed, factor] points).
+# 'up' and 'down' are the actions of the AbsWheelUp and AbsWheelDown directions: 'REL_WHEEL <n>'
+# (or 'REL_HWHEEL <n>') scrolls n steps per scaled detent in a single event, and keys (e.g.
+# 'KEY_LEFTCTRL+KEY_KPPLUS') are pressed once per scaled detent, so a factor below 1 sends fewer key
+# presses when the touchring is turned quickly. E.g.
+#     'acceleration': {'up': 'REL_WHEEL 1', 'down': 'REL_WHEEL -1',
+#                      'curve': [[0, 1], [50, 1], [200, 4]]}
+#
 # For a simple example, look the 'Default' PROFILE below:
 #     We define in the cmdlist that when the touchring is "rotated" anticlockwise (parameter key
 #     "AbsWheelUp") the touchring will emulate a mouse wheel up even (parameter value "4").
@@ -124,14 +168,44 @@ PROFILE = OrderedDict({
     }
 })
 
+# The parameters used by the touchrings after the first one, in place of the parameters the
+# profiles define for the first touchring (see above).
+RING_PARAMS = {
+    1: {'AbsWheelUp': 'AbsWheel2Up', 'AbsWheelDown': 'AbsWheel2Down'},
+}
+
+# When the script runs with '--follow-window', the profile is chosen from the WM_CLASS
+# of the active window instead of the KDE Wacom profile. A profile is used if its name
+# matches the class or the instance name of the window (case insensitive, e.g. the profile
+# 'Gimp' matches the class 'Gimp-2.10'). Add entries to the 'WINDOW_PROFILE' dict for
+# windows whose class does not look like the name of the profile. Windows that do not
+# match any profile use the 'Default' profile.
+WINDOW_PROFILE = OrderedDict({
+    # WM_CLASS (lower case) : PROFILE name
+    'org.kde.krita': 'Krita',
+})
+
 ##########################################################################
 ##########################################################################
 ##########################################################################
 ##########################################################################
 
 __all__ = [
-    'quick_regexp', 'print_', 'validate_profile_modes',
-    'strip_string_list', 'executeCommand', 'LOG'
+    'quick_regexp', 'print_', 'validate_profile_modes', 'profile_errors',
+    'load_profiles', 'read_profile_file',
+    'strip_string_list', 'executeCommand', 'executeBatch', 'backgroundTask', 'LOG',
+    'toggle_touchring', 'touchring_daemon', 'send_daemon_request',
+    'default_socket_path', 'xsetwacom_backend', 'xlib_backend',
+    'get_param_backend', 'discovery_fingerprint', 'load_discovery_cache',
+    'save_discovery_cache', 'load_runtime_state', 'save_runtime_state',
+    'find_pad_event_nodes', 'pad_button_listener',
+    'profile_for_window', 'active_window_watcher', 'tracer', 'TRACE',
+    'touchring_tablet', 'physical_device', 'x_device_nodes',
+    'touchring_leds', 'ring_cmdlist', 'dbus_connection', 'dbus_error',
+    'session_bus_address', 'kde_wacom_profile', 'parse_ring_action',
+    'acceleration_errors', 'acceleration_factor', 'uinput_device', 'ring_processor',
+    'kernel_version', 'driver_kernel_version', 'dkms_inventory', 'file_inventory',
+    'loaded_wacom_modules', 'system_inventory'
 ]
 
 PROGRAM_NAME = 'toggle-wacom-touchring-mode'
@@ -140,6 +214,29 @@ AUTHOR = 'Vangelis Tasoulas'
 
 LOG = logging.getLogger('default.' + __name__)
 
+# Where sysfs is mounted. Tests and benchmarks can point it to a fake tree.
+SYSFS_ROOT = os.environ.get('TOGGLE_WACOM_SYSFS_ROOT', '/sys')
+
+# How many seconds the helper programs may run before they are killed, so that a hung
+# qdbus (or X server) cannot block a mode switch.
+QDBUS_TIMEOUT = 1.0
+XSETWACOM_TIMEOUT = 5.0
+
+# The longest request line in bytes that the daemon accepts from a client
+MAX_REQUEST_SIZE = 65536
+
+# The files that input-wacom-dkms.sh installs, reported by --inventory
+DKMS_TREE = '/var/lib/dkms'
+BLACKLIST_FILE = '/etc/modprobe.d/blacklist-input-wacom-dkms.conf'
+UDEV_RULES_FILE = '/etc/udev/rules.d/wacom.rules'
+# The directories of the input-wacom sources and the oldest kernel each one is built for
+# (DRIVER_KERNEL_VER in input-wacom-dkms.sh), newest first
+DRIVER_KERNEL_VERSIONS = ['4.5', '3.17', '3.7', '2.6.38', '2.6.36', '2.6.30']
+
+# The default time in milliseconds over which the detents of a touchring are coalesced into one
+# action by the ring processors (see ring_processor and the 'acceleration' dict of the profiles).
+ACCELERATION_WINDOW_MS = 40
+
 ################################################
 ############### HELPER FUNCTIONS ###############
 ################################################
@@ -217,16 +314,22 @@ class executeCommand(object):
     Custom class to execute a shell command and
     provide to the user, access to the returned
     values
+
+    If timeout (in seconds) is given, the command (and every process it
+    started) is killed when it runs for longer than that.
+    A command that cannot be executed returns 127, like in a shell.
     """
 
-    def __init__(self, args=None, isUtc=True, shell = False):
+    def __init__(self, args=None, isUtc=True, shell = False, timeout=None):
         self._stdout = None
         self._stderr = None
         self._returncode = None
         self._timeStartedExecution = None
         self._timeFinishedExecution = None
+        self._timedOut = False
         self._args = args
         self._shell = shell
+        self._timeout = timeout
         self.isUtc = isUtc
         if(self._args != None):
             self.execute()
@@ -240,13 +343,34 @@ class executeCommand(object):
                 self._timeStartedExecution = datetime.datetime.utcnow()
             else:
                 self._timeStartedExecution = datetime.datetime.now()
-            p = subprocess.Popen(self._args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=self._shell)
+            # Imported here, so that the runs that only talk to the daemon do not pay for it.
+            import subprocess
+            with TRACE.span('exec', args=self._args):
+                try:
+                    # With a timeout, start a new process group so that the whole group can be killed.
+                    p = subprocess.Popen(self._args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=self._shell,
+                                         preexec_fn=os.setsid if self._timeout else None)
+                except OSError as e:
+                    p = None
+                    self._stdout, self._stderr = '', str(e)
+                if p is not None:
+                    timer = None
+                    if self._timeout:
+                        timer = threading.Timer(self._timeout, self._kill, [p])
+                        timer.start()
+                    try:
+                        self._stdout, self._stderr = p.communicate()
+                    finally:
+                        if timer is not None:
+                            timer.cancel()
+                            # A timer started by a daemon thread is a daemon thread too; let it end
+                            # now rather than at interpreter shutdown.
+                            timer.join()
             if(self.isUtc):
                 self._timeFinishedExecution = datetime.datetime.utcnow()
             else:
                 self._timeFinishedExecution = datetime.datetime.now()
-            self._stdout, self._stderr = p.communicate()
-            self._returncode = p.returncode
+            self._returncode = p.returncode if p is not None else 127
             return 1
         else:
             self._stdout = None
@@ -254,6 +378,21 @@ class executeCommand(object):
             self._returncode = None
             return 0
 
+    def _kill(self, p):
+        self._timedOut = True
+        LOG.warning("'{}' did not finish in {} seconds, killing it.".format(
+            self._args if self._shell else ' '.join(pipes.quote(arg) for arg in self._args), self._timeout))
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def getTimedOut(self):
+        """
+        Get whether the command was killed because it ran out of time
+        """
+        return self._timedOut
+
     def getStdout(self, getList=True):
         """
         Get the standard output of the executed command
@@ -304,6 +443,314 @@ class executeCommand(object):
                 return int(str(calendar.timegm(self._timeFinishedExecution.timetuple())) + str(self._timeFinishedExecution.strftime("%f")))
         return self._timeFinishedExecution
 
+    def getDuration(self):
+        """
+        Get the execution time of the command in seconds
+        """
+        if(isinstance(self._timeStartedExecution, datetime.datetime) and
+           isinstance(self._timeFinishedExecution, datetime.datetime)):
+            return (self._timeFinishedExecution - self._timeStartedExecution).total_seconds()
+        return None
+
+#----------------------------------------------------------------------
+def _monotonic_clock():
+    """
+    Return a function that reads CLOCK_MONOTONIC in seconds, or time.time
+    if it is not available. (Python 2 has no time.monotonic(), and loading
+    ctypes takes a while, so this is only done when tracing is enabled.)
+    """
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        ts = timespec()
+
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+#----------------------------------------------------------------------
+class tracer(object):
+    """
+    Collect timing spans of the hot path (discovery, profile resolution,
+    LED writes, every parameter set, ...).
+
+    Spans are only recorded after enable() is called; until then, span()
+    returns a shared object that does nothing.
+
+    #### Sample code ####
+    TRACE.enable()
+    with TRACE.span('discovery', cache='miss'):
+        discover()
+    TRACE.write('/tmp/trace.json', 'chrome')
+    """
+
+    class _span(object):
+        def __init__(self, tracer, name, args):
+            self._tracer = tracer
+            self._name = name
+            self._args = args
+
+        def __enter__(self):
+            self._start = self._tracer.clock()
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            self._tracer.add(self._name, self._start, self._tracer.clock(), **self._args)
+            return False
+
+    class _null_span(object):
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            return False
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.clock = time.time
+        self._null = self._null_span()
+
+    def enable(self):
+        self.enabled = True
+        self.clock = _monotonic_clock()
+        self._origin = self.clock()
+
+    def span(self, name, **args):
+        """
+        Return a context manager that records the time spent in its block
+        """
+        if not self.enabled:
+            return self._null
+        return self._span(self, name, args)
+
+    def add(self, name, start, end, **args):
+        # list.append() is atomic, so worker threads can add spans too
+        self.spans.append({'name': name,
+                           'start_us': round((start - self._origin) * 1e6, 1),
+                           'duration_us': round((end - start) * 1e6, 1),
+                           'pid': os.getpid(),
+                           'tid': threading.current_thread().ident,
+                           'args': args})
+
+    def write(self, path, trace_format='jsonl'):
+        """
+        Append the recorded spans to path as JSON lines, or write them as a
+        Chrome trace (chrome://tracing, Perfetto) with trace_format='chrome'
+        """
+        if trace_format == 'chrome':
+            events = [{'name': span['name'], 'ph': 'X', 'ts': span['start_us'], 'dur': span['duration_us'],
+                       'pid': span['pid'], 'tid': span['tid'], 'args': span['args']} for span in self.spans]
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        else:
+            with open(path, 'a') as f:
+                for span in self.spans:
+                    f.write(json.dumps(span) + '\n')
+
+    def summary(self):
+        """
+        Return a list of (name, count, total ms, max ms) tuples, the
+        most expensive first
+        """
+        totals = OrderedDict()
+        for span in self.spans:
+            count, total, longest = totals.get(span['name'], (0, 0.0, 0.0))
+            duration = span['duration_us'] / 1000.0
+            totals[span['name']] = (count + 1, total + duration, max(longest, duration))
+        return sorted([(name,) + values for name, values in totals.items()], key=lambda item: -item[2])
+
+    def print_summary(self):
+        print_('{:<20} {:>6} {:>11} {:>11}'.format('span', 'count', 'total (ms)', 'max (ms)'))
+        for name, count, total, longest in self.summary():
+            print_('{:<20} {:>6} {:>11.3f} {:>11.3f}'.format(name, count, total, longest))
+
+TRACE = tracer()
+
+#----------------------------------------------------------------------
+class executeBatch(object):
+    """
+    Execute a list of commands (argument lists) and provide access to the
+    executeCommand object of each one of them.
+
+    The commands are executed concurrently by up to max_workers threads.
+    If max_workers is 0, all of the commands are executed sequentially by
+    a single 'sh -c' process instead of one process per command.
+
+    timeout: The time (in seconds) each command may run, see executeCommand
+    cancelled: A function that returns True when the commands that have
+               not been started yet should not be started any more. The
+               result of every command that was not started is None.
+
+    #### Sample code ####
+    batch = executeBatch([['xsetwacom', '--set', 'pad', 'AbsWheelUp', '4'],
+                          ['xsetwacom', '--set', 'pad', 'AbsWheelDown', '5']])
+    for args, cmd in batch.getFailed():
+        print(args, cmd.getStderr(False))
+    """
+
+    def __init__(self, commands=None, max_workers=4, timeout=None, cancelled=None):
+        self._commands = commands
+        self._max_workers = max_workers
+        self._timeout = timeout
+        self._cancelled = cancelled or (lambda: False)
+        self._results = []
+        if(self._commands != None):
+            self.execute()
+
+    def execute(self, commands=None):
+        if(commands != None):
+            self._commands = commands
+
+        self._results = [None] * len(self._commands or [])
+        if not self._commands:
+            return 0
+
+        if self._max_workers <= 0:
+            self._execute_as_script()
+        elif self._max_workers == 1 or len(self._commands) == 1:
+            for i, args in enumerate(self._commands):
+                if self._cancelled():
+                    break
+                self._results[i] = executeCommand(args, timeout=self._timeout)
+        else:
+            self._execute_concurrently()
+        return 1
+
+    def _execute_concurrently(self):
+        pending = list(enumerate(self._commands))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending or self._cancelled():
+                        return
+                    i, args = pending.pop(0)
+                self._results[i] = executeCommand(args, timeout=self._timeout)
+
+        workers = [threading.Thread(target=worker) for _ in xrange(min(self._max_workers, len(pending)))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    def _execute_as_script(self):
+        # Every command is preceded by a marker and followed by its return code on both
+        # stdout and stderr, so that the output can be split per command. A newline is
+        # printed before the return code, in case the output does not end with one.
+        marker = '@@{}@@'.format(os.urandom(8).encode('hex'))
+        script = []
+        for i, args in enumerate(self._commands):
+            script.append('echo "{0} {1}"; echo "{0} {1}" >&2; {2}; rc=$?; '
+                          'echo; echo "{0} rc $rc"; echo >&2; echo "{0} rc $rc" >&2'.format(
+                              marker, i, ' '.join(pipes.quote(arg) for arg in args)))
+
+        if self._cancelled():
+            return
+        cmd = executeCommand(['sh', '-c', '\n'.join(script)],
+                             timeout=self._timeout * len(self._commands) if self._timeout else None)
+        stdout_parts = self._split_output(cmd.getStdout(False), marker)
+        stderr_parts = self._split_output(cmd.getStderr(False), marker)
+        for i in xrange(len(self._commands)):
+            result = executeCommand()
+            result._args = self._commands[i]
+            result._timeStartedExecution = cmd.getTimeStartedExecution()
+            result._timeFinishedExecution = cmd.getTimeFinishedExecution()
+            result._stdout, result._returncode = stdout_parts.get(i, ('', None))
+            result._stderr = stderr_parts.get(i, ('', None))[0]
+            if result._returncode is None:
+                # The script did not get this far
+                result._returncode = cmd.getReturnCode() or 1
+            self._results[i] = result
+
+    @staticmethod
+    def _split_output(output, marker):
+        """
+        Return a {command index: (output, return code)} dict
+        """
+        parts = {}
+        index = None
+        lines = []
+        for line in output.split('\n'):
+            if line.startswith(marker + ' '):
+                token = line[len(marker) + 1:]
+                if not token.startswith('rc '):
+                    index, lines = int(token), []
+                elif index is not None:
+                    # The output ends right before the newline that precedes the return code
+                    parts[index] = ('\n'.join(lines), int(token[3:]))
+                    index = None
+            elif index is not None:
+                lines.append(line)
+        if index is not None:
+            # The script was killed while this command was running
+            parts[index] = ('\n'.join(lines), None)
+        return parts
+
+    def getResults(self):
+        """
+        Get the executeCommand objects in the order the commands were given
+        """
+        return self._results
+
+    def getFailed(self):
+        """
+        Get a list of (args, executeCommand) tuples for the commands
+        that returned a non-zero exit status (or were not executed)
+        """
+        return [(args, cmd) for args, cmd in zip(self._commands or [], self._results)
+                if cmd is None or cmd.getReturnCode() != 0]
+
+#----------------------------------------------------------------------
+class backgroundTask(object):
+    """
+    Call a function in another thread, and get its result (or the
+    exception it raised) later.
+
+    #### Sample code ####
+    task = backgroundTask(executeCommand, ['qdbus', 'org.kde.Wacom'], timeout=1.0)
+    do_something_else()
+    print(task.getResult().getStdout(False))
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except BaseException:
+            self._error = sys.exc_info()
+
+    def getResult(self):
+        """
+        Wait for the function to return and get its return value. An
+        exception raised by the function is raised again here.
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
 #----------------------------------------------------------------------
 
 ########################################
@@ -359,6 +806,8 @@ def _command_Line_Options():
     argument parsing examples
     http://docs.python.org/2/library/argparse.html
     """
+    # Imported here, so that importing this script (e.g. by the benchmark) does not pay for it.
+    import argparse
 
     parser = argparse.ArgumentParser(description=PROGRAM_NAME + " version " + VERSION)
 
@@ -380,142 +829,3363 @@ def _command_Line_Options():
                                   metavar="LOG_LEVEL",
                                   help="LOG_LEVEL might be set to: CRITICAL, ERROR, WARNING, INFO, DEBUG. (Default: INFO)")
 
+    parser.add_argument("-r", "--rediscover",
+                        action="store_true",
+                        default=False,
+                        dest="rediscover",
+                        help="Ignore the cached LED file and device list and discover them again.")
+
+    parser.add_argument("-p", "--profiles-dir",
+                        action="store",
+                        default=None,
+                        dest="profiles_dir",
+                        metavar="DIR",
+                        help="Also load the profiles defined in the JSON (or YAML/TOML, if PyYAML/toml are "
+                             "installed) files of DIR. (Default: {})".format(profiles_dir()))
+    parser.add_argument("--verify",
+                        action="store_true",
+                        default=False,
+                        dest="verify",
+                        help="Only the parameters that changed since the last switch are sent to the devices. "
+                             "With --verify, the current values are read back first (with one batched "
+                             "'xsetwacom --get' call) to resync after other programs changed them.")
+    parser.add_argument("-T", "--tablet",
+                        action="store",
+                        default=None,
+                        dest="tablet",
+                        metavar="TABLET",
+                        help="Only switch the mode of TABLET: its index or its name (the sysfs name of its "
+                             "USB device, e.g. 1-2) as printed by --status, or 'all'. Every tablet has its "
+                             "own mode. (Default: all)")
+    parser.add_argument("-R", "--ring",
+                        action="store",
+                        type=int,
+                        default=0,
+                        dest="ring",
+                        metavar="RING",
+                        help="Switch the mode of touchring RING, on tablets with two touchrings. The profiles "
+                             "are shared, see RING_PARAMS. (Default: 0)")
+
+    traceGroupOpts = parser.add_argument_group('Tracing Options', 'Measure where the time of a mode switch goes')
+    traceGroupOpts.add_argument("--trace",
+                                action="store",
+                                default=None,
+                                dest="trace_file",
+                                metavar="FILE",
+                                help="Record the duration of every step (discovery, profile resolution, LED write, "
+                                     "every parameter set, ...) and write them to FILE when the script exits.")
+    traceGroupOpts.add_argument("--trace-format",
+                                action="store",
+                                choices=['jsonl', 'chrome'],
+                                default='jsonl',
+                                dest="trace_format",
+                                help="'jsonl' appends one JSON object per step to FILE, 'chrome' writes a trace "
+                                     "that can be loaded in chrome://tracing or Perfetto. (Default: jsonl)")
+    traceGroupOpts.add_argument("--trace-summary",
+                                action="store_true",
+                                default=False,
+                                dest="trace_summary",
+                                help="Print the total and the maximum time spent in each step when the script exits.")
+
+    daemonGroupOpts = parser.add_argument_group('Daemon Options',
+                                                'Keep the script resident and control it through a Unix domain socket')
+    daemonGroupOpts.add_argument("-d", "--daemon",
+                                 action="store_true",
+                                 default=False,
+                                 dest="isDaemon",
+                                 help="Run in the background and wait for requests on the control socket.")
+    daemonGroupOpts.add_argument("-s", "--socket",
+                                 action="store",
+                                 default=None,
+                                 dest="socket_path",
+                                 metavar="SOCKET_PATH",
+                                 help="Path of the control socket. (Default: $XDG_RUNTIME_DIR/{}.sock, or "
+                                      "/tmp/{}-<uid>/daemon.sock)".format(PROGRAM_NAME, PROGRAM_NAME))
+    parser.add_argument("-b", "--backend",
+                        action="store",
+                        choices=['auto'] + PARAM_BACKENDS.keys(),
+                        default="auto",
+                        dest="backend",
+                        help="How the Wacom parameters are applied. 'xlib' changes the X device properties "
+                             "in-process (needs python-xlib) and uses 'xsetwacom' for anything it cannot set. (Default: auto)")
+    parser.add_argument("-j", "--jobs",
+                        action="store",
+                        type=int,
+                        default=4,
+                        dest="jobs",
+                        metavar="N",
+                        help="Run up to N xsetwacom commands concurrently. With 0, all of the xsetwacom "
+                             "commands of a mode switch are run by a single 'sh' process. (Default: 4)")
+
+    daemonGroupOpts.add_argument("-L", "--listen",
+                                 action="store",
+                                 default=None,
+                                 dest="listen_button",
+                                 metavar="BUTTON",
+                                 help="Toggle the mode whenever BUTTON (e.g. BTN_0, or an event code) is pressed "
+                                      "on the pad, by reading its /dev/input/event* node. Implies --daemon. "
+                                      "Remove the desktop shortcut of that button when you use this option.")
+    daemonGroupOpts.add_argument("-w", "--follow-window",
+                                 action="store_true",
+                                 default=False,
+                                 dest="follow_window",
+                                 help="Choose the profile from the class of the active window (see WINDOW_PROFILE) "
+                                      "instead of the KDE Wacom profile. Needs python-xlib. Implies --daemon.")
+    daemonGroupOpts.add_argument("-A", "--accelerate",
+                                 action="store_true",
+                                 default=False,
+                                 dest="accelerate",
+                                 help="Read the rotation of the touchrings from the pads and send the actions of the "
+                                      "modes that define an 'acceleration' dict through /dev/uinput, scaled by the "
+                                      "rotation speed. Implies --daemon.")
+    daemonGroupOpts.add_argument("--listen-device",
+                                 action="store",
+                                 default=None,
+                                 dest="listen_device",
+                                 metavar="PATH",
+                                 help="Read the button (and touchring) events from PATH (an event node, a FIFO "
+                                      "or a file with recorded events) instead of the discovered pad.")
+
+    clientGroupOpts = daemonGroupOpts.add_mutually_exclusive_group()
+    clientGroupOpts.add_argument("-t", "--toggle",
+                                 action="store_const",
+                                 const="toggle",
+                                 dest="client_command",
+                                 help="Ask the running daemon to switch to the next mode.")
+    clientGroupOpts.add_argument("-m", "--set-mode",
+                                 action="store",
+                                 type=int,
+                                 default=None,
+                                 dest="client_mode",
+                                 metavar="MODE",
+                                 help="Ask the running daemon to switch to MODE.")
+    clientGroupOpts.add_argument("--apply",
+                                 action="store",
+                                 default=None,
+                                 dest="apply",
+                                 metavar="PROFILE:MODE",
+                                 help="Select PROFILE and switch to its MODE, through the running daemon if there is "
+                                      "one. Exits with 1 if the mode could not be applied.")
+    clientGroupOpts.add_argument("--inventory",
+                                 action="store_true",
+                                 default=False,
+                                 dest="inventory",
+                                 help="Print a JSON report of the driver installation (DKMS, blacklist and udev "
+                                      "files), the tablets, their LED files and X devices, the profiles and the "
+                                      "daemon, without changing anything.")
+    clientGroupOpts.add_argument("--status",
+                                 action="store_const",
+                                 const="status",
+                                 dest="client_command",
+                                 help="Print the profile and mode the running daemon is using.")
+    clientGroupOpts.add_argument("--reload",
+                                 action="store_const",
+                                 const="reload",
+                                 dest="client_command",
+                                 help="Ask the running daemon to rediscover the LED, the devices and the profile.")
+
     opts = parser.parse_args()
 
     if(opts.isQuiet):
         opts.loglevel = "NOTSET"
 
+    opts.client_profile = None
+    if(opts.apply is not None):
+        profile, _, mode = opts.apply.rpartition(':')
+        try:
+            opts.client_mode = int(mode)
+        except ValueError:
+            parser.error("--apply expects PROFILE:MODE, e.g. Krita:1")
+        opts.client_profile = profile or None
+
+    if(opts.client_mode is not None):
+        opts.client_command = "set-mode"
+
+    if(opts.listen_button is not None):
+        try:
+            opts.listen_button = parse_button(opts.listen_button)
+        except ValueError as e:
+            parser.error(str(e))
+        opts.isDaemon = True
+
+    if(opts.follow_window or opts.accelerate):
+        opts.isDaemon = True
+
+    if(opts.isDaemon and (opts.client_command is not None or opts.inventory)):
+        parser.error("--daemon/--listen/--follow-window/--accelerate cannot be combined with --toggle, --set-mode, --apply, --status, --reload or --inventory")
+
     return opts
 
 
 #----------------------------------------------------------------------
-def validate_profile_modes():
+def profile_errors(profiles, known_params=None):
     """
-    Validate the defined modes on each profile.
+    Check the modes of every profile in 'profiles' (a dict like PROFILE)
+    and return the list of all of the problems found.
+
+    known_params: If given, the parameter keys used in the cmdlists must
+                  be in this set (see 'xsetwacom --list parameters').
     """
-    for key in PROFILE.keys():
-        # The modes on each profile should not exceed MAX_MODES_PER_PROFILE.
-        if len(PROFILE[key]) > MAX_MODES_PER_PROFILE:
-            LOG.error("Maximum of {} touchring modes are supported.".format(MAX_MODES_PER_PROFILE))
-            exit(1)
+    errors = []
+    for key in profiles.keys():
+        # The number of modes is checked against the LEDs of each tablet, once they are discovered
+        # (see toggle_touchring.check_profile()).
 
         # The modes should be sequential, starting from 0.
-        for i in xrange(len(PROFILE[key])):
-            if not PROFILE[key].has_key(str(i)):
-                LOG.critical("The available modes are '0, 1, 2, 3', and they have to be sequential,\ni.e. you cannot define mode 0 and mode 2 if you do not define mode 1.\n")
-                LOG.critical("Currently defined modes for profile '{}': {}.".format(key, str(PROFILE[key].keys())))
-                LOG.critical("Please edit the 'PROFILE' dict in this python script accordingly.")
-                exit(1)
+        if set(profiles[key].keys()) != set(str(i) for i in xrange(len(profiles[key]))):
+            errors.append("Profile '{}': The modes have to be sequential starting from 0, i.e. you cannot "
+                          "define mode 0 and mode 2 if you do not define mode 1. Currently defined modes: {}."
+                          .format(key, sorted(profiles[key].keys())))
 
+        for mode_id, mode in profiles[key].items():
+            if not isinstance(mode, dict) or not isinstance(mode.get('cmdlist'), dict) or not mode.get('apply_to_dev_type'):
+                errors.append("Profile '{}', mode '{}': 'apply_to_dev_type' and a 'cmdlist' dict are required."
+                              .format(key, mode_id))
+                continue
+            if known_params is not None:
+                for param_key in mode['cmdlist'].keys():
+                    if param_key.split()[0] not in known_params:
+                        errors.append("Profile '{}', mode '{}': Unknown parameter '{}'."
+                                      .format(key, mode_id, param_key))
+            if 'acceleration' in mode:
+                errors.extend("Profile '{}', mode '{}': {}".format(key, mode_id, error)
+                              for error in acceleration_errors(mode['acceleration']))
+    return errors
 
-class toggle_touchring(object):
+#----------------------------------------------------------------------
+def validate_profile_modes(known_params=None):
     """
-    Class to change the mode of the touchring
+    Validate the defined modes on each profile.
     """
-    #----------------------------------------------------------------------
-    def __init__(self):
-        # Choose the right led path based on the kernel version
-        system_kernel_version = os.uname()[2]
-        compare_kernel_version = "3.17"
-        if system_kernel_version < compare_kernel_version:
-            status_led0_select_path = '/sys/bus/usb/devices/*/wacom_led/status_led0_select'
-        else:
-            status_led0_select_path = '/sys/class/hidraw/hidraw*/device/wacom_led/status_led0_select'
-
-        # Get the status_led0_select file
-        cmd = executeCommand('ls {}'.format(status_led0_select_path), shell=True)
-        # If the return status of the ls file == 0, the file exists.
-        if cmd.getReturnCode() == 0:
-            self.SYS_LED_FILE = cmd.getStdout(False).strip()
-            self.CURRENT_MODE = -1
-            self.CURRENT_WACOM_PROFILE = "Default"
-            self.WACOM_DEVICES = {}
-            try:
-                # Try to open the file and read its contents
-                f = open(self.SYS_LED_FILE)
-                self.CURRENT_MODE = int(f.read(1)) % 4
-                f.close()
-            except:
-                LOG.debug("Could not open the '{}' file :(".format(self.SYS_LED_FILE))
-                exit(1)
+    errors = profile_errors(PROFILE, known_params)
+    if errors:
+        for error in errors:
+            LOG.critical(error)
+        LOG.critical("Please edit the 'PROFILE' dict in this python script or the profile files accordingly.")
+        exit(1)
+
+#----------------------------------------------------------------------
+def xsetwacom_parameters():
+    """
+    Return the set of parameter names listed by 'xsetwacom --list parameters',
+    or None if xsetwacom cannot be executed.
+    """
+    try:
+        cmd = executeCommand(['xsetwacom', '--list', 'parameters'], timeout=XSETWACOM_TIMEOUT)
+    except OSError as e:
+        LOG.debug("Could not execute xsetwacom: {}".format(e))
+        return None
+    if cmd.getReturnCode() != 0:
+        return None
+    return set(line.split()[0] for line in cmd.getStdout() if line.strip())
 
-            # Read the current Wacom profile and try to match it with on of the profiles
-            # defined in the "PROFILE" dict. If a profile cannot be matched, fall back to
-            # the Default profile.
-            cmd.execute('qdbus org.kde.Wacom /Tablet org.kde.Wacom.getProfile')
-            self.CURRENT_WACOM_PROFILE = cmd.getStdout(False).strip()
-            if self.CURRENT_WACOM_PROFILE not in PROFILE.keys():
-                LOG.debug("Currently selected profile '{}' is not defined in PROFILE dict. Falling back to 'Default'".format(self.CURRENT_WACOM_PROFILE))
-                self.CURRENT_WACOM_PROFILE = "Default"
-
-            LOG.debug("Selected profile '{}' with {} modes.".format(self.CURRENT_WACOM_PROFILE, len(PROFILE[self.CURRENT_WACOM_PROFILE])))
-
-            # Add all of the devices listed by 'xsetwacom --list' in a dict.
-            # Use the "type" of the device as the dict key.
-            cmd.execute('xsetwacom --list devices')
-            r = quick_regexp()
-            for wacom_device in cmd.getStdout():
-                if(r.search("(.*)\s+id:\s+(\d+)\s+type:\s+(\w+)", wacom_device)):
-                    r.groups = strip_string_list(r.groups)
-                    wacom_dev_name = r.groups[0]
-                    wacom_dev_id = r.groups[1]
-                    wacom_dev_type = r.groups[2]
-                    # We may have more than one device a specific "dev_type", so create one dictionary
-                    # per device type and add all of the devices in the dictionary.
-                    if not self.WACOM_DEVICES.has_key(wacom_dev_type):
-                        self.WACOM_DEVICES[wacom_dev_type] = {}
-                    self.WACOM_DEVICES[wacom_dev_type][wacom_dev_id] = wacom_dev_name
-
-            #print_(self.WACOM_DEVICES)
+#----------------------------------------------------------------------
+def profiles_dir():
+    """
+    Return the directory of the profile files
+    ($XDG_CONFIG_HOME/wacom-touchring/profiles.d)
+    """
+    config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return os.path.join(config_home, 'wacom-touchring', 'profiles.d')
+
+#----------------------------------------------------------------------
+def profiles_cache_path():
+    """
+    Return the path of the compiled profiles
+    ($XDG_CACHE_HOME/toggle-wacom-touchring-mode/profiles.marshal)
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, PROGRAM_NAME, 'profiles.marshal')
+
+#----------------------------------------------------------------------
+def read_profile_file(path):
+    """
+    Read one profile file. JSON files are always supported, YAML and TOML
+    files only if PyYAML or toml are installed.
 
+    Returns a dict of profiles, or raises ValueError.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path) as f:
+        if extension == '.json':
+            profiles = _to_str(json.load(f))
+        elif extension in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is required to read YAML profiles")
+            profiles = yaml.safe_load(f)
+        elif extension == '.toml':
+            try:
+                import toml
+            except ImportError:
+                raise ValueError("toml is required to read TOML profiles")
+            profiles = toml.load(f)
         else:
-            LOG.debug("Return code of 'ls {}': {}".format(status_led0_select_path, cmd.getReturnCode()))
-            exit(cmd.getReturnCode())
+            raise ValueError("Unsupported profile file type")
 
+    if not isinstance(profiles, dict):
+        raise ValueError("A profile file must contain a dict of profiles")
+    # Mode IDs may have been written as numbers (e.g. in YAML)
+    return dict((str(name), dict((str(mode_id), mode) for mode_id, mode in modes.items()))
+                for name, modes in profiles.items())
 
-    #----------------------------------------------------------------------
-    def toggle_mode(self):
+#----------------------------------------------------------------------
+def load_profiles(directory=None, use_cache=True):
+    """
+    Add the profiles defined in the files of 'directory' (profiles_dir()
+    by default) to the PROFILE dict. A profile file overrides a profile
+    with the same name defined in this script.
+
+    The profiles are validated (also against 'xsetwacom --list parameters')
+    only when a profile file or this script changes. The validated result
+    is compiled with marshal into profiles_cache_path(), so that the next
+    runs load all of the profiles with a single read.
+    """
+    directory = directory or profiles_dir()
+    files = []
+    try:
+        files = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                       if os.path.splitext(name)[1].lower() in ('.json', '.yaml', '.yml', '.toml'))
+    except OSError:
+        pass
+
+    # Everything the compiled profiles depend on
+    key = []
+    for path in [os.path.abspath(__file__)] + files:
+        try:
+            st = os.stat(path)
+            key.append((path, st.st_mtime, st.st_size))
+        except OSError:
+            key.append((path, None, None))
+
+    cache_path = profiles_cache_path()
+    if use_cache:
+        try:
+            with open(cache_path, 'rb') as f:
+                cache = marshal.loads(f.read())
+            if cache['key'] == key:
+                LOG.debug("Loaded the compiled profiles from '{}'.".format(cache_path))
+                PROFILE.clear()
+                PROFILE.update(cache['profiles'])
+                return True
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+            pass
+
+    LOG.debug("Compiling the profiles of '{}'.".format(directory))
+    errors = []
+    for path in files:
+        try:
+            PROFILE.update(read_profile_file(path))
+        except (IOError, ValueError, AttributeError) as e:
+            errors.append("'{}': {}".format(path, e))
+
+    errors.extend(profile_errors(PROFILE, xsetwacom_parameters()))
+    if errors:
+        for error in errors:
+            LOG.critical(error)
+        LOG.critical("Please edit the 'PROFILE' dict in this python script or the profile files accordingly.")
+        exit(1)
+
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        tmp_path = '{}.{}'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(marshal.dumps({'key': key, 'profiles': PROFILE.items()}))
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError, ValueError) as e:
+        LOG.debug("Could not write the compiled profiles '{}': {}".format(cache_path, e))
+    return True
+
+
+#----------------------------------------------------------------------
+class xsetwacom_backend(object):
+    """
+    Apply Wacom parameters by running 'xsetwacom --set' for each of them.
+
+    All of the commands of one set_params() call are run as one batch by
+    executeBatch (see the 'jobs' argument), and the failures are reported
+    together once the batch has finished.
+
+    This backend understands every parameter xsetwacom does, and it is
+    used as the fallback for anything the other backends cannot set.
+    """
+    name = 'xsetwacom'
+
+    def __init__(self, jobs=4):
+        self.jobs = jobs
+        self.fallback = None
+        # set_params() may be called by several threads at once (one per tablet)
+        self._local = threading.local()
+
+    @property
+    def failed_updates(self):
         """
-        Loop through the available modes (one at a time)
+        The updates of the last set_params() call of the calling thread
+        that failed
+        """
+        return getattr(self._local, 'failed_updates', [])
+
+    @property
+    def skipped_updates(self):
+        """
+        The updates of the last set_params() call of the calling thread
+        that were not sent because the call was cancelled
+        """
+        return getattr(self._local, 'skipped_updates', [])
+
+    def set_params(self, updates, cancelled=None):
+        """
+        updates: A list of (dev_id, dev_name, param_key, param_val) tuples
+        cancelled: A function that returns True when the updates that were
+                   not sent yet should be dropped (see executeBatch)
+
+        Returns the list of updates that could not be handled (always
+        empty for this backend).
+        """
+        commands = []
+        for dev_id, dev_name, param_key, param_val in updates:
+            args = ['xsetwacom', '--set', dev_name] + shlex.split(param_key) + shlex.split(param_val)
+            LOG.debug(' '.join(pipes.quote(arg) for arg in args))
+            commands.append(args)
+
+        batch = executeBatch(commands, self.jobs, XSETWACOM_TIMEOUT, cancelled)
+        results = batch.getResults()
+        self._local.failed_updates = [update for update, cmd in zip(updates, results)
+                                      if cmd is not None and cmd.getReturnCode() != 0]
+        self._local.skipped_updates = [update for update, cmd in zip(updates, results) if cmd is None]
+        if self._local.skipped_updates:
+            LOG.debug("{} of {} xsetwacom commands were cancelled.".format(len(self._local.skipped_updates),
+                                                                          len(commands)))
+        failed = [(cmd_args, cmd) for cmd_args, cmd in batch.getFailed() if cmd is not None]
+        if failed:
+            LOG.error("{} of {} xsetwacom commands failed:".format(len(failed), len(commands)))
+            for cmd_args, cmd in failed:
+                LOG.error("    {}: {}".format(' '.join(pipes.quote(arg) for arg in cmd_args), cmd.getStderr(False).strip()))
+        return []
+
+    def close(self):
+        pass
+
+#----------------------------------------------------------------------
+class xlib_backend(object):
+    """
+    Apply Wacom parameters in-process by changing the XInput2 device
+    properties of the wacom driver over one X connection.
+
+    Only button/wheel/strip action parameters are supported (e.g.
+    'AbsWheelUp', 'StripLeftDown' or 'Button 3'); the values are encoded
+    the same way 'xsetwacom' encodes them. All the property changes of
+    one set_params() call are sent as one batch and synced once.
+
+    Requires python-xlib 0.31 or later (for the XInput2 device property
+    requests). An ImportError or an Xlib error is raised by the
+    constructor if the backend cannot be used.
+    """
+    name = 'xlib'
+
+    # Action encoding, see include/Xwacom.h of xf86-input-wacom
+    AC_KEY = 0x00010000
+    AC_MODETOGGLE = 0x00020000
+    AC_DISPLAYTOGGLE = 0x00040000
+    AC_PANSCROLL = 0x00050000
+    AC_BUTTON = 0x00080000
+    AC_KEYBTNPRESS = 0x00100000
+
+    # Parameter name -> (property holding the action atoms, offset in that property)
+    ACTION_PARAMS = {
+        'RelWheelUp': ('Wacom Wheel Buttons', 0),
+        'RelWheelDown': ('Wacom Wheel Buttons', 1),
+        'AbsWheelUp': ('Wacom Wheel Buttons', 2),
+        'AbsWheelDown': ('Wacom Wheel Buttons', 3),
+        'AbsWheel2Up': ('Wacom Wheel Buttons', 4),
+        'AbsWheel2Down': ('Wacom Wheel Buttons', 5),
+        'StripLeftUp': ('Wacom Strip Buttons', 0),
+        'StripLeftDown': ('Wacom Strip Buttons', 1),
+        'StripRightUp': ('Wacom Strip Buttons', 2),
+        'StripRightDown': ('Wacom Strip Buttons', 3),
+    }
+
+    # Key names accepted by xsetwacom ('xsetwacom --list modifiers')
+    KEY_ALIASES = {
+        'ctrl': 'Control_L', 'ctl': 'Control_L', 'control': 'Control_L',
+        'lctrl': 'Control_L', 'rctrl': 'Control_R',
+        'meta': 'Meta_L', 'lmeta': 'Meta_L', 'rmeta': 'Meta_R',
+        'alt': 'Alt_L', 'lalt': 'Alt_L', 'ralt': 'Alt_R',
+        'shift': 'Shift_L', 'lshift': 'Shift_L', 'rshift': 'Shift_R',
+        'super': 'Super_L', 'lsuper': 'Super_L', 'rsuper': 'Super_R',
+        'hyper': 'Hyper_L', 'lhyper': 'Hyper_L', 'rhyper': 'Hyper_R',
+        'esc': 'Escape', 'up': 'Up', 'down': 'Down', 'left': 'Left', 'right': 'Right',
+        'backspace': 'BackSpace', 'tab': 'Tab', 'pgup': 'Prior', 'pgdn': 'Next',
+    }
+
+    def __init__(self, display_name=None, fallback=None):
+        from Xlib import display, error, X, Xatom, XK
+        self.fallback = fallback
+        self._X = X
+        self._Xatom = Xatom
+        self._XK = XK
+        self._XError = error.XError
+        self._display = display.Display(display_name)
+        if not self._display.has_extension('XInputExtension'):
+            self._display.close()
+            raise error.DisplayConnectionError(display_name, 'XInputExtension is not available')
+        if not hasattr(self._display, 'xinput_get_device_property'):
+            self._display.close()
+            raise ImportError('python-xlib 0.31 or later is needed for the XInput2 device properties')
+        self._atoms = {}
+        self._action_atoms = {}
+        self._errors = []
+        self._display.set_error_handler(lambda err, *args: self._errors.append(err))
+        # The X connection (and the error list) is shared, so one set_params() call runs at a time.
+        self._lock = threading.Lock()
+
+    def _atom(self, name):
+        if name not in self._atoms:
+            self._atoms[name] = self._display.intern_atom(name)
+        return self._atoms[name]
+
+    def _keysym(self, name):
+        name = self.KEY_ALIASES.get(name.lower(), name)
+        if len(name) == 1:
+            # Printable latin-1 characters have the same keysym value
+            return ord(name)
+        if name.lower().startswith('f') and name[1:].isdigit():
+            name = name.upper()
+        keysym = self._XK.string_to_keysym(name)
+        if not keysym:
+            raise ValueError("Unknown key '{}'".format(name))
+        return keysym
+
+    def encode_action(self, param_val):
+        """
+        Convert an xsetwacom action string (e.g. '4', 'key +shift =' or
+        'button +1 -1') to the list of action codes stored in the
+        action property.
+
+        Raises ValueError for actions that cannot be encoded.
+        """
+        tokens = param_val.split()
+        if not tokens:
+            raise ValueError("Empty action")
+
+        if len(tokens) == 1 and tokens[0].isdigit():
+            tokens = ['button', tokens[0]]
+
+        actions = []
+        pressed = []
+        action_type = None
+        for token in tokens:
+            keyword = token.lower()
+            if keyword == 'key':
+                action_type = self.AC_KEY
+            elif keyword == 'button':
+                action_type = self.AC_BUTTON
+            elif keyword == 'modetoggle':
+                actions.append(self.AC_MODETOGGLE | self.AC_KEYBTNPRESS)
+            elif keyword == 'displaytoggle':
+                actions.append(self.AC_DISPLAYTOGGLE | self.AC_KEYBTNPRESS)
+            elif keyword == 'pan':
+                actions.append(self.AC_PANSCROLL | self.AC_KEYBTNPRESS)
+            elif action_type is None:
+                raise ValueError("Unsupported action '{}'".format(param_val))
+            else:
+                if len(token) > 1 and token[0] in '+-':
+                    press, release, name = token[0] == '+', token[0] == '-', token[1:]
+                else:
+                    press, release, name = True, True, token
+                if action_type == self.AC_BUTTON:
+                    if not name.isdigit():
+                        raise ValueError("Invalid button '{}'".format(name))
+                    code = int(name)
+                else:
+                    code = self._keysym(name)
+                if code > 0xffff:
+                    raise ValueError("Cannot encode '{}'".format(name))
+                if press:
+                    actions.append(action_type | self.AC_KEYBTNPRESS | code)
+                    pressed.append(action_type | code)
+                if release:
+                    actions.append(action_type | code)
+                    if action_type | code in pressed:
+                        pressed.remove(action_type | code)
+
+        # Release everything that is still held at the end of the action
+        actions.extend(reversed(pressed))
+        return actions
+
+    def _action_property(self, dev_id, param_key):
         """
-        cmd = executeCommand(shell=True)
-        # Each time the script is executed, find the currently used mode in the profile and change
-        # the functionality to that of the next mode.
-        # If the last mode is currently used, then loop and start from mode 0.
-        if self.CURRENT_MODE <= len(PROFILE[self.CURRENT_WACOM_PROFILE]) - 2:
-            self.CURRENT_MODE = self.CURRENT_MODE + 1
+        Return (buttons property atom, list of action atoms, index) for param_key
+        """
+        if param_key in self.ACTION_PARAMS:
+            prop_name, index = self.ACTION_PARAMS[param_key]
+        elif param_key.startswith('Button ') and param_key[7:].isdigit():
+            prop_name, index = 'Wacom Button Actions', int(param_key[7:]) - 1
         else:
-            self.CURRENT_MODE = 0
+            return None
+
+        key = (dev_id, prop_name)
+        if key not in self._action_atoms:
+            reply = self._display.xinput_get_device_property(int(dev_id), self._atom(prop_name),
+                                                             self._Xatom.ATOM, 0, 256)
+            if reply.value is None or reply.value[0] != 32:
+                self._action_atoms[key] = None
+            else:
+                self._action_atoms[key] = list(reply.value[1])
+
+        atoms = self._action_atoms[key]
+        if atoms is None or index >= len(atoms):
+            return None
+        return self._atom(prop_name), atoms, index
 
-        # Update the LED indication
-        cmd.execute('echo {} > {}'.format(self.CURRENT_MODE, self.SYS_LED_FILE))
+    def set_params(self, updates, cancelled=None):
+        """
+        updates: A list of (dev_id, dev_name, param_key, param_val) tuples
+        cancelled: Ignored, all of the updates are sent in one batch
 
-        LOG.debug("Changing to mode '{}'".format(PROFILE[self.CURRENT_WACOM_PROFILE][str(self.CURRENT_MODE)]['mode_description']))
+        Returns the list of updates that could not be handled by this
+        backend, so that they can be passed to another backend.
+        """
+        with self._lock:
+            return self._set_params(updates)
 
-        current_mode = PROFILE[self.CURRENT_WACOM_PROFILE][str(self.CURRENT_MODE)]
-        for dev_id, dev_name in self.WACOM_DEVICES[current_mode['apply_to_dev_type']].items():
-            # Update the 'param_up_key' and 'param_down_key' properties as defined in the currently used profile.
-            for param_key, param_val in current_mode['cmdlist'].items():
-                command_str = 'xsetwacom --set "{}" {} {}'.format(dev_name, param_key, param_val)
-                LOG.debug(command_str)
-                cmd.execute(command_str)
+    def _set_params(self, updates):
+        unhandled = []
+        changed_buttons = {}
+        for update in updates:
+            dev_id, dev_name, param_key, param_val = update
+            try:
+                prop = self._action_property(dev_id, param_key)
+                actions = self.encode_action(param_val) if prop else None
+            except (ValueError, AttributeError, self._XError) as e:
+                LOG.debug("xlib backend cannot set '{}' to '{}': {}".format(param_key, param_val, e))
+                prop = None
+            if prop is None:
+                unhandled.append(update)
+                continue
 
+            buttons_atom, atoms, index = prop
+            if not atoms[index]:
+                if buttons_atom != self._atom('Wacom Button Actions'):
+                    # The 'Wacom button action <N>' names belong to the buttons, leave the
+                    # empty wheel and strip slots to xsetwacom.
+                    LOG.debug("xlib backend has no action property for '{}'.".format(param_key))
+                    unhandled.append(update)
+                    continue
+                atoms[index] = self._atom('Wacom button action {}'.format(index + 1))
+                changed_buttons[(dev_id, buttons_atom)] = atoms
 
+            LOG.debug("xlib: {} '{}' {} {}".format(dev_id, dev_name, param_key, param_val))
+            self._display.xinput_change_device_property(int(dev_id), atoms[index], self._Xatom.INTEGER,
+                                                        self._X.PropModeReplace, (32, actions))
 
-if __name__ == '__main__':
+        for (dev_id, buttons_atom), atoms in changed_buttons.items():
+            self._display.xinput_change_device_property(int(dev_id), buttons_atom, self._Xatom.ATOM,
+                                                        self._X.PropModeReplace, (32, atoms))
+
+        # One round-trip for the whole batch
+        self._errors = []
+        with TRACE.span('xlib_sync', params=len(updates) - len(unhandled)):
+            self._display.sync()
+        if self._errors:
+            LOG.debug("xlib backend got {} X errors, retrying with xsetwacom.".format(len(self._errors)))
+            self._action_atoms = {}
+            return updates
+
+        return unhandled
+
+    def close(self):
+        self._display.close()
+
+PARAM_BACKENDS = OrderedDict([('xlib', xlib_backend), ('xsetwacom', xsetwacom_backend)])
+
+#----------------------------------------------------------------------
+def get_param_backend(name='auto', jobs=4):
     """
-    Write the main program here
+    Return an instance of the parameter backend 'name'. With 'auto', the
+    first backend of PARAM_BACKENDS that can be initialized is used.
+
+    jobs: Number of concurrent xsetwacom processes (0 runs them all
+          in one 'sh -c' script) for the xsetwacom backend, which is
+          also the fallback of the other backends.
     """
-    # Parse the command line options
-    options = _command_Line_Options()
-    # Configure logging
-    _configureLogging(options.loglevel)
+    fallback = xsetwacom_backend(jobs)
+    candidates = PARAM_BACKENDS.keys() if name == 'auto' else [name]
+    for candidate in candidates:
+        if candidate == 'xsetwacom':
+            LOG.debug("Using the 'xsetwacom' parameter backend.")
+            return fallback
+        try:
+            backend = PARAM_BACKENDS[candidate](fallback=fallback)
+            LOG.debug("Using the '{}' parameter backend.".format(candidate))
+            return backend
+        except Exception as e:
+            LOG.debug("The '{}' parameter backend is not available: {}".format(candidate, e))
+
+    LOG.warning("Parameter backend '{}' is not available, falling back to 'xsetwacom'.".format(name))
+    return fallback
+
+
+# The checked runtime directories, see runtime_dir()
+RUNTIME_DIRS = {}
+
+#----------------------------------------------------------------------
+def runtime_dir():
+    """
+    Return the runtime directory of this script
+    ($XDG_RUNTIME_DIR/toggle-wacom-touchring-mode, or
+    /tmp/toggle-wacom-touchring-mode-<uid>), creating it if it does not
+    exist.
+
+    Return None if the directory cannot be created, or if it is not a
+    real directory owned by the current user with mode 0700: in /tmp it
+    could have been created by another user, to feed the cache with other
+    files or to read what is written there.
+    """
+    xdg_runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if xdg_runtime_dir:
+        path = os.path.join(xdg_runtime_dir, PROGRAM_NAME)
+    else:
+        path = os.path.join('/tmp', '{}-{}'.format(PROGRAM_NAME, os.getuid()))
+    if path not in RUNTIME_DIRS:
+        RUNTIME_DIRS[path] = _check_runtime_dir(path)
+    return RUNTIME_DIRS[path]
+
+#----------------------------------------------------------------------
+def _check_runtime_dir(path):
+    """
+    Create the runtime directory 'path' if it does not exist and return it,
+    or None if it is not safe to use (see runtime_dir())
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            LOG.debug("Could not create the runtime directory '{}': {}".format(path, e))
+            return None
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        LOG.warning("'{}' is not a directory with mode 0700 owned by the current user, not using it.".format(path))
+        return None
+    return path
+
+#----------------------------------------------------------------------
+def runtime_path(name):
+    """
+    Return the path of 'name' in the runtime directory of this script, or
+    None if there is no safe runtime directory (see runtime_dir())
+    """
+    path = runtime_dir()
+    return os.path.join(path, name) if path else None
+
+# Increase when the format of the discovery results changes
+DISCOVERY_CACHE_VERSION = 4
+# Increase when the format of the applied parameters state changes
+APPLIED_PARAMS_VERSION = 2
+
+#----------------------------------------------------------------------
+def runtime_state_path(name):
+    """
+    Return the path of the runtime state file 'name' for the current X
+    display, or None if there is no safe runtime directory
+    """
+    display = os.environ.get('DISPLAY', '').replace('/', '_')
+    return runtime_path('{}{}.json'.format(name, display))
 
-    # Validate the user defined profiles
-    validate_profile_modes()
+#----------------------------------------------------------------------
+def discovery_cache_path():
+    """
+    Return the path of the discovery cache file for the current X display
+    """
+    return runtime_state_path('discovery')
+
+#----------------------------------------------------------------------
+def led_select_pattern(ring='0'):
+    """
+    Return the glob pattern of the status_led<ring>_select files, which
+    are found through usb (before Linux 3.17) or through hidraw
+    """
+    if kernel_version() < (3, 17, 0):
+        return os.path.join(SYSFS_ROOT, 'bus/usb/devices/*/wacom_led/status_led{}_select'.format(ring))
+    return os.path.join(SYSFS_ROOT, 'class/hidraw/hidraw*/device/wacom_led/status_led{}_select'.format(ring))
+
+#----------------------------------------------------------------------
+def discovery_fingerprint():
+    """
+    Return a cheap fingerprint of the connected tablets and the X server.
 
-    # Create a toggle_touchring() object and call the toggle_mode() method.
-    wacom = toggle_touchring()
-    wacom.toggle_mode()
+    It holds the LED files that discover() looks for, resolved to their
+    sysfs devices, so it changes when a tablet is plugged or unplugged
+    (its HID device gets a new id even if the hidraw number is reused)
+    but not when other input devices come and go, like the uinput device
+    of --accelerate. It also changes when the X server is restarted (the
+    mtime of its socket changes). It does not fork.
+    """
+    fingerprint = {'display': os.environ.get('DISPLAY', ''),
+                   'led_files': sorted(os.path.realpath(led_file) for led_file in glob.glob(led_select_pattern('*')))}
+    r = quick_regexp()
+    fingerprint['x_socket'] = None
+    if r.search(r'^:(\d+)', fingerprint['display']):
+        try:
+            fingerprint['x_socket'] = os.stat('/tmp/.X11-unix/X{}'.format(r.groups[0])).st_mtime
+        except OSError:
+            pass
+    return fingerprint
 
+#----------------------------------------------------------------------
+def _to_str(obj):
+    """
+    Convert the unicode strings returned by json.load() back to str
+    """
+    if isinstance(obj, dict):
+        return dict((_to_str(key), _to_str(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [_to_str(value) for value in obj]
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
 
+#----------------------------------------------------------------------
+def load_runtime_state(name, fingerprint, version):
+    """
+    Return the data of the runtime state file 'name', or None if there is
+    no such file or if it was written for a different version or
+    fingerprint.
+    """
+    path = runtime_state_path(name)
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            state = _to_str(json.load(f))
+    except (IOError, OSError, ValueError):
+        return None
+
+    if state.get('version') != version:
+        return None
+    if state.get('fingerprint') != _to_str(json.loads(json.dumps(fingerprint))):
+        return None
+    return state.get('data')
+
+#----------------------------------------------------------------------
+def save_runtime_state(name, fingerprint, version, data):
+    """
+    Atomically write data to the runtime state file 'name'
+    """
+    path = runtime_state_path(name)
+    if not path:
+        return
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': version, 'fingerprint': fingerprint, 'data': data}, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        LOG.debug("Could not write '{}': {}".format(path, e))
+
+#----------------------------------------------------------------------
+def valid_led_file(led_file):
+    """
+    Return True if led_file exists, resolves to a path under SYSFS_ROOT and
+    is a wacom_led/status_led<N>_select file. The LED files are opened for
+    writing, so the cached paths are not trusted blindly.
+    """
+    real_path = os.path.realpath(led_file)
+    if not real_path.startswith(os.path.join(os.path.realpath(SYSFS_ROOT), '')):
+        return False
+    if not re.search(r'/wacom_led/status_led\d+_select$', real_path):
+        return False
+    return os.path.exists(real_path)
+
+#----------------------------------------------------------------------
+def load_discovery_cache(fingerprint):
+    """
+    Return the cached discovery results, or None if there is no cache or
+    if it was written for a different fingerprint.
+    """
+    discovery = load_runtime_state('discovery', fingerprint, DISCOVERY_CACHE_VERSION)
+    if not discovery:
+        return None
+    led_files = [led_file for tablet in discovery.get('tablets', [])
+                 for ring in tablet['rings'] for led_file in ring['led_files']]
+    if not led_files or not all(valid_led_file(led_file) for led_file in led_files):
+        return None
+    return discovery
+
+#----------------------------------------------------------------------
+def save_discovery_cache(fingerprint, discovery):
+    """
+    Atomically write the discovery results to the cache file
+    """
+    save_runtime_state('discovery', fingerprint, DISCOVERY_CACHE_VERSION, discovery)
+
+
+class touchring_tablet(object):
+    """
+    The touchrings, the X devices and the current modes of one physical
+    tablet (see toggle_touchring.discover()).
+
+    Every touchring has its own mode LEDs and mode. 'state_lock' is held
+    while the mode is changed and the LED is lit, and 'lock' while the
+    parameters of the new mode are applied. Each mode change increments
+    the generation of its touchring, so that a change whose parameters
+    are still being applied can see that it has been superseded.
+    """
+    #----------------------------------------------------------------------
+    def __init__(self, discovered):
+        # The sysfs path of the tablet, e.g. '/sys/devices/pci0000:00/0000:00:14.0/usb1/1-2'
+        self.id = discovered['id']
+        self.name = os.path.basename(self.id)
+        # One {'led_files': [...], 'leds': number of LEDs} dict per touchring
+        self.rings = discovered['rings']
+        # The X devices of the tablet, {dev_type: {dev_id: dev_name}}
+        self.devices = discovered['devices']
+        self.pad_event_nodes = discovered['pad_event_nodes']
+        # The touchrings whose rotation is read by a ring_processor() of the daemon
+        self.processed_rings = set()
+        self.modes = [-1] * len(self.rings)
+        self.generations = [0] * len(self.rings)
+        self.state_lock = threading.Lock()
+        self.lock = threading.Lock()
+        # One list of file descriptors per touchring
+        self._led_fds = []
+        # The descriptors of the LED files that the user cannot write to
+        self._read_only_fds = set()
+
+    #----------------------------------------------------------------------
+    @property
+    def led_files(self):
+        return [led_file for ring in self.rings for led_file in ring['led_files']]
+
+    #----------------------------------------------------------------------
+    def open_leds(self):
+        """
+        Open the LED files and read the current mode of every touchring
+        from its first LED file
+        """
+        for ring, ring_info in enumerate(self.rings):
+            fds = []
+            for led_file in ring_info['led_files']:
+                writable = os.access(led_file, os.W_OK)
+                if not writable:
+                    LOG.warning("No write access to '{}', the LED will not show the mode. Install the udev rules "
+                                "of input-wacom-dkms.sh (or run 'chmod 0666' on the file as root).".format(led_file))
+                try:
+                    fd = os.open(led_file, os.O_RDWR if writable else os.O_RDONLY)
+                except OSError as e:
+                    LOG.debug("Could not open the '{}' file: {}".format(led_file, e))
+                    exit(1)
+                fds.append(fd)
+                if not writable:
+                    self._read_only_fds.add(fd)
+            self._led_fds.append(fds)
+
+            try:
+                self.modes[ring] = int(os.read(fds[0], 1)) % ring_info['leds']
+            except (OSError, ValueError):
+                LOG.debug("Could not read the '{}' file :(".format(ring_info['led_files'][0]))
+                exit(1)
+
+    #----------------------------------------------------------------------
+    def write_led(self, ring, mode):
+        """
+        Light the LED of the given mode of a touchring
+        """
+        for led_file, fd in zip(self.rings[ring]['led_files'], self._led_fds[ring]):
+            if fd in self._read_only_fds:
+                # Reported by open_leds()
+                continue
+            try:
+                with TRACE.span('led_write', path=led_file):
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, str(mode))
+            except OSError as e:
+                LOG.error("Could not write to '{}': {}".format(led_file, e))
+
+    #----------------------------------------------------------------------
+    def close(self):
+        """
+        Close the LED files
+        """
+        for fds in self._led_fds:
+            for fd in fds:
+                os.close(fd)
+        self._led_fds = []
+        self._read_only_fds = set()
+
+    #----------------------------------------------------------------------
+    def mode_count(self, profile, ring):
+        """
+        Return the number of modes of profile that a touchring cycles
+        through: one per LED at most
+        """
+        return min(len(PROFILE[profile]), self.rings[ring]['leds'])
+
+    #----------------------------------------------------------------------
+    def status(self, profile):
+        """
+        Return a dict describing the tablet and the modes of its
+        touchrings in profile. 'mode' is the mode of the first touchring.
+        """
+        rings = [{'ring': ring,
+                  'leds': ring_info['leds'],
+                  'mode': self.modes[ring],
+                  'mode_description': PROFILE[profile].get(str(self.modes[ring]), {}).get('mode_description')}
+                 for ring, ring_info in enumerate(self.rings)]
+        return {'id': self.id,
+                'name': self.name,
+                'mode': rings[0]['mode'],
+                'mode_description': rings[0]['mode_description'],
+                'led_files': self.led_files,
+                'rings': rings}
+
+
+class toggle_touchring(object):
+    """
+    Class to change the mode of the touchring
+
+    Every touchring of every connected tablet has its own mode (see
+    touchring_tablet). The mode switching methods take a 'tablet' argument
+    (see select_tablets()) and a 'ring' argument, and switch the selected
+    tablets concurrently, one thread per tablet.
+    """
+    #----------------------------------------------------------------------
+    def __init__(self, backend=None, use_cache=True):
+        # The backend used to apply the parameters of each mode
+        self.backend = backend if backend is not None else xsetwacom_backend()
+
+        self.TABLETS = []
+        self.SYS_LED_FILES = []
+        self.PAD_EVENT_NODES = []
+        # The parameter values that were applied last, {dev_id: {param_key: param_val}}
+        self.APPLIED_PARAMS = {}
+        # What 'xsetwacom --get' returns after a value was set, per backend and device type
+        # (see readback_values()), {'<backend>:<dev_type>': {param_key: {param_val: output}}}
+        self.READBACK_VALUES = {}
+        # The mode of the first touchring of the first tablet
+        self.CURRENT_MODE = -1
+        self.CURRENT_WACOM_PROFILE = "Default"
+        self.WACOM_DEVICES = {}
+        # Protects APPLIED_PARAMS and READBACK_VALUES, which are updated by one thread per tablet
+        self._state_lock = threading.Lock()
+
+        # The profile lookup does not depend on the devices, run it while they are discovered.
+        profile_task = backgroundTask(self.resolve_profile)
+
+        # Use the results of a previous discovery if the devices did not change since then.
+        with TRACE.span('discovery_cache'):
+            self._fingerprint = discovery_fingerprint()
+            discovery = load_discovery_cache(self._fingerprint) if use_cache else None
+        if discovery is not None:
+            LOG.debug("Discovery cache hit ('{}').".format(discovery_cache_path()))
+        else:
+            LOG.debug("Discovery cache miss, discovering the LED files and the Wacom devices.")
+            with TRACE.span('discovery'):
+                discovery = self.discover()
+            save_discovery_cache(self._fingerprint, discovery)
+
+        self.TABLETS = [touchring_tablet(tablet) for tablet in discovery['tablets']]
+        for tablet in self.TABLETS:
+            self.SYS_LED_FILES.extend(tablet.led_files)
+            self.PAD_EVENT_NODES.extend(tablet.pad_event_nodes)
+            for dev_type, devices in tablet.devices.items():
+                self.WACOM_DEVICES.setdefault(dev_type, {}).update(devices)
+
+        # The parameters applied by previous runs, as long as the devices and X did not change
+        state = load_runtime_state('applied-params', self._fingerprint, APPLIED_PARAMS_VERSION) or {}
+        self.APPLIED_PARAMS = state.get('applied', {})
+        self.READBACK_VALUES = state.get('readback', {})
+
+        # Keep the LED files open, so that a mode switch costs a single write() per LED.
+        with TRACE.span('led_open'):
+            for tablet in self.TABLETS:
+                tablet.open_leds()
+        self.CURRENT_MODE = self.TABLETS[0].modes[0]
+
+        self.CURRENT_WACOM_PROFILE = profile_task.getResult()
+        LOG.debug("Selected profile '{}' with {} modes.".format(self.CURRENT_WACOM_PROFILE, len(PROFILE[self.CURRENT_WACOM_PROFILE])))
+        self.check_profile(self.CURRENT_WACOM_PROFILE)
+
+    #----------------------------------------------------------------------
+    def resolve_profile(self):
+        """
+        Read the current Wacom profile and try to match it with on of the profiles
+        defined in the "PROFILE" dict. If a profile cannot be matched (or the KDE
+        Wacom service does not answer in QDBUS_TIMEOUT seconds), fall back to the
+        Default profile.
+        """
+        with TRACE.span('profile_resolution'):
+            profile = kde_wacom_profile()
+        if profile not in PROFILE.keys():
+            LOG.debug("Currently selected profile '{}' is not defined in PROFILE dict. Falling back to 'Default'".format(profile))
+            profile = "Default"
+        return profile
+
+    #----------------------------------------------------------------------
+    def check_profile(self, profile):
+        """
+        Warn about the touchrings that have less LEDs than the modes of
+        profile; they skip the modes they have no LED for.
+        """
+        for tablet in self.TABLETS:
+            for ring, ring_info in enumerate(tablet.rings):
+                if len(PROFILE[profile]) > ring_info['leds']:
+                    LOG.warning("Profile '{}' has {} modes, but touchring {} of tablet '{}' has {} LEDs. "
+                                "Modes {} and up are skipped.".format(profile, len(PROFILE[profile]), ring,
+                                                                      tablet.name, ring_info['leds'],
+                                                                      ring_info['leds']))
+
+    #----------------------------------------------------------------------
+    def discover(self):
+        """
+        Find the LED files and the Wacom devices known to X, and group them
+        per physical tablet.
+
+        Returns a dict with the list of 'tablets'. Each tablet is a dict
+        with its 'id' (see physical_device()), its 'rings', its X
+        'devices' (the devices listed by 'xsetwacom --list devices',
+        grouped by their type) and its 'pad_event_nodes'. Each ring is a
+        dict with the 'led_files' (status_led<ring>_select) and the
+        number of 'leds' of one touchring (see touchring_leds()).
+
+        The X devices are matched to the tablets through their 'Device
+        Node' property. Devices without one are added to every tablet, and
+        tablets without any X device (those of the other seats, which are
+        driven by another X server) are left out.
+        """
+        # List the X devices while the LED files are searched for
+        devices_task = backgroundTask(executeCommand, ['xsetwacom', '--list', 'devices'], timeout=XSETWACOM_TIMEOUT)
+
+        # Choose the right led path based on the kernel version
+        status_led0_select_path = led_select_pattern()
+
+        # Get the status_led0_select file of every tablet
+        led_files = sorted(glob.glob(status_led0_select_path))
+        if not led_files:
+            LOG.debug("No file matches '{}'".format(status_led0_select_path))
+            exit(1)
+
+        # Add all of the devices listed by 'xsetwacom --list' in a dict.
+        # Use the "type" of the device as the dict key.
+        devices = {}
+        cmd = devices_task.getResult()
+        r = quick_regexp()
+        for wacom_device in cmd.getStdout():
+            if(r.search("(.*)\s+id:\s+(\d+)\s+type:\s+(\w+)", wacom_device)):
+                r.groups = strip_string_list(r.groups)
+                wacom_dev_name = r.groups[0]
+                wacom_dev_id = r.groups[1]
+                wacom_dev_type = r.groups[2]
+                # We may have more than one device a specific "dev_type", so create one dictionary
+                # per device type and add all of the devices in the dictionary.
+                if not devices.has_key(wacom_dev_type):
+                    devices[wacom_dev_type] = {}
+                devices[wacom_dev_type][wacom_dev_id] = wacom_dev_name
+
+        #print_(devices)
+
+        # One tablet per physical device, with one status_led<ring>_select file per touchring.
+        tablets = OrderedDict()
+        for led_file in led_files:
+            wacom_led_dir = os.path.dirname(led_file)
+            tablet_id = physical_device(os.path.dirname(wacom_led_dir))
+            if tablet_id not in tablets:
+                tablets[tablet_id] = {'id': tablet_id, 'rings': [], 'devices': {}, 'pad_event_nodes': []}
+            rings = tablets[tablet_id]['rings']
+            ring = 0
+            ring_led_file = led_file
+            while os.path.exists(ring_led_file):
+                if ring == len(rings):
+                    rings.append({'led_files': [], 'leds': touchring_leds(os.path.dirname(wacom_led_dir), ring)})
+                rings[ring]['led_files'].append(ring_led_file)
+                ring += 1
+                ring_led_file = os.path.join(wacom_led_dir, 'status_led{}_select'.format(ring))
+            tablets[tablet_id]['pad_event_nodes'].extend(find_pad_event_nodes([led_file]))
+
+        nodes = x_device_nodes([dev_id for type_devices in devices.values() for dev_id in type_devices])
+        for dev_type, type_devices in devices.items():
+            for dev_id, dev_name in type_devices.items():
+                if dev_id not in nodes:
+                    # Cannot tell which tablet this device belongs to
+                    targets = tablets.keys()
+                else:
+                    tablet_id = physical_device(os.path.join(SYSFS_ROOT, 'class/input', os.path.basename(nodes[dev_id])))
+                    targets = [tablet_id] if tablet_id in tablets else []
+                    if not targets:
+                        LOG.debug("Device {} '{}' does not belong to a tablet with LEDs.".format(dev_id, dev_name))
+                for tablet_id in targets:
+                    tablets[tablet_id]['devices'].setdefault(dev_type, {})[dev_id] = dev_name
+
+        if nodes:
+            for tablet_id in [tablet_id for tablet_id, tablet in tablets.items() if not tablet['devices']]:
+                LOG.debug("Tablet '{}' has no X devices on this display, ignoring it.".format(tablet_id))
+                del tablets[tablet_id]
+            if not tablets:
+                LOG.debug("None of the tablets has X devices on this display.")
+                exit(1)
+
+        return {'tablets': tablets.values()}
+
+    #----------------------------------------------------------------------
+    def is_stale(self):
+        """
+        Return True if devices were plugged or unplugged (or X was restarted)
+        since this object discovered them.
+        """
+        return discovery_fingerprint() != self._fingerprint
+
+    #----------------------------------------------------------------------
+    def select_tablets(self, tablet=None):
+        """
+        Return the list of the tablets that 'tablet' refers to: all of
+        them if it is None or 'all', otherwise the tablet with that index
+        (in the order of the status() list), name or id.
+        """
+        if tablet is None or tablet == 'all':
+            return list(self.TABLETS)
+        tablet = str(tablet)
+        if tablet.isdigit():
+            return self.TABLETS[int(tablet):int(tablet) + 1]
+        return [t for t in self.TABLETS if tablet in (t.name, t.id)]
+
+    #----------------------------------------------------------------------
+    def _for_each_tablet(self, tablet, func):
+        """
+        Call func(tablet) for each of the selected tablets, concurrently if
+        there are more than one. Returns True if all of the calls did.
+
+        An exception raised for one tablet does not stop the others. It is
+        logged with its traceback and the name of its tablet, and counts as
+        a failed call.
+        """
+        tablets = self.select_tablets(tablet)
+        if not tablets:
+            LOG.error("There is no tablet '{}'.".format(tablet))
+            return False
+        if len(tablets) == 1:
+            return func(tablets[0])
+
+        results = {}
+        errors = []
+
+        def worker(t):
+            try:
+                results[t.id] = func(t)
+            except Exception:
+                errors.append((t, sys.exc_info()))
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in tablets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for t, exc_info in errors:
+            LOG.error("Switching tablet '{}' failed:".format(t.name), exc_info=exc_info)
+        return all(results.get(t.id) for t in tablets)
+
+    #----------------------------------------------------------------------
+    def close(self):
+        """
+        Close the LED files
+        """
+        for tablet in self.TABLETS:
+            tablet.close()
+
+    #----------------------------------------------------------------------
+    def mode_error(self, mode=None, tablet=None, ring=0, profile=None):
+        """
+        Return why set_mode() (or toggle_mode() if mode is None) rejects
+        these arguments for at least one of the selected tablets, or None
+        if it does not. Errors of the parameter backends are not known here.
+        """
+        if profile is None:
+            profile = self.CURRENT_WACOM_PROFILE
+        if profile not in PROFILE:
+            return "Profile '{}' is not defined in PROFILE dict.".format(profile)
+        if mode is not None and not PROFILE[profile].has_key(str(mode)):
+            return "Profile '{}' does not define mode '{}'.".format(profile, mode)
+        tablets = self.select_tablets(tablet)
+        if not tablets:
+            return "There is no tablet '{}'.".format(tablet)
+        for t in tablets:
+            if ring >= len(t.rings):
+                return "Tablet '{}' does not have touchring {}.".format(t.name, ring)
+            if mode is not None and mode >= t.mode_count(profile, ring):
+                return "Touchring {} of tablet '{}' has {} LEDs, it cannot switch to mode '{}'.".format(
+                    ring, t.name, t.rings[ring]['leds'], mode)
+        return None
+
+    #----------------------------------------------------------------------
+    def toggle_mode(self, verify=False, tablet=None, ring=0):
+        """
+        Loop through the available modes (one at a time)
+
+        verify: See set_mode()
+        tablet: See select_tablets(). Each tablet switches to the mode
+                after its own current mode.
+        ring: The touchring to switch, 0 for the first one
+        """
+        profile = self.CURRENT_WACOM_PROFILE
+        return self._for_each_tablet(tablet, lambda t: self._set_tablet_mode(t, profile, ring, None, True, verify))
+
+    #----------------------------------------------------------------------
+    def set_mode(self, mode, only_changes=True, verify=False, tablet=None, ring=0, profile=None):
+        """
+        Switch to the given mode of the currently selected profile, or of
+        profile (which is selected first) if it is given.
+
+        only_changes: If True, only send the parameters whose value differs
+                      from the value that was applied last.
+        verify: If True, read the current values back from the devices first
+                (with one batched 'xsetwacom --get' call), so that values
+                changed by other programs are sent again.
+        tablet: See select_tablets()
+        ring: The touchring to switch, 0 for the first one
+
+        Returns False (and keeps the current profile) if the profile is not
+        defined or does not define the requested mode, or if a selected
+        touchring has no LED for it (see mode_error()).
+        """
+        if profile is None:
+            profile = self.CURRENT_WACOM_PROFILE
+        # Check the mode against the new profile before selecting it, a rejected request keeps the current one.
+        error = self.mode_error(mode, tablet, ring, profile)
+        if error:
+            LOG.error(error)
+            return False
+        if profile != self.CURRENT_WACOM_PROFILE:
+            LOG.debug("Selected profile '{}' with {} modes.".format(profile, len(PROFILE[profile])))
+            self.CURRENT_WACOM_PROFILE = profile
+            self.check_profile(profile)
+
+        return self._for_each_tablet(tablet, lambda t: self._set_tablet_mode(t, profile, ring, mode, only_changes, verify))
+
+    #----------------------------------------------------------------------
+    def _set_tablet_mode(self, tablet, profile, ring, mode, only_changes, verify):
+        """
+        Switch a touchring of one tablet to mode (or to the mode after its
+        current one if mode is None) of profile. See set_mode().
+        """
+        if ring >= len(tablet.rings):
+            LOG.error("Tablet '{}' does not have touchring {}.".format(tablet.name, ring))
+            return False
+
+        with tablet.state_lock:
+            mode_count = tablet.mode_count(profile, ring)
+            if mode is None:
+                # Each time the script is executed, find the currently used mode in the profile and change
+                # the functionality to that of the next mode.
+                # If the last mode is currently used, then loop and start from mode 0.
+                if tablet.modes[ring] <= mode_count - 2:
+                    mode = tablet.modes[ring] + 1
+                else:
+                    mode = 0
+            elif mode >= mode_count:
+                LOG.error("Touchring {} of tablet '{}' has {} LEDs, it cannot switch to mode '{}'."
+                          .format(ring, tablet.name, tablet.rings[ring]['leds'], mode))
+                return False
+            tablet.modes[ring] = mode
+            tablet.generations[ring] += 1
+            generation = tablet.generations[ring]
+            self.CURRENT_MODE = self.TABLETS[0].modes[0]
+
+            # Update the LED indication right away, the parameters follow.
+            tablet.write_led(ring, mode)
+
+        # A newer mode change of the same touchring (e.g. a double press of the toggle button) supersedes
+        # this one: if it arrives before the parameters of this one are applied, they are not applied at
+        # all, and if it arrives while they are applied, the parameters that were not sent yet are dropped.
+        # The newer change then only sends what differs from what was really applied.
+        cancelled = lambda: tablet.generations[ring] != generation
+        with tablet.lock:
+            if cancelled():
+                LOG.debug("Touchring {} of tablet '{}' was switched again, skipping mode '{}'.".format(ring, tablet.name, mode))
+                return True
+
+            current_mode = PROFILE[profile][str(mode)]
+            LOG.debug("Changing touchring {} of tablet '{}' to mode '{}'".format(ring, tablet.name, current_mode['mode_description']))
+
+            cmdlist = current_mode['cmdlist']
+            if ring in tablet.processed_rings and current_mode.get('acceleration'):
+                # The daemon sends the actions of the rotation itself (see ring_processor).
+                cmdlist = dict(cmdlist, AbsWheelUp='0', AbsWheelDown='0')
+
+            updates = []
+            for dev_id, dev_name in tablet.devices.get(current_mode['apply_to_dev_type'], {}).items():
+                # Update the 'param_up_key' and 'param_down_key' properties as defined in the currently used profile.
+                for param_key, param_val in ring_cmdlist(cmdlist, ring).items():
+                    updates.append((dev_id, dev_name, param_key, param_val))
+
+            if verify:
+                with TRACE.span('verify', tablet=tablet.name):
+                    self.verify_params(updates)
+            if only_changes:
+                with self._state_lock:
+                    updates = [(dev_id, dev_name, param_key, param_val)
+                               for dev_id, dev_name, param_key, param_val in updates
+                               if self.APPLIED_PARAMS.get(dev_id, {}).get(param_key) != param_val]
+                LOG.debug("{} parameters of tablet '{}' changed since the last switch.".format(len(updates), tablet.name))
+
+            self.apply_params(updates, cancelled)
+            if verify and not cancelled():
+                # Remember what the devices report for the new values, to compare with it next time.
+                readback = self.read_params(updates)
+                with self._state_lock:
+                    for dev_id, dev_name, param_key, param_val in updates:
+                        if readback.get((dev_id, param_key)) is not None:
+                            self.readback_values(dev_id).setdefault(param_key, {})[param_val] = readback[(dev_id, param_key)]
+        self.save_applied_params()
+
+        return True
+
+    #----------------------------------------------------------------------
+    def read_params(self, updates):
+        """
+        Read the current value of the parameters of the given updates with
+        one 'sh' process that runs all of the 'xsetwacom --get' commands.
+
+        Returns a {(dev_id, param_key): output} dict. The output is None for
+        parameters that could not be read.
+        """
+        keys = []
+        commands = []
+        for dev_id, dev_name, param_key, param_val in updates:
+            keys.append((dev_id, param_key))
+            commands.append(['xsetwacom', '--get', dev_name] + shlex.split(param_key))
+
+        values = {}
+        for key, cmd in zip(keys, executeBatch(commands, 0, XSETWACOM_TIMEOUT).getResults()):
+            values[key] = cmd.getStdout(False).strip() if cmd.getReturnCode() == 0 else None
+        return values
+
+    #----------------------------------------------------------------------
+    def readback_values(self, dev_id):
+        """
+        Return the READBACK_VALUES that apply to device dev_id,
+        {param_key: {param_val: output}}. The caller holds _state_lock.
+
+        What 'xsetwacom --get' returns for a value can differ between the
+        device types of a tablet, and between the backends that set it (the
+        xlib backend writes the device properties directly), so the values
+        are kept per backend and device type. Which backend (or its
+        xsetwacom fallback) sets a parameter does not change from one run
+        to the next, so the configured backend is enough to tell them
+        apart.
+        """
+        dev_type = next((dev_type for dev_type, devices in self.WACOM_DEVICES.items() if dev_id in devices), None)
+        return self.READBACK_VALUES.setdefault('{}:{}'.format(self.backend.name, dev_type), {})
+
+    #----------------------------------------------------------------------
+    def verify_params(self, updates):
+        """
+        Forget the applied value of every parameter of the given updates
+        that changed on the device since it was applied, so that it is sent
+        again. A parameter is considered unchanged if 'xsetwacom --get'
+        returns what it returned right after its applied value was set.
+        """
+        readback = self.read_params(updates)
+        with self._state_lock:
+            for (dev_id, param_key), output in readback.items():
+                applied = self.APPLIED_PARAMS.get(dev_id, {}).get(param_key)
+                expected = self.readback_values(dev_id).get(param_key, {}).get(applied)
+                if output is None or expected is None or output != expected:
+                    LOG.debug("Parameter '{}' of device {} is out of sync ({!r}).".format(param_key, dev_id, output))
+                    self.APPLIED_PARAMS.get(dev_id, {}).pop(param_key, None)
+
+    #----------------------------------------------------------------------
+    def save_applied_params(self):
+        """
+        Store the applied parameters in the runtime directory, so that the
+        next run only sends what changed
+        """
+        with self._state_lock:
+            save_runtime_state('applied-params', self._fingerprint, APPLIED_PARAMS_VERSION,
+                               {'applied': self.APPLIED_PARAMS, 'readback': self.READBACK_VALUES})
+
+    #----------------------------------------------------------------------
+    def set_profile(self, profile, tablet=None):
+        """
+        Select another profile and apply its mode 0 to every touchring,
+        sending only the parameters that differ from the ones currently
+        applied.
+
+        Returns False if the profile is not defined in the PROFILE dict.
+        """
+        if profile not in PROFILE:
+            LOG.error("Profile '{}' is not defined in PROFILE dict.".format(profile))
+            return False
+
+        LOG.debug("Selected profile '{}' with {} modes.".format(profile, len(PROFILE[profile])))
+        self.CURRENT_WACOM_PROFILE = profile
+        self.check_profile(profile)
+
+        # Mode 0 of every touchring
+        return self._for_each_tablet(tablet, lambda t: all([self._set_tablet_mode(t, profile, ring, 0, True, False)
+                                                            for ring in xrange(len(t.rings))]))
+
+    #----------------------------------------------------------------------
+    def apply_params(self, updates, cancelled=None):
+        """
+        Apply a list of (dev_id, dev_name, param_key, param_val) updates with
+        the selected backend. Whatever the backend cannot handle is passed
+        to its fallback backend (xsetwacom).
+
+        cancelled: A function that returns True when the updates that were
+                   not sent yet should be dropped
+        """
+        failed = []
+        skipped = []
+        with TRACE.span('apply', backend=self.backend.name, params=len(updates)):
+            remaining = self.backend.set_params(updates, cancelled)
+        if remaining and self.backend.fallback is not None:
+            with TRACE.span('apply', backend=self.backend.fallback.name, params=len(remaining)):
+                self.backend.fallback.set_params(remaining, cancelled)
+            failed = self.backend.fallback.failed_updates
+            skipped = self.backend.fallback.skipped_updates
+        elif remaining:
+            failed = remaining
+        else:
+            failed = getattr(self.backend, 'failed_updates', [])
+            skipped = getattr(self.backend, 'skipped_updates', [])
+
+        with self._state_lock:
+            for dev_id, dev_name, param_key, param_val in updates:
+                if (dev_id, dev_name, param_key, param_val) in skipped:
+                    # Not sent, the device still has the value applied before
+                    continue
+                if (dev_id, dev_name, param_key, param_val) in failed:
+                    self.APPLIED_PARAMS.get(dev_id, {}).pop(param_key, None)
+                else:
+                    self.APPLIED_PARAMS.setdefault(dev_id, {})[param_key] = param_val
+
+    #----------------------------------------------------------------------
+    def status(self):
+        """
+        Return a dict describing the currently selected profile and the
+        modes of every tablet. 'mode' and 'mode_description' are those of
+        the first touchring of the first tablet.
+        """
+        return {'profile': self.CURRENT_WACOM_PROFILE,
+                'mode': self.CURRENT_MODE,
+                'mode_description': PROFILE[self.CURRENT_WACOM_PROFILE].get(str(self.CURRENT_MODE), {}).get('mode_description'),
+                'modes': len(PROFILE[self.CURRENT_WACOM_PROFILE]),
+                'led_files': self.SYS_LED_FILES,
+                'tablets': [tablet.status(self.CURRENT_WACOM_PROFILE) for tablet in self.TABLETS]}
+
+
+#----------------------------------------------------------------------
+def default_socket_path():
+    """
+    Return the default path of the daemon control socket.
+
+    The socket is placed in $XDG_RUNTIME_DIR if it is set, otherwise in the
+    private runtime directory of this script in /tmp (see runtime_dir()).
+    Return None if there is no such directory.
+    """
+    xdg_runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if xdg_runtime_dir:
+        return os.path.join(xdg_runtime_dir, PROGRAM_NAME + '.sock')
+    return runtime_path('daemon.sock')
+
+#----------------------------------------------------------------------
+def send_daemon_request(socket_path, request, timeout=2.0):
+    """
+    Send one request (a dict) to the daemon listening on socket_path and
+    return the decoded reply.
+
+    Raises socket.error if the daemon cannot be reached.
+    """
+    if not socket_path:
+        raise socket.error(errno.ENOENT, 'No safe runtime directory for the daemon socket, use --socket')
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall(json.dumps(request) + '\n')
+        reply = ''
+        while not reply.endswith('\n'):
+            data = s.recv(4096)
+            if not data:
+                break
+            reply += data
+    finally:
+        s.close()
+
+    return json.loads(reply)
+
+
+#----------------------------------------------------------------------
+def kernel_version(release=None):
+    """
+    Return the version of the running kernel (or of release, e.g.
+    '4.15.0-20-generic') as a tuple of three numbers, e.g. (4, 15, 0).
+    """
+    if release is None:
+        release = os.uname()[2]
+    numbers = re.match(r'\d+(\.\d+)*', release)
+    version = [int(n) for n in numbers.group(0).split('.')[:3]] if numbers else []
+    return tuple(version + [0] * (3 - len(version)))
+
+#----------------------------------------------------------------------
+def driver_kernel_version(release=None):
+    """
+    Return the directory of the input-wacom sources that is built for the
+    running kernel (or for release), like DRIVER_KERNEL_VER of
+    input-wacom-dkms.sh, or None if the kernel is too old.
+    """
+    version = kernel_version(release)
+    for driver_version in DRIVER_KERNEL_VERSIONS:
+        if version >= kernel_version(driver_version):
+            return driver_version
+    return None
+
+#----------------------------------------------------------------------
+def dkms_inventory(module='input-wacom'):
+    """
+    Return the versions of module that DKMS knows about, read from its
+    tree (/var/lib/dkms/<module>/<version>/<kernel>/<arch>/module/), and
+    the version installed for each kernel (the
+    /var/lib/dkms/<module>/kernel-<kernel>-<arch> links).
+    """
+    tree = os.path.join(DKMS_TREE, module)
+    inventory = {'path': tree, 'present': os.path.isdir(tree), 'versions': {}, 'installed': {}}
+    if not inventory['present']:
+        return inventory
+
+    for entry in sorted(os.listdir(tree)):
+        path = os.path.join(tree, entry)
+        if entry.startswith('kernel-'):
+            # e.g. kernel-4.15.0-20-generic-x86_64 -> 0.39.0/4.15.0-20-generic/x86_64
+            try:
+                inventory['installed'][entry[len('kernel-'):]] = os.readlink(path).split('/')[0]
+            except OSError:
+                pass
+            continue
+        if not os.path.isdir(path):
+            continue
+        builds = []
+        for module_dir in sorted(glob.glob(os.path.join(path, '*', '*', 'module'))):
+            arch_dir = os.path.dirname(module_dir)
+            builds.append({'kernel': os.path.basename(os.path.dirname(arch_dir)),
+                           'arch': os.path.basename(arch_dir),
+                           'modules': sorted(os.path.basename(ko) for ko in glob.glob(os.path.join(module_dir, '*.ko*')))})
+        inventory['versions'][entry] = {'source': os.path.exists(os.path.join(path, 'source')), 'builds': builds}
+    return inventory
+
+#----------------------------------------------------------------------
+def file_inventory(path):
+    """
+    Return whether path exists and its lines (without the empty lines and
+    the comments)
+    """
+    try:
+        with open(path) as f:
+            lines = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+    except IOError as e:
+        return {'path': path, 'present': os.path.exists(path), 'error': e.strerror}
+    return {'path': path, 'present': True, 'lines': lines}
+
+#----------------------------------------------------------------------
+def loaded_wacom_modules():
+    """
+    Return the names of the loaded kernel modules of the Wacom drivers
+    """
+    try:
+        with open('/proc/modules') as f:
+            return sorted(line.split()[0] for line in f if 'wacom' in line.split()[0])
+    except IOError:
+        return []
+
+#----------------------------------------------------------------------
+def system_inventory(backend=None, socket_path=None, use_cache=True):
+    """
+    Gather the state of the driver installation (see input-wacom-dkms.sh)
+    and of the tablets in one dict, for --inventory.
+
+    The tablets are discovered (from the discovery cache if possible) and
+    the daemon is asked for its status while the files are read. Nothing
+    is applied.
+    """
+    def discover_tablets():
+        try:
+            wacom = toggle_touchring(backend, use_cache)
+        except SystemExit:
+            return {'profile': None, 'tablets': [], 'error': 'No tablet with touchring LEDs was found.'}
+        try:
+            tablets = []
+            for tablet in wacom.TABLETS:
+                status = tablet.status(wacom.CURRENT_WACOM_PROFILE)
+                status['led_files'] = [{'path': led_file,
+                                        'readable': os.access(led_file, os.R_OK),
+                                        'writable': os.access(led_file, os.W_OK)}
+                                       for led_file in tablet.led_files]
+                status['devices'] = tablet.devices
+                status['pad_event_nodes'] = tablet.pad_event_nodes
+                tablets.append(status)
+            return {'profile': wacom.CURRENT_WACOM_PROFILE, 'tablets': tablets}
+        finally:
+            wacom.close()
+
+    def daemon_status():
+        try:
+            return {'socket': socket_path, 'running': True,
+                    'status': send_daemon_request(socket_path, {'command': 'status'}, timeout=0.5)}
+        except (socket.error, ValueError):
+            return {'socket': socket_path, 'running': False}
+
+    tablets_task = backgroundTask(discover_tablets)
+    daemon_task = backgroundTask(daemon_status) if socket_path else None
+
+    release = os.uname()[2]
+    inventory = {'hostname': socket.gethostname(),
+                 'version': VERSION,
+                 'kernel': {'release': release,
+                            'driver_kernel_ver': driver_kernel_version(release),
+                            'loaded_modules': loaded_wacom_modules()},
+                 'dkms': dkms_inventory(),
+                 'blacklist_file': file_inventory(BLACKLIST_FILE),
+                 'udev_rules_file': file_inventory(UDEV_RULES_FILE),
+                 'profiles': {'names': sorted(PROFILE.keys()), 'errors': profile_errors(PROFILE)}}
+    discovered = tablets_task.getResult()
+    inventory['profiles']['current'] = discovered.pop('profile')
+    inventory.update(discovered)
+    if daemon_task is not None:
+        inventory['daemon'] = daemon_task.getResult()
+    return inventory
+
+
+#----------------------------------------------------------------------
+def physical_device(path):
+    """
+    Return the sysfs directory of the physical device that the sysfs
+    directory 'path' belongs to: the USB device (e.g. '.../usb1/1-2'),
+    or the HID device (e.g. '.../0005:056A:0357.0003') of tablets that
+    are not connected over USB. All the LED files and input devices of
+    one tablet have the same physical device.
+    """
+    path = os.path.realpath(path)
+    hid_device = None
+    current = path
+    while current not in ('/', ''):
+        name = os.path.basename(current)
+        if re.match(r'^\d+-\d+(\.\d+)*$', name):
+            return current
+        if hid_device is None and re.match(r'^[0-9A-Fa-f]{4}:[0-9A-Fa-f]{4}:[0-9A-Fa-f]{4}\.[0-9A-Fa-f]{4}$', name):
+            hid_device = current
+        current = os.path.dirname(current)
+    return hid_device or path
+
+#----------------------------------------------------------------------
+def touchring_leds(device_dir, ring):
+    """
+    Return the number of mode LEDs of touchring 'ring' of the device
+    whose sysfs directory (the one with the wacom_led directory) is
+    device_dir.
+
+    The kernel registers them as the '<device>::wacom-<ring>.<led>' LEDs
+    of the device since Linux 4.11. MAX_MODES_PER_PROFILE is returned for
+    older kernels.
+    """
+    leds = glob.glob(os.path.join(device_dir, 'leds', '*::wacom-{}.*'.format(ring)))
+    return len(leds) or MAX_MODES_PER_PROFILE
+
+#----------------------------------------------------------------------
+def ring_cmdlist(cmdlist, ring):
+    """
+    Return the cmdlist of a profile mode for touchring 'ring'. The first
+    touchring uses the cmdlist as it is. The other ones only use the keys
+    listed in RING_PARAMS, translated to their own parameters (e.g.
+    'AbsWheelUp' to 'AbsWheel2Up').
+    """
+    if ring == 0:
+        return cmdlist
+    params = RING_PARAMS.get(ring, {})
+    return dict((params[param_key], param_val) for param_key, param_val in cmdlist.items() if param_key in params)
+
+#----------------------------------------------------------------------
+def x_device_nodes(dev_ids):
+    """
+    Return a {dev_id: node} dict with the 'Device Node' property (e.g.
+    '/dev/input/event5') of the given X input devices. Devices whose node
+    cannot be read are left out.
+
+    The properties are read over one X connection if python-xlib is
+    installed, otherwise with one batch of 'xinput --list-props' commands.
+    """
+    nodes = {}
+    if not dev_ids:
+        return nodes
+
+    try:
+        from Xlib import display, X
+        xdisplay = display.Display()
+        try:
+            atom = xdisplay.intern_atom('Device Node', True)
+            for dev_id in dev_ids:
+                if not atom:
+                    break
+                try:
+                    reply = xdisplay.xinput_get_device_property(int(dev_id), atom, X.AnyPropertyType, 0, 1024)
+                except Exception as e:
+                    LOG.debug("Could not read the device node of device {}: {}".format(dev_id, e))
+                    continue
+                if reply.value is not None and reply.value[0] == 8:
+                    node = reply.value[1]
+                    if not isinstance(node, str):
+                        node = ''.join(chr(c) for c in node)
+                    nodes[dev_id] = node.rstrip('\0')
+        finally:
+            xdisplay.close()
+        return nodes
+    except Exception as e:
+        LOG.debug("Cannot read the device nodes with python-xlib ({}), using xinput.".format(e))
+
+    dev_ids = list(dev_ids)
+    batch = executeBatch([['xinput', '--list-props', dev_id] for dev_id in dev_ids], 0, XSETWACOM_TIMEOUT)
+    r = quick_regexp()
+    for dev_id, cmd in zip(dev_ids, batch.getResults()):
+        if cmd.getReturnCode() != 0:
+            continue
+        for line in cmd.getStdout():
+            if r.search(r'^\s*Device Node \(\d+\):\s*"(.*)"', line):
+                nodes[dev_id] = r.groups[0]
+    return nodes
+
+#----------------------------------------------------------------------
+def find_pad_event_nodes(led_files):
+    """
+    Return the /dev/input/event* nodes of the pads of the tablets that
+    the given LED files belong to.
+
+    The LED directory (wacom_led) lives in the sysfs directory of the
+    device that also owns the input devices of the tablet. The pad is
+    the input device whose name ends with 'Pad'.
+    """
+    nodes = []
+    for led_file in led_files:
+        device_dir = os.path.dirname(os.path.dirname(led_file))
+        for event_dir in sorted(glob.glob(os.path.join(device_dir, 'input', 'input*', 'event*'))):
+            try:
+                with open(os.path.join(os.path.dirname(event_dir), 'name')) as f:
+                    name = f.read().strip()
+            except IOError:
+                continue
+            if name.endswith('Pad'):
+                nodes.append(os.path.join('/dev/input', os.path.basename(event_dir)))
+    return nodes
+
+#----------------------------------------------------------------------
+def parse_button(button):
+    """
+    Convert a button name (e.g. 'BTN_0') or number (e.g. '256' or '0x100')
+    to a Linux input event code.
+
+    Raises ValueError for unknown buttons.
+    """
+    try:
+        return int(button, 0)
+    except ValueError:
+        pass
+    name = button.upper()
+    if name in pad_button_listener.BUTTON_CODES:
+        return pad_button_listener.BUTTON_CODES[name]
+    raise ValueError("Unknown button '{}'".format(button))
+
+
+class pad_button_listener(object):
+    """
+    Read the input events of a pad (/dev/input/event*) and call callback()
+    every time the configured button is pressed.
+
+    Any file that contains 'struct input_event' records can be read, so a
+    uinput device or a FIFO fed with recorded events can stand in for
+    the real pad.
+    """
+    # struct input_event: struct timeval, __u16 type, __u16 code, __s32 value
+    INPUT_EVENT = struct.Struct('llHHi')
+    EV_KEY = 0x01
+
+    BUTTON_CODES = dict([('BTN_{}'.format(i), 0x100 + i) for i in xrange(10)] +
+                        [('BTN_A', 0x130), ('BTN_B', 0x131), ('BTN_C', 0x132),
+                         ('BTN_X', 0x133), ('BTN_Y', 0x134), ('BTN_Z', 0x135),
+                         ('BTN_BASE', 0x126), ('BTN_BASE2', 0x127),
+                         ('BTN_LEFT', 0x110), ('BTN_RIGHT', 0x111), ('BTN_MIDDLE', 0x112),
+                         ('BTN_FORWARD', 0x115), ('BTN_BACK', 0x116)])
+
+    #----------------------------------------------------------------------
+    def __init__(self, path, button, callback):
+        self.path = path
+        self.button = button
+        self.callback = callback
+        self._buffer = ''
+        self._fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+
+    #----------------------------------------------------------------------
+    def fileno(self):
+        return self._fd
+
+    #----------------------------------------------------------------------
+    def handle_events(self, fd=None, events=None):
+        """
+        Process all of the events that can be read without blocking.
+
+        Returns False once the end of the file is reached (or the device
+        is gone), True otherwise.
+        """
+        while True:
+            try:
+                data = os.read(self._fd, self.INPUT_EVENT.size * 64)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return True
+                LOG.debug("Reading '{}' failed: {}".format(self.path, e))
+                return False
+            if not data:
+                return False
+
+            self._buffer += data
+            while len(self._buffer) >= self.INPUT_EVENT.size:
+                _, _, ev_type, ev_code, ev_value = self.INPUT_EVENT.unpack_from(self._buffer)
+                self._buffer = self._buffer[self.INPUT_EVENT.size:]
+                # Only react to presses (value 1), not to releases (0) or autorepeat (2)
+                if ev_type == self.EV_KEY and ev_code == self.button and ev_value == 1:
+                    LOG.debug("Button {:#x} pressed on '{}'".format(ev_code, self.path))
+                    self.callback()
+
+    #----------------------------------------------------------------------
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+#----------------------------------------------------------------------
+def parse_ring_action(action):
+    """
+    Convert the 'up' or 'down' action of an 'acceleration' dict to a
+    (event type, codes, value) tuple for uinput_device.send_action():
+        'REL_WHEEL 1'              -> (EV_REL, [REL_WHEEL], 1)
+        'KEY_LEFTCTRL+KEY_KPPLUS'  -> (EV_KEY, [KEY_LEFTCTRL, KEY_KPPLUS], 1)
+    Keys can also be given by their event code (e.g. '78').
+
+    Raises ValueError for unknown actions.
+    """
+    if not isinstance(action, basestring) or not action.strip():
+        raise ValueError("Invalid action '{}'".format(action))
+    words = action.split()
+    name = words[0].upper()
+    if name in uinput_device.REL_CODES:
+        if len(words) != 2:
+            raise ValueError("Action '{}' needs the number of steps, e.g. '{} 1'".format(action, name))
+        try:
+            return (uinput_device.EV_REL, [uinput_device.REL_CODES[name]], int(words[1]))
+        except ValueError:
+            raise ValueError("Invalid number of steps in action '{}'".format(action))
+
+    codes = []
+    for key in ''.join(words).split('+'):
+        try:
+            code = int(key, 0)
+        except ValueError:
+            code = uinput_device.KEY_CODES.get(key.upper())
+        if code is None or not 0 < code < uinput_device.KEY_MAX:
+            raise ValueError("Unknown key '{}' in action '{}'".format(key, action))
+        codes.append(code)
+    return (uinput_device.EV_KEY, codes, 1)
+
+#----------------------------------------------------------------------
+def acceleration_errors(config):
+    """
+    Return the list of the problems of the 'acceleration' dict of a mode
+    (see the PROFILE dict).
+    """
+    if not isinstance(config, dict):
+        return ["'acceleration' has to be a dict."]
+    errors = []
+    for direction in ('up', 'down'):
+        try:
+            parse_ring_action(config.get(direction))
+        except ValueError as e:
+            errors.append("'acceleration' '{}': {}".format(direction, e))
+    window = config.get('window_ms', ACCELERATION_WINDOW_MS)
+    if not isinstance(window, (int, long, float)) or window <= 0:
+        errors.append("'acceleration' 'window_ms' has to be a positive number.")
+    curve = config.get('curve', [])
+    if (not isinstance(curve, list) or
+            not all(isinstance(point, (list, tuple)) and len(point) == 2 and
+                    all(isinstance(v, (int, long, float)) and v >= 0 for v in point) for point in curve)):
+        errors.append("'acceleration' 'curve' has to be a list of [speed, factor] pairs.")
+    elif [point[0] for point in curve] != sorted(point[0] for point in curve):
+        errors.append("'acceleration' 'curve' has to be sorted by speed.")
+    return errors
+
+#----------------------------------------------------------------------
+def acceleration_factor(curve, speed):
+    """
+    Return the factor of the [speed, factor] points of curve for speed,
+    interpolating linearly between the points. Speeds below the first
+    point use its factor, and speeds above the last point the last
+    factor. Without points, the factor is 1.
+    """
+    if not curve:
+        return 1.0
+    if speed <= curve[0][0]:
+        return float(curve[0][1])
+    for (speed0, factor0), (speed1, factor1) in zip(curve, curve[1:]):
+        if speed <= speed1:
+            if speed1 == speed0:
+                return float(factor1)
+            return factor0 + (factor1 - factor0) * float(speed - speed0) / (speed1 - speed0)
+    return float(curve[-1][1])
+
+
+class uinput_device(object):
+    """
+    A virtual input device (created through /dev/uinput) that sends the
+    actions of the ring processors (see ring_processor) to the desktop.
+
+    The legacy uinput interface (a 'struct uinput_user_dev' written to
+    the device) is used, so that kernels older than 4.5 are supported.
+    Writing to /dev/uinput usually needs a udev rule that gives the user
+    access to it.
+    """
+    EV_SYN = 0x00
+    EV_KEY = 0x01
+    EV_REL = 0x02
+    SYN_REPORT = 0
+
+    KEY_MAX = 0x2ff
+    REL_CODES = {'REL_HWHEEL': 0x06, 'REL_WHEEL': 0x08}
+    KEY_CODES = dict([('KEY_{}'.format(c), code) for row, first in (('1234567890', 2), ('QWERTYUIOP', 16),
+                                                                    ('ASDFGHJKL', 30), ('ZXCVBNM', 44))
+                      for code, c in enumerate(row, first)] +
+                     [('KEY_F{}'.format(i), 58 + i) for i in xrange(1, 11)] +
+                     [('KEY_ESC', 1), ('KEY_MINUS', 12), ('KEY_EQUAL', 13), ('KEY_BACKSPACE', 14),
+                      ('KEY_TAB', 15), ('KEY_LEFTBRACE', 26), ('KEY_RIGHTBRACE', 27), ('KEY_ENTER', 28),
+                      ('KEY_LEFTCTRL', 29), ('KEY_LEFTSHIFT', 42), ('KEY_COMMA', 51), ('KEY_DOT', 52),
+                      ('KEY_SLASH', 53), ('KEY_RIGHTSHIFT', 54), ('KEY_LEFTALT', 56), ('KEY_SPACE', 57),
+                      ('KEY_KPMINUS', 74), ('KEY_KPPLUS', 78), ('KEY_F11', 87), ('KEY_F12', 88),
+                      ('KEY_RIGHTCTRL', 97), ('KEY_RIGHTALT', 100), ('KEY_HOME', 102), ('KEY_UP', 103),
+                      ('KEY_PAGEUP', 104), ('KEY_LEFT', 105), ('KEY_RIGHT', 106), ('KEY_END', 107),
+                      ('KEY_DOWN', 108), ('KEY_PAGEDOWN', 109), ('KEY_INSERT', 110), ('KEY_DELETE', 111),
+                      ('KEY_VOLUMEDOWN', 114), ('KEY_VOLUMEUP', 115), ('KEY_LEFTMETA', 125),
+                      ('KEY_RIGHTMETA', 126), ('KEY_UNDO', 131), ('KEY_REDO', 182)])
+
+    # ioctls of <linux/uinput.h>: UI_DEV_CREATE = _IO('U', 1), UI_SET_*BIT = _IOW('U', 100 + n, int)
+    UI_DEV_CREATE = 0x5501
+    UI_DEV_DESTROY = 0x5502
+    UI_SET_EVBIT = 0x40045564
+    UI_SET_KEYBIT = 0x40045565
+    UI_SET_RELBIT = 0x40045566
+
+    # struct uinput_user_dev: char name[80], struct input_id (4 x __u16), __u32 ff_effects_max,
+    # __s32 absmax[64], absmin[64], absfuzz[64], absflat[64]
+    USER_DEV = struct.Struct('80s4HI256i')
+    BUS_VIRTUAL = 0x06
+
+    #----------------------------------------------------------------------
+    def __init__(self, path=None, name=PROGRAM_NAME):
+        paths = [path] if path else ['/dev/uinput', '/dev/input/uinput']
+        self.path = None
+        self._fd = None
+        for candidate in paths:
+            try:
+                self._fd = os.open(candidate, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                error = e
+                continue
+            self.path = candidate
+            break
+        if self._fd is None:
+            raise error
+
+        try:
+            fcntl.ioctl(self._fd, self.UI_SET_EVBIT, self.EV_KEY)
+            for code in xrange(1, 256):
+                fcntl.ioctl(self._fd, self.UI_SET_KEYBIT, code)
+            fcntl.ioctl(self._fd, self.UI_SET_EVBIT, self.EV_REL)
+            for code in self.REL_CODES.values():
+                fcntl.ioctl(self._fd, self.UI_SET_RELBIT, code)
+            os.write(self._fd, self.USER_DEV.pack(name, self.BUS_VIRTUAL, 0, 0, 1, 0, *([0] * 256)))
+            fcntl.ioctl(self._fd, self.UI_DEV_CREATE)
+        except (IOError, OSError):
+            os.close(self._fd)
+            self._fd = None
+            raise
+        self._lock = threading.Lock()
+
+    #----------------------------------------------------------------------
+    def send_action(self, action, count):
+        """
+        Send the action returned by parse_ring_action() count times. A
+        scroll action is sent as a single event of count times its steps,
+        a key action as count key presses.
+        """
+        ev_type, codes, value = action
+        events = []
+        if ev_type == self.EV_REL:
+            events += [(self.EV_REL, codes[0], value * count), (self.EV_SYN, self.SYN_REPORT, 0)]
+        else:
+            for _ in xrange(count):
+                events += [(self.EV_KEY, code, 1) for code in codes] + [(self.EV_SYN, self.SYN_REPORT, 0)]
+                events += [(self.EV_KEY, code, 0) for code in reversed(codes)] + [(self.EV_SYN, self.SYN_REPORT, 0)]
+        data = ''.join(pad_button_listener.INPUT_EVENT.pack(0, 0, ev_type, ev_code, ev_value)
+                       for ev_type, ev_code, ev_value in events)
+        with self._lock:
+            os.write(self._fd, data)
+
+    #----------------------------------------------------------------------
+    def close(self):
+        if self._fd is not None:
+            try:
+                fcntl.ioctl(self._fd, self.UI_DEV_DESTROY)
+            except IOError:
+                pass
+            os.close(self._fd)
+            self._fd = None
+
+
+class ring_processor(object):
+    """
+    Read the rotation of one touchring from the events of a pad
+    (/dev/input/event*) and send it through a uinput_device(), scaled by
+    the rotation speed.
+
+    get_config() returns the 'acceleration' dict of the current mode of
+    the touchring, or None if the mode does not have one (the rotation is
+    then left to the X driver). The detents turned within the window of
+    the config are sent as one action: its count is the number of
+    detents multiplied by the factor of the curve for the speed of the
+    rotation (in detents per second, from the event before the first
+    detent to the last one). The fractions that are left are carried
+    over to the next action in the same direction.
+
+    The times of the events are used instead of the time they are read,
+    so recorded events are processed like live ones.
+    """
+    EV_ABS = 0x03
+    # The axes of the first and the second touchring
+    RING_AXES = [0x08, 0x06]    # ABS_WHEEL, ABS_THROTTLE
+    # EVIOCGABS(abs) = _IOR('E', 0x40 + abs, struct input_absinfo)
+    ABS_INFO = struct.Struct('6i')
+    EVIOCGABS = 0x80184540
+    # The positions of the rings of the Intuos, Intuos Pro and Cintiq tablets
+    DEFAULT_POSITIONS = 72
+
+    #----------------------------------------------------------------------
+    def __init__(self, path, ring, get_config, output):
+        self.path = path
+        self.ring = ring
+        self.axis = self.RING_AXES[ring]
+        self.get_config = get_config
+        self.output = output
+        self._buffer = ''
+        self._last = None
+        self._last_time = None
+        self._delta = 0
+        self._burst_start = None
+        self._burst_from = None
+        self._burst_end = None
+        self._direction = 0
+        self._remainder = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.positions = self._axis_positions()
+
+    #----------------------------------------------------------------------
+    def _axis_positions(self):
+        try:
+            _, minimum, maximum, _, _, _ = self.ABS_INFO.unpack(
+                fcntl.ioctl(self._fd, self.EVIOCGABS + self.axis, '\0' * self.ABS_INFO.size))
+        except IOError:
+            # Not an event node (e.g. recorded events)
+            return self.DEFAULT_POSITIONS
+        return maximum - minimum + 1 if maximum > minimum else self.DEFAULT_POSITIONS
+
+    #----------------------------------------------------------------------
+    def fileno(self):
+        return self._fd
+
+    #----------------------------------------------------------------------
+    def handle_events(self, fd=None, events=None):
+        """
+        Process all of the events that can be read without blocking.
+
+        Returns False once the end of the file is reached (or the device
+        is gone), True otherwise.
+        """
+        while True:
+            try:
+                data = os.read(self._fd, pad_button_listener.INPUT_EVENT.size * 64)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return True
+                LOG.debug("Reading '{}' failed: {}".format(self.path, e))
+                data = ''
+            if not data:
+                self.flush()
+                return False
+
+            self._buffer += data
+            size = pad_button_listener.INPUT_EVENT.size
+            while len(self._buffer) >= size:
+                sec, usec, ev_type, ev_code, ev_value = pad_button_listener.INPUT_EVENT.unpack_from(self._buffer)
+                self._buffer = self._buffer[size:]
+                if ev_type == self.EV_ABS and ev_code == self.axis:
+                    self._on_position(sec + usec / 1000000.0, ev_value)
+
+    #----------------------------------------------------------------------
+    def _on_position(self, timestamp, position):
+        config = self.get_config()
+        # The rings report 0 when the finger is lifted
+        if not config or position == 0:
+            self._last = None
+            return
+        last, self._last = self._last, position
+        last_time, self._last_time = self._last_time, timestamp
+        if last is None:
+            return
+        delta = position - last
+        # The shortest way around the ring
+        if delta > self.positions / 2:
+            delta -= self.positions
+        elif delta < -self.positions / 2:
+            delta += self.positions
+        if not delta:
+            return
+
+        window = config.get('window_ms', ACCELERATION_WINDOW_MS) / 1000.0
+        with self._lock:
+            if self._burst_start is not None and timestamp - self._burst_start >= window:
+                self._flush(config)
+            if self._burst_start is None:
+                self._burst_start = timestamp
+                self._burst_from = last_time
+                # Send the last detents of a rotation even if no more events arrive
+                self._timer = threading.Timer(window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+            self._delta += delta
+            self._burst_end = timestamp
+
+    #----------------------------------------------------------------------
+    def flush(self):
+        """
+        Send the detents that were turned since the last action
+        """
+        with self._lock:
+            self._flush(self.get_config())
+
+    #----------------------------------------------------------------------
+    def _flush(self, config):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        delta, self._delta = self._delta, 0
+        self._burst_start = None
+        if not delta or not config:
+            return
+
+        direction = 1 if delta > 0 else -1
+        if direction != self._direction:
+            self._direction = direction
+            self._remainder = 0.0
+        speed = abs(delta) / max(self._burst_end - self._burst_from, 0.001)
+        units = abs(delta) * acceleration_factor(config.get('curve'), speed) + self._remainder
+        count = int(units)
+        self._remainder = units - count
+        LOG.debug("Touchring {} of '{}': {} detents at {:.0f} detents/s, {} actions"
+                  .format(self.ring, self.path, delta, speed, count))
+        if count:
+            try:
+                self.output.send_action(parse_ring_action(config['up' if direction > 0 else 'down']), count)
+            except (OSError, ValueError) as e:
+                LOG.error("Could not send the touchring action: {}".format(e))
+
+    #----------------------------------------------------------------------
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+#----------------------------------------------------------------------
+def profile_for_window(wm_class):
+    """
+    Return the name of the profile for a window with the given WM_CLASS
+    (an (instance, class) tuple), or 'Default' if none matches.
+    """
+    names = [name.lower() for name in (wm_class or ()) if name]
+    for name in names:
+        if name in WINDOW_PROFILE:
+            return WINDOW_PROFILE[name]
+    for profile in PROFILE.keys():
+        for name in names:
+            if name == profile.lower() or name.startswith(profile.lower() + '-'):
+                return profile
+    return 'Default'
+
+
+class active_window_watcher(object):
+    """
+    Watch the _NET_ACTIVE_WINDOW property of the root window and call
+    callback(wm_class) whenever a window with a different WM_CLASS gets
+    the focus. No polling is involved: the root window is selected for
+    PropertyNotify events and the X connection is added to the event loop
+    of the daemon.
+
+    Requires python-xlib.
+    """
+    #----------------------------------------------------------------------
+    def __init__(self, callback, display_name=None):
+        from Xlib import display, X
+        self._X = X
+        self.callback = callback
+        self._display = display.Display(display_name)
+        self._root = self._display.screen().root
+        self._NET_ACTIVE_WINDOW = self._display.intern_atom('_NET_ACTIVE_WINDOW')
+        self._root.change_attributes(event_mask=X.PropertyChangeMask)
+        self._display.flush()
+        self._wm_class = None
+
+    #----------------------------------------------------------------------
+    def fileno(self):
+        return self._display.fileno()
+
+    #----------------------------------------------------------------------
+    def active_wm_class(self):
+        """
+        Return the WM_CLASS of the active window, or None
+        """
+        try:
+            prop = self._root.get_full_property(self._NET_ACTIVE_WINDOW, self._X.AnyPropertyType)
+            if prop is None or not prop.value or not prop.value[0]:
+                return None
+            window = self._display.create_resource_object('window', prop.value[0])
+            return window.get_wm_class()
+        except Exception as e:
+            # The window may be gone by the time we ask for its class
+            LOG.debug("Could not get the class of the active window: {}".format(e))
+            return None
+
+    #----------------------------------------------------------------------
+    def handle_events(self, fd=None, events=None):
+        changed = False
+        while self._display.pending_events():
+            event = self._display.next_event()
+            if event.type == self._X.PropertyNotify and event.atom == self._NET_ACTIVE_WINDOW:
+                changed = True
+
+        if changed:
+            wm_class = self.active_wm_class()
+            if wm_class != self._wm_class:
+                self._wm_class = wm_class
+                self.callback(wm_class)
+
+    #----------------------------------------------------------------------
+    def close(self):
+        self._display.close()
+
+class dbus_error(Exception):
+    """
+    An error reply of a D-Bus method call. 'name' is the D-Bus error name
+    (e.g. 'org.freedesktop.DBus.Error.ServiceUnknown').
+    """
+    def __init__(self, name, message=''):
+        Exception.__init__(self, "{}: {}".format(name, message) if message else name)
+        self.name = name
+
+
+class dbus_connection(object):
+    """
+    A minimal D-Bus client: it speaks the wire protocol over the Unix
+    socket of a bus, so neither a D-Bus binding nor a 'qdbus' process is
+    needed. It supports method calls and signals with arguments of the
+    basic types, arrays, structs, dict entries and variants.
+
+    address: A D-Bus address, the session bus (see session_bus_address())
+             by default.
+    timeout: How many seconds a method call waits for its reply
+
+    Raises socket.error if the bus cannot be reached, and IOError if the
+    bus does not accept the connection.
+
+    #### Sample code ####
+    bus = dbus_connection()
+    print(bus.call('org.kde.Wacom', '/Tablet', 'org.kde.Wacom', 'getProfile'))
+    bus.on_signal('org.kde.Wacom', 'profileChanged', lambda args, message: print_(args))
+    while bus.handle_events():
+        select.select([bus], [], [])
+    """
+    METHOD_CALL, METHOD_RETURN, ERROR, SIGNAL = 1, 2, 3, 4
+    NO_REPLY_EXPECTED = 0x1
+
+    # Header field codes and the type of their values
+    HEADER_FIELDS = {1: ('path', 'o'), 2: ('interface', 's'), 3: ('member', 's'), 4: ('error_name', 's'),
+                     5: ('reply_serial', 'u'), 6: ('destination', 's'), 7: ('sender', 's'),
+                     8: ('signature', 'g'), 9: ('unix_fds', 'u')}
+
+    _ALIGNMENT = {'y': 1, 'b': 4, 'n': 2, 'q': 2, 'i': 4, 'u': 4, 'x': 8, 't': 8, 'd': 8, 'h': 4,
+                  's': 4, 'o': 4, 'g': 1, 'a': 4, '(': 8, '{': 8, 'v': 1}
+    _FORMATS = {'y': 'B', 'b': 'I', 'n': 'h', 'q': 'H', 'i': 'i', 'u': 'I', 'x': 'q', 't': 'Q', 'd': 'd', 'h': 'I'}
+
+    #----------------------------------------------------------------------
+    def __init__(self, address=None, timeout=1.0):
+        self.timeout = timeout
+        self._serial = 0
+        self._buffer = ''
+        # Signals received while waiting for a method reply, dispatched by handle_events()
+        self._pending_signals = []
+        self._signal_handlers = []
+        # One method call at a time
+        self._lock = threading.Lock()
+        self._sock = self._connect(address or session_bus_address())
+        try:
+            self._authenticate()
+            self.unique_name = self.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus',
+                                         'Hello')[0]
+        except:
+            self._sock.close()
+            raise
+
+    #----------------------------------------------------------------------
+    def _connect(self, address):
+        error = socket.error("No supported transport in the D-Bus address '{}'".format(address))
+        for entry in address.split(';'):
+            transport, _, params = entry.partition(':')
+            if transport != 'unix':
+                continue
+            params = dict(param.split('=', 1) for param in params.split(',') if '=' in param)
+            params = dict((key, re.sub(r'%([0-9A-Fa-f]{2})', lambda m: chr(int(m.group(1), 16)), value))
+                          for key, value in params.items())
+            if 'path' in params:
+                path = params['path']
+            elif 'abstract' in params:
+                path = '\0' + params['abstract']
+            else:
+                continue
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(path)
+                return sock
+            except socket.error as e:
+                sock.close()
+                error = e
+        raise error
+
+    #----------------------------------------------------------------------
+    def _authenticate(self):
+        self._sock.sendall('\0AUTH EXTERNAL {}\r\n'.format(str(os.getuid()).encode('hex')))
+        line = ''
+        while not line.endswith('\r\n'):
+            data = self._sock.recv(256)
+            if not data:
+                break
+            line += data
+        if not line.startswith('OK '):
+            raise IOError("D-Bus authentication failed: {!r}".format(line.strip()))
+        self._sock.sendall('BEGIN\r\n')
+
+    #----------------------------------------------------------------------
+    def fileno(self):
+        return self._sock.fileno()
+
+    #----------------------------------------------------------------------
+    def close(self):
+        self._sock.close()
+
+    #----------------------------------------------------------------------
+    @classmethod
+    def split_signature(cls, signature):
+        """
+        Split a signature into its complete types, e.g. 'sa{sv}(ii)' to
+        ['s', 'a{sv}', '(ii)']
+        """
+        types = []
+        start = 0
+        while start < len(signature):
+            end = start
+            while signature[end] == 'a':
+                end += 1
+            if signature[end] in '({':
+                depth = 0
+                while True:
+                    if signature[end] in '({':
+                        depth += 1
+                    elif signature[end] in ')}':
+                        depth -= 1
+                    end += 1
+                    if depth == 0:
+                        break
+            else:
+                end += 1
+            types.append(signature[start:end])
+            start = end
+        return types
+
+    #----------------------------------------------------------------------
+    def _marshal(self, data, type_code, value):
+        """
+        Append value, of the single complete type type_code, to the
+        bytearray data
+        """
+        code = type_code[0]
+        data.extend('\0' * (-len(data) % self._ALIGNMENT[code]))
+        if code in self._FORMATS:
+            data.extend(struct.pack('<' + self._FORMATS[code], value))
+        elif code in 'so':
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            data.extend(struct.pack('<I', len(value)) + value + '\0')
+        elif code == 'g':
+            data.extend(struct.pack('<B', len(value)) + value + '\0')
+        elif code == 'v':
+            signature, inner = value
+            self._marshal(data, 'g', signature)
+            self._marshal(data, signature, inner)
+        elif code in '({':
+            for field_type, field in zip(self.split_signature(type_code[1:-1]), value):
+                self._marshal(data, field_type, field)
+        elif code == 'a':
+            length_offset = len(data)
+            data.extend('\0' * 4)
+            element_type = type_code[1:]
+            data.extend('\0' * (-len(data) % self._ALIGNMENT[element_type[0]]))
+            start = len(data)
+            for element in (value.items() if element_type[0] == '{' else value):
+                self._marshal(data, element_type, element)
+            struct.pack_into('<I', data, length_offset, len(data) - start)
+        else:
+            raise ValueError("Unsupported D-Bus type '{}'".format(type_code))
+
+    #----------------------------------------------------------------------
+    def _unmarshal(self, data, offset, type_code, endian):
+        """
+        Read a value of the single complete type type_code from data at
+        offset. Returns (value, offset after the value).
+        """
+        code = type_code[0]
+        offset += -offset % self._ALIGNMENT[code]
+        if code in self._FORMATS:
+            fmt = endian + self._FORMATS[code]
+            value = struct.unpack_from(fmt, data, offset)[0]
+            return (bool(value) if code == 'b' else value), offset + struct.calcsize(fmt)
+        elif code in 'so':
+            length = struct.unpack_from(endian + 'I', data, offset)[0]
+            return data[offset + 4:offset + 4 + length], offset + 4 + length + 1
+        elif code == 'g':
+            length = ord(data[offset])
+            return data[offset + 1:offset + 1 + length], offset + 1 + length + 1
+        elif code == 'v':
+            signature, offset = self._unmarshal(data, offset, 'g', endian)
+            return self._unmarshal(data, offset, signature, endian)
+        elif code in '({':
+            fields = []
+            for field_type in self.split_signature(type_code[1:-1]):
+                field, offset = self._unmarshal(data, offset, field_type, endian)
+                fields.append(field)
+            return tuple(fields), offset
+        elif code == 'a':
+            length = struct.unpack_from(endian + 'I', data, offset)[0]
+            element_type = type_code[1:]
+            offset += 4
+            offset += -offset % self._ALIGNMENT[element_type[0]]
+            end = offset + length
+            elements = []
+            while offset < end:
+                element, offset = self._unmarshal(data, offset, element_type, endian)
+                elements.append(element)
+            return (dict(elements) if element_type[0] == '{' else elements), offset
+        raise ValueError("Unsupported D-Bus type '{}'".format(type_code))
+
+    #----------------------------------------------------------------------
+    def send(self, message_type, fields, signature='', args=(), flags=0):
+        """
+        Send a message and return its serial.
+
+        fields: A dict with the header fields, by name (see HEADER_FIELDS)
+        """
+        self._serial += 1
+        body = bytearray()
+        for type_code, arg in zip(self.split_signature(signature), args):
+            self._marshal(body, type_code, arg)
+
+        header_fields = []
+        for code, (name, type_code) in sorted(self.HEADER_FIELDS.items()):
+            if name == 'signature' and signature:
+                header_fields.append((code, ('g', signature)))
+            elif fields.get(name) is not None:
+                header_fields.append((code, (type_code, fields[name])))
+
+        message = bytearray()
+        message.extend(struct.pack('<cBBBII', 'l', message_type, flags, 1, len(body), self._serial))
+        self._marshal(message, 'a(yv)', header_fields)
+        message.extend('\0' * (-len(message) % 8))
+        message.extend(body)
+        self._sock.sendall(str(message))
+        return self._serial
+
+    #----------------------------------------------------------------------
+    def _parse_message(self):
+        """
+        Remove one complete message from the receive buffer and return it
+        as a dict (the header fields by name, 'type', 'serial' and 'body',
+        the list of the arguments), or None if more data is needed.
+        """
+        data = self._buffer
+        if len(data) < 16:
+            return None
+        endian = '<' if data[0] == 'l' else '>'
+        body_length, serial, fields_length = struct.unpack_from(endian + 'III', data, 4)
+        header_length = 16 + fields_length
+        header_length += -header_length % 8
+        if len(data) < header_length + body_length:
+            return None
+
+        message = {'type': ord(data[1]), 'flags': ord(data[2]), 'serial': serial}
+        fields, _ = self._unmarshal(data, 12, 'a(yv)', endian)
+        for code, value in fields:
+            if code in self.HEADER_FIELDS:
+                message[self.HEADER_FIELDS[code][0]] = value
+
+        body = []
+        offset = header_length
+        for type_code in self.split_signature(message.get('signature', '')):
+            value, offset = self._unmarshal(data, offset, type_code, endian)
+            body.append(value)
+        message['body'] = body
+
+        self._buffer = data[header_length + body_length:]
+        return message
+
+    #----------------------------------------------------------------------
+    def _receive(self, deadline):
+        """
+        Return the next message, waiting for it until deadline (a
+        time.time() value). Raises socket.timeout if it does not arrive.
+        """
+        while True:
+            message = self._parse_message()
+            if message is not None:
+                return message
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("No reply from the bus")
+            self._sock.settimeout(remaining)
+            data = self._sock.recv(65536)
+            if not data:
+                raise socket.error(errno.ECONNRESET, "The bus closed the connection")
+            self._buffer += data
+
+    #----------------------------------------------------------------------
+    def call(self, destination, path, interface, member, signature='', args=()):
+        """
+        Call a method and return the list of the arguments of its reply.
+
+        Raises dbus_error if the reply is an error, and socket.timeout if
+        there is no reply within the timeout.
+        """
+        with self._lock:
+            serial = self.send(self.METHOD_CALL, {'destination': destination, 'path': path,
+                                                  'interface': interface, 'member': member}, signature, args)
+            deadline = time.time() + self.timeout
+            while True:
+                message = self._receive(deadline)
+                if message['type'] == self.SIGNAL:
+                    self._pending_signals.append(message)
+                elif message.get('reply_serial') == serial:
+                    break
+
+        if message['type'] == self.ERROR:
+            body = message['body']
+            raise dbus_error(message.get('error_name', 'Unknown'), body[0] if body and isinstance(body[0], str) else '')
+        return message['body']
+
+    #----------------------------------------------------------------------
+    def on_signal(self, interface, member, callback):
+        """
+        Call callback(args, message) whenever the signal 'member' of
+        'interface' is received (see handle_events())
+        """
+        self.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'AddMatch', 's',
+                  ["type='signal',interface='{}',member='{}'".format(interface, member)])
+        self._signal_handlers.append((interface, member, callback))
+
+    #----------------------------------------------------------------------
+    def handle_events(self, fd=None, events=None):
+        """
+        Read whatever the bus sent without blocking, and dispatch the
+        signals. Returns False if the bus closed the connection.
+        """
+        connected = True
+        with self._lock:
+            self._sock.setblocking(0)
+            try:
+                while True:
+                    data = self._sock.recv(65536)
+                    if not data:
+                        connected = False
+                        break
+                    self._buffer += data
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            message = self._parse_message()
+            while message is not None:
+                if message['type'] == self.SIGNAL:
+                    self._pending_signals.append(message)
+                message = self._parse_message()
+            signals, self._pending_signals = self._pending_signals, []
+
+        for message in signals:
+            for interface, member, callback in self._signal_handlers:
+                if message.get('interface') == interface and message.get('member') == member:
+                    callback(message['body'], message)
+        return connected
+
+#----------------------------------------------------------------------
+def session_bus_address():
+    """
+    Return the address of the session bus: $DBUS_SESSION_BUS_ADDRESS, or
+    the 'bus' socket of $XDG_RUNTIME_DIR (where systemd puts it).
+    """
+    address = os.environ.get('DBUS_SESSION_BUS_ADDRESS')
+    if address:
+        return address
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.exists(os.path.join(runtime_dir, 'bus')):
+        return 'unix:path=' + os.path.join(runtime_dir, 'bus')
+    raise socket.error(errno.ENOENT, "The address of the session bus is not known")
+
+_SESSION_BUS = None
+_SESSION_BUS_LOCK = threading.Lock()
+
+#----------------------------------------------------------------------
+def kde_wacom_profile():
+    """
+    Return the current profile of the KDE Wacom tablet service, or '' if
+    the service does not answer.
+
+    The profile is asked over a connection to the session bus that is
+    opened once and reused by the next calls. 'qdbus' is used instead if
+    the session bus cannot be used.
+    """
+    global _SESSION_BUS
+    with _SESSION_BUS_LOCK:
+        try:
+            if _SESSION_BUS is None:
+                _SESSION_BUS = dbus_connection(timeout=QDBUS_TIMEOUT)
+            reply = _SESSION_BUS.call('org.kde.Wacom', '/Tablet', 'org.kde.Wacom', 'getProfile')
+            return reply[0] if reply and isinstance(reply[0], str) else ''
+        except dbus_error as e:
+            LOG.debug("org.kde.Wacom.getProfile failed: {}".format(e))
+            return ''
+        except socket.timeout:
+            LOG.warning("The session bus did not answer in {} seconds.".format(QDBUS_TIMEOUT))
+            return ''
+        except (socket.error, IOError, ValueError, struct.error) as e:
+            LOG.debug("Cannot use the session bus ({}), using qdbus.".format(e))
+            if _SESSION_BUS is not None:
+                _SESSION_BUS.close()
+                _SESSION_BUS = None
+
+    cmd = executeCommand(['qdbus', 'org.kde.Wacom', '/Tablet', 'org.kde.Wacom.getProfile'], timeout=QDBUS_TIMEOUT)
+    return cmd.getStdout(False).strip()
+
+
+class touchring_daemon(object):
+    """
+    Keep a toggle_touchring() object resident and serve mode changes
+    that arrive on a Unix domain socket.
+
+    The protocol is one JSON object per line in each direction, e.g.
+        {"command": "toggle"}
+        {"command": "set-mode", "mode": 2, "tablet": "1-2", "ring": 1}
+        {"command": "set-mode", "mode": 1, "profile": "Krita"}
+        {"command": "status"}
+        {"command": "reload"}
+    Every reply carries a "status" key which is either "ok" or "error".
+    "toggle" and "set-mode" switch all of the tablets, or only the one
+    given by "tablet" (see toggle_touchring.select_tablets()), and the
+    first touchring, or the one given by "ring". The mode
+    switches are done by one thread per request, so that a switch of one
+    tablet does not wait for the switch of another one.
+
+    If listen_button is set, the daemon also reads the events of the pads
+    (or of listen_device) and toggles the mode itself when that button is
+    pressed, without a desktop shortcut having to start the client. Only
+    the tablet whose pad was pressed is toggled.
+
+    If accelerate is True, the daemon also reads the rotation of the
+    touchrings from the pads (or from listen_device, for the first
+    touchring of the first tablet) and sends the actions of the modes
+    that define an 'acceleration' dict itself (see ring_processor).
+
+    If follow_window is True, the profile follows the active window (see
+    WINDOW_PROFILE) and mode 0 of the new profile is applied as soon as
+    the focus changes. Otherwise, the daemon subscribes to the
+    profileChanged signal of the KDE Wacom service on the session bus,
+    and applies mode 0 of the new profile as soon as it is selected.
+    """
+    #----------------------------------------------------------------------
+    def __init__(self, socket_path, backend=None, use_cache=True, listen_button=None, listen_device=None,
+                 follow_window=False, accelerate=False):
+        self.socket_path = socket_path
+        self.backend = backend
+        self.listen_button = listen_button
+        self.listen_device = listen_device
+        self.accelerate = accelerate
+        self.wacom = toggle_touchring(backend, use_cache)
+        self._poller = select.epoll()
+        self._handlers = {}
+        # The connected clients whose request is not complete yet, {fd: [socket, data]}
+        self._clients = {}
+        self._listeners = []
+        self._processors = []
+        self._uinput = None
+        self._server = None
+        self._window_watcher = None
+        self._profile_watcher = None
+        # The profile that the profile worker applies next, see _switch_profile()
+        self._pending_profile = None
+        self._profile_thread = None
+        self._profile_lock = threading.Lock()
+        if follow_window:
+            try:
+                self._window_watcher = active_window_watcher(self._on_window_changed)
+            except Exception as e:
+                LOG.error("Cannot follow the active window: {}".format(e))
+        else:
+            try:
+                self._profile_watcher = dbus_connection(timeout=QDBUS_TIMEOUT)
+                self._profile_watcher.on_signal('org.kde.Wacom', 'profileChanged', self._on_profile_changed)
+            except (dbus_error, socket.error, IOError, ValueError, struct.error) as e:
+                LOG.debug("Cannot follow the profile of the KDE Wacom service: {}".format(e))
+                if self._profile_watcher is not None:
+                    self._profile_watcher.close()
+                    self._profile_watcher = None
+
+    #----------------------------------------------------------------------
+    def _on_profile_changed(self, args, message):
+        # Newer versions of the service also send the id of the tablet, the profile is the last argument.
+        profile = args[-1] if args and isinstance(args[-1], str) else ''
+        if profile not in PROFILE:
+            LOG.debug("Profile '{}' is not defined in PROFILE dict. Falling back to 'Default'".format(profile))
+            profile = 'Default'
+        LOG.debug("The KDE Wacom profile changed to '{}'".format(profile))
+        self._switch_profile(profile)
+
+    #----------------------------------------------------------------------
+    def _on_bus_event(self, fd, events):
+        try:
+            connected = self._profile_watcher.handle_events()
+        except (socket.error, ValueError, struct.error) as e:
+            LOG.debug("Session bus error: {}".format(e))
+            connected = False
+        if not connected:
+            LOG.debug("The session bus closed the connection, the KDE Wacom profile is not followed any more.")
+            self.unregister(fd)
+            self._profile_watcher.close()
+            self._profile_watcher = None
+
+    #----------------------------------------------------------------------
+    def _on_window_changed(self, wm_class):
+        profile = profile_for_window(wm_class)
+        LOG.debug("Active window class {}, profile '{}'".format(wm_class, profile))
+        self._switch_profile(profile)
+
+    #----------------------------------------------------------------------
+    def _switch_profile(self, profile):
+        """
+        Select profile and apply it on a worker thread, so that the event
+        loop does not wait for its parameters. There is one worker at a
+        time, and it applies the profiles in order. The profiles requested
+        while it is busy are coalesced, only the last one is applied.
+        """
+        with self._profile_lock:
+            self._pending_profile = profile
+            if self._profile_thread is not None:
+                return
+            self._profile_thread = threading.Thread(target=self._profile_worker)
+            self._profile_thread.daemon = True
+            self._profile_thread.start()
+
+    #----------------------------------------------------------------------
+    def _profile_worker(self):
+        while True:
+            with self._profile_lock:
+                profile, self._pending_profile = self._pending_profile, None
+                if profile is None:
+                    self._profile_thread = None
+                    return
+            wacom = self.wacom
+            if profile == wacom.CURRENT_WACOM_PROFILE:
+                continue
+            try:
+                wacom.set_profile(profile)
+            except Exception:
+                LOG.error("Switching to profile '{}' failed:".format(profile), exc_info=True)
+
+    #----------------------------------------------------------------------
+    def _open_listeners(self):
+        """
+        (Re)open the pad event nodes if a listen button is configured or
+        the touchrings are accelerated
+        """
+        for listener in self._listeners + self._processors:
+            if listener.fileno() in self._handlers:
+                self.unregister(listener.fileno())
+            listener.close()
+        self._listeners = []
+        self._processors = []
+
+        if self.accelerate:
+            self._open_processors()
+        if self.listen_button is None:
+            return
+        if self.listen_device:
+            paths = [(self.listen_device, None)]
+        else:
+            paths = [(path, tablet.id) for tablet in self.wacom.TABLETS for path in tablet.pad_event_nodes]
+        if not paths:
+            LOG.warning("No pad event node was found, cannot listen for button presses.")
+        for path, tablet in paths:
+            try:
+                listener = pad_button_listener(path, self.listen_button, lambda tablet=tablet: self._on_button(tablet))
+            except OSError as e:
+                LOG.error("Could not open '{}': {}".format(path, e))
+                continue
+            self._listeners.append(listener)
+            try:
+                self.register(listener.fileno(), self._on_listener_event)
+            except IOError as e:
+                if e.errno != errno.EPERM:
+                    raise
+                # Regular files (recorded events) cannot be polled, replay them at once.
+                LOG.debug("Replaying the events recorded in '{}'".format(path))
+                listener.handle_events()
+                continue
+            LOG.info("Listening for button {:#x} on '{}'".format(self.listen_button, path))
+
+    #----------------------------------------------------------------------
+    def _on_listener_event(self, fd, events):
+        for listeners in (self._listeners, self._processors):
+            for listener in listeners:
+                if listener.fileno() == fd:
+                    if not listener.handle_events() or events & (select.EPOLLHUP | select.EPOLLERR):
+                        LOG.debug("'{}' was closed.".format(listener.path))
+                        self.unregister(fd)
+                        listener.close()
+                        listeners.remove(listener)
+                    return
+
+    #----------------------------------------------------------------------
+    def _open_processors(self):
+        """
+        Open a ring_processor() for every touchring of every pad, and
+        reapply the current modes of the touchrings that are processed,
+        so that the X driver stops acting on their rotation.
+        """
+        if self._uinput is None:
+            try:
+                self._uinput = uinput_device()
+            except (OSError, IOError) as e:
+                LOG.error("Could not create the uinput device, the touchrings are not accelerated: {}".format(e))
+                return
+
+        if self.listen_device:
+            rings = [(self.listen_device, self.wacom.TABLETS[0], 0)] if self.wacom.TABLETS else []
+        else:
+            rings = [(path, tablet, ring) for tablet in self.wacom.TABLETS
+                     for path in tablet.pad_event_nodes for ring in xrange(len(tablet.rings))]
+        if not rings:
+            LOG.warning("No pad event node was found, cannot accelerate the touchrings.")
+        for path, tablet, ring in rings:
+            try:
+                processor = ring_processor(path, ring, lambda tablet=tablet, ring=ring: self._acceleration(tablet, ring),
+                                           self._uinput)
+            except OSError as e:
+                LOG.error("Could not open '{}': {}".format(path, e))
+                continue
+            self._processors.append(processor)
+            tablet.processed_rings.add(ring)
+            try:
+                self.register(processor.fileno(), self._on_listener_event)
+            except IOError as e:
+                if e.errno != errno.EPERM:
+                    raise
+                # Regular files (recorded events) cannot be polled, replay them at once.
+                LOG.debug("Replaying the touchring events recorded in '{}'".format(path))
+                processor.handle_events()
+                continue
+            LOG.info("Accelerating touchring {} of tablet '{}' from '{}'".format(ring, tablet.name, path))
+
+        for tablet in self.wacom.TABLETS:
+            for ring in tablet.processed_rings:
+                if tablet.modes[ring] >= 0:
+                    self.wacom.set_mode(tablet.modes[ring], tablet=tablet.id, ring=ring)
+
+    #----------------------------------------------------------------------
+    def _acceleration(self, tablet, ring):
+        """
+        Return the 'acceleration' dict of the current mode of a touchring,
+        or None if it does not have one
+        """
+        profile = PROFILE.get(self.wacom.CURRENT_WACOM_PROFILE, {})
+        return profile.get(str(tablet.modes[ring]), {}).get('acceleration')
+
+    #----------------------------------------------------------------------
+    def _on_button(self, tablet=None):
+        job = self.start_request({'command': 'toggle', 'tablet': tablet})
+
+        def worker():
+            reply = job()
+            LOG.debug("Switched to mode {} of profile '{}'".format(reply.get('mode'), reply.get('profile')))
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    #----------------------------------------------------------------------
+    def register(self, fd, callback, eventmask=select.EPOLLIN):
+        """
+        Call callback(fd, events) whenever fd becomes ready.
+        """
+        self._handlers[fd] = callback
+        self._poller.register(fd, eventmask)
+
+    #----------------------------------------------------------------------
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+        del self._handlers[fd]
+
+    #----------------------------------------------------------------------
+    def _bind(self):
+        """
+        Create the listening socket. A socket file left behind by a daemon
+        that is no longer running is removed first. Without a safe runtime
+        directory (see default_socket_path()), the socket is created in a
+        new private directory, and clients need its path.
+        """
+        if not self.socket_path:
+            self.socket_path = os.path.join(tempfile.mkdtemp(prefix=PROGRAM_NAME + '-'), 'daemon.sock')
+            LOG.warning("No safe runtime directory, listening on '{}' (use --socket).".format(self.socket_path))
+
+        if os.path.exists(self.socket_path):
+            try:
+                send_daemon_request(self.socket_path, {'command': 'status'}, timeout=0.5)
+            except (socket.error, ValueError):
+                LOG.debug("Removing stale socket '{}'".format(self.socket_path))
+                os.unlink(self.socket_path)
+            else:
+                LOG.error("Another daemon is already listening on '{}'.".format(self.socket_path))
+                exit(1)
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self._server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self._server.listen(8)
+        self.register(self._server.fileno(), self._accept)
+
+    #----------------------------------------------------------------------
+    def _accept(self, fd, events):
+        conn, _ = self._server.accept()
+        # The request is read by the event loop as it arrives, a slow client does not block the other events
+        conn.setblocking(False)
+        self._clients[conn.fileno()] = [conn, '']
+        self.register(conn.fileno(), self._read_request)
+
+    #----------------------------------------------------------------------
+    def _read_request(self, fd, events):
+        """
+        Read the available data of a client. Once its request line is
+        complete, it is started, and its reply is sent by another thread.
+        """
+        conn, request = self._clients[fd]
+        try:
+            data = conn.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            LOG.debug("Client connection failed: {}".format(e))
+            data = None
+        if data is None or (not data and not request):
+            self.unregister(fd)
+            del self._clients[fd]
+            conn.close()
+            return
+
+        request += data
+        if data and not request.endswith('\n') and len(request) <= MAX_REQUEST_SIZE:
+            self._clients[fd][1] = request
+            return
+
+        self.unregister(fd)
+        del self._clients[fd]
+        if len(request) > MAX_REQUEST_SIZE:
+            reply = {'status': 'error', 'message': 'Request too long'}
+            job = lambda: reply
+        else:
+            try:
+                job = self.start_request(json.loads(request))
+            except ValueError:
+                reply = {'status': 'error', 'message': 'Malformed request'}
+                job = lambda: reply
+
+        conn.setblocking(True)
+        conn.settimeout(1.0)
+        thread = threading.Thread(target=self._finish_request, args=(conn, job))
+        thread.daemon = True
+        thread.start()
+
+    #----------------------------------------------------------------------
+    def _finish_request(self, conn, job):
+        try:
+            with TRACE.span('request'):
+                reply = job()
+            conn.sendall(json.dumps(reply) + '\n')
+        except socket.error as e:
+            LOG.debug("Client connection failed: {}".format(e))
+        finally:
+            conn.close()
+
+    #----------------------------------------------------------------------
+    def start_request(self, request):
+        """
+        Check one decoded request and return a function that executes it
+        and returns the reply dict.
+
+        Reloads (also the ones triggered by devices that changed) and
+        status requests are done right away. Mode switches are done by the
+        returned function, which may be called from another thread.
+        """
+        command = request.get('command') if isinstance(request, dict) else None
+        LOG.debug("Received request '{}'".format(command))
+        if command not in ('toggle', 'set-mode', 'status', 'reload'):
+            reply = {'status': 'error', 'message': "Unknown command '{}'".format(command)}
+            return lambda: reply
+
+        if command == 'reload' or self.wacom.is_stale():
+            if command != 'reload':
+                LOG.debug("The devices changed, rediscovering them.")
+            ok = self._reload()
+            if command == 'reload' or not ok:
+                reply = self._reply(self.wacom, ok, "Rediscovery failed, keeping the previous state.")
+                return lambda: reply
+
+        wacom = self.wacom
+        if command == 'status':
+            reply = self._reply(wacom, True)
+            return lambda: reply
+
+        verify = bool(request.get('verify'))
+        tablet = request.get('tablet')
+        try:
+            ring = int(request.get('ring') or 0)
+        except (TypeError, ValueError):
+            reply = {'status': 'error', 'message': "Invalid ring '{}'".format(request.get('ring'))}
+            return lambda: reply
+        if command == 'toggle':
+            return lambda: self._reply(wacom, wacom.toggle_mode(verify=verify, tablet=tablet, ring=ring),
+                                       lambda: wacom.mode_error(None, tablet, ring))
+
+        try:
+            mode = int(request.get('mode'))
+        except (TypeError, ValueError):
+            reply = {'status': 'error', 'message': "Invalid mode '{}'".format(request.get('mode'))}
+            return lambda: reply
+        profile = request.get('profile')
+        return lambda: self._reply(wacom, wacom.set_mode(mode, verify=verify, tablet=tablet, ring=ring, profile=profile),
+                                   lambda: wacom.mode_error(mode, tablet, ring, profile))
+
+    #----------------------------------------------------------------------
+    def handle_request(self, request):
+        """
+        Execute one decoded request and return the reply dict.
+        """
+        return self.start_request(request)()
+
+    #----------------------------------------------------------------------
+    @staticmethod
+    def _reply(wacom, ok, message=None):
+        """
+        Return the reply dict of a request. A failed request always has a
+        'message': message, or what message() returns if it is a function,
+        or a generic one.
+        """
+        reply = wacom.status()
+        reply['status'] = 'ok' if ok else 'error'
+        if not ok:
+            if callable(message):
+                message = message()
+            reply['message'] = message or "The mode switch failed, see the log of the daemon."
+        return reply
+
+    #----------------------------------------------------------------------
+    def _reload(self):
+        """
+        Rediscover the tablets. The switches that are still running on the
+        previous toggle_touchring() object are waited for before its LED
+        files are closed.
+
+        Returns False (and keeps the previous state) if the rediscovery
+        failed.
+        """
+        try:
+            wacom = toggle_touchring(self.backend, use_cache=False)
+        except SystemExit:
+            LOG.error("Rediscovery failed, keeping the previous state.")
+            return False
+
+        old_wacom, self.wacom = self.wacom, wacom
+        for tablet in old_wacom.TABLETS:
+            with tablet.lock:
+                with tablet.state_lock:
+                    tablet.close()
+        self._open_listeners()
+        if self._window_watcher is not None:
+            self._on_window_changed(self._window_watcher.active_wm_class())
+        return True
+
+    #----------------------------------------------------------------------
+    def serve_forever(self):
+        """
+        Dispatch events until SIGTERM or SIGINT is received.
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+        self._bind()
+        LOG.info("Listening on '{}'".format(self.socket_path))
+        self._open_listeners()
+        if self._window_watcher is not None:
+            self.register(self._window_watcher.fileno(), self._window_watcher.handle_events)
+            self._on_window_changed(self._window_watcher.active_wm_class())
+        if self._profile_watcher is not None:
+            self.register(self._profile_watcher.fileno(), self._on_bus_event)
+            # Signals that arrived while subscribing
+            self._on_bus_event(self._profile_watcher.fileno(), 0)
+        try:
+            while True:
+                try:
+                    events = self._poller.poll()
+                except IOError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                for fd, event in events:
+                    if fd in self._handlers:
+                        self._handlers[fd](fd, event)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for listener in self._listeners + self._processors:
+                listener.close()
+            if self._uinput is not None:
+                self._uinput.close()
+            if self._window_watcher is not None:
+                self._window_watcher.close()
+            if self._profile_watcher is not None:
+                self._profile_watcher.close()
+            self._server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+#----------------------------------------------------------------------
+def run_client(options):
+    """
+    Forward the requested command to the daemon and print its reply.
+
+    If no daemon is running, --toggle and --set-mode are executed in
+    this process instead.
+    """
+    request = {'command': options.client_command, 'verify': options.verify, 'tablet': options.tablet,
+               'ring': options.ring}
+    if options.client_command == 'set-mode':
+        request['mode'] = options.client_mode
+        request['profile'] = options.client_profile
+
+    try:
+        reply = send_daemon_request(options.socket_path, request)
+    except (socket.error, ValueError) as e:
+        # Only switch in-process if no daemon listens: one that is slow to reply may still switch the mode.
+        no_daemon = isinstance(e, socket.error) and e.errno in (errno.ENOENT, errno.ECONNREFUSED)
+        if options.client_command not in ('toggle', 'set-mode') or not no_daemon:
+            LOG.error("Could not reach the daemon on '{}': {}".format(options.socket_path, e))
+            return 1
+
+        LOG.debug("Daemon is not available ({}), switching the mode in-process.".format(e))
+        load_profiles(options.profiles_dir)
+        wacom = toggle_touchring(get_param_backend(options.backend, options.jobs), not options.rediscover)
+        if options.client_command == 'toggle':
+            return 0 if wacom.toggle_mode(options.verify, options.tablet, options.ring) else 1
+        return 0 if wacom.set_mode(options.client_mode, verify=options.verify, tablet=options.tablet,
+                                   ring=options.ring, profile=options.client_profile) else 1
+
+    if reply.get('status') != 'ok':
+        LOG.error(reply.get('message', "Daemon failed to execute '{}'".format(options.client_command)))
+        return 1
+
+    for tablet in reply.get('tablets', []):
+        for ring in tablet.get('rings', []):
+            name = tablet.get('name') if len(tablet['rings']) == 1 else '{} ring {}'.format(tablet.get('name'), ring.get('ring'))
+            LOG.info("Tablet '{}', profile '{}', mode {}: {}".format(name, reply.get('profile'), ring.get('mode'),
+                                                                   ring.get('mode_description')))
+    return 0
+
+
+if __name__ == '__main__':
+    """
+    Write the main program here
+    """
+    # Parse the command line options
+    options = _command_Line_Options()
+    # Configure logging
+    _configureLogging(options.loglevel)
+    # The default socket path checks the runtime directory, which may log a warning
+    if options.socket_path is None:
+        options.socket_path = default_socket_path()
+
+    if options.trace_file or options.trace_summary:
+        TRACE.enable()
+
+    try:
+        if options.inventory:
+            load_profiles(options.profiles_dir)
+            print_(json.dumps(system_inventory(get_param_backend(options.backend, options.jobs), options.socket_path,
+                                               not options.rediscover), indent=2, sort_keys=True))
+            exit(0)
+
+        # Requests for a running daemon do not need anything else.
+        if options.client_command is not None:
+            exit(run_client(options))
+
+        # Load and validate the user defined profiles
+        with TRACE.span('profiles'):
+            load_profiles(options.profiles_dir)
+
+        if options.isDaemon:
+            # Keep the discovered state resident and serve requests on the control socket.
+            touchring_daemon(options.socket_path, get_param_backend(options.backend, options.jobs),
+                             not options.rediscover, options.listen_button, options.listen_device,
+                             options.follow_window, options.accelerate).serve_forever()
+        else:
+            # Create a toggle_touchring() object and call the toggle_mode() method.
+            wacom = toggle_touchring(get_param_backend(options.backend, options.jobs), not options.rediscover)
+            with TRACE.span('toggle'):
+                wacom.toggle_mode(options.verify, options.tablet, options.ring)
+    finally:
+        if TRACE.enabled:
+            if options.trace_file:
+                TRACE.write(options.trace_file, options.trace_format)
+            if options.trace_summary:
+                TRACE.print_summary()